@@ -0,0 +1,280 @@
+"""
+    给命令行客户端用的 JSON API，URL 都以 /api/v1/ 开头
+    用请求头 Authorization: Token <令牌> 认证，令牌用 python manage.py apitoken 创建，
+    不用 session 和 CSRF，也不渲染模板
+
+    GET    stat/?path=a/b           按路径查文件或者目录
+    GET    dirs/<pk>/               目录信息和分页的目录列表，参数同目录详情页
+    POST   dirs/                    新建目录 {"parent": pk, "name": ...}
+    PATCH  dirs/<pk>/               移动或者重命名 {"parent": pk, "name": ...}，都可以省略
+    DELETE dirs/<pk>/               递归地删除目录
+    POST   dirs/<pk>/files/         上传文件，multipart，字段名 files，可以有多个；
+                                    conflict 字段指定重名时怎么办：suffix、replace 或 reject
+    GET    dirs/<pk>/archive/       打包下载整个目录，参数同网页的打包下载
+    GET    files/<pk>/              文件信息
+    GET    files/<pk>/content/      下载，支持 Range
+    PATCH  files/<pk>/              移动或者重命名
+    DELETE files/<pk>/              删除文件
+    POST   batch/                   {"operations": [...]}，在一个事务里依次执行，有一个失败全部回滚
+
+    batch 里的每个操作是 {"op": "mkdir" | "move" | "delete", ...}，参数和上面对应的接口一样，
+    move 和 delete 还需要 "kind": "dir" | "file" 和 "id"；
+    parent 可以写成 "$0"，表示同一批里第 0 个操作新建的目录
+
+    出错时返回 {"error": 说明}，batch 出错时还有 "index"，表示第几个操作失败
+    目录下已经有同名文件（上传时 conflict 为 reject，或者移动、改名）时返回 409
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse, HttpResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+
+from .archives import get_archive_response, ARCHIVE_FORMATS, COMPRESSIONS
+from .forms import CreateDirectoryForm, EditForm
+from .handles import (handle_uploaded_files, get_download_response, check_quota,
+                      list_directory, get_listing_args, find_by_path, get_conflict_arg)
+from .models import Directory, File, Link, ApiToken, NameConflict
+from .tasks import wake_blob_reaper
+from .uploadhandlers import use_hashing_upload_handler
+
+import functools
+import json
+
+
+class ApiError(Exception):
+    """ 返回给客户端的错误，status 为 HTTP 状态码 """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_view(*methods):
+    """
+        API 的 view 都用这个装饰：检查请求方法，按令牌认证，
+        把 ApiError、ValueError（模型里的检查）和 Http404 转成 JSON 错误
+    """
+    def decorator(view):
+        @csrf_exempt
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                response = JsonResponse({'error': '不支持 {} 方法'.format(request.method)}, status=405)
+                response['Allow'] = ', '.join(methods)
+                return response
+            user = authenticate(request)
+            if user is None:
+                response = JsonResponse({'error': '缺少令牌或者令牌无效'}, status=401)
+                response['WWW-Authenticate'] = 'Token'
+                return response
+            request.user = user
+            try:
+                return view(request, *args, **kwargs)
+            except ApiError as e:
+                return JsonResponse({'error': str(e)}, status=e.status)
+            except NameConflict as e:
+                return JsonResponse({'error': str(e)}, status=409)
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            except Http404:
+                return JsonResponse({'error': '文件或者目录不存在'}, status=404)
+        return wrapper
+    return decorator
+
+
+def authenticate(request):
+    """ 请求头 Authorization: Token <令牌>，返回对应的用户，没有或者无效时返回 None """
+    keyword, _, key = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if keyword != 'Token' or not key.strip():
+        return None
+    return ApiToken.get_user(key.strip())
+
+
+def read_json(request):
+    """ 请求体里的 JSON 对象，空请求体当作 {} """
+    if not request.body:
+        return {}
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        raise ApiError('请求体不是合法的 JSON')
+    if not isinstance(data, dict):
+        raise ApiError('请求体必须是 JSON 对象')
+    return data
+
+
+def clean_name(form_class, name):
+    """ 用网页上同样的表单检查文件名、目录名 """
+    form = form_class({'name': name})
+    if not form.is_valid():
+        raise ApiError(' '.join(form.errors['name']))
+    return form.cleaned_data['name']
+
+
+###################
+####  操作  ####
+###################
+
+# 单个接口和 batch 共用下面这些函数，results 是同一批里前面操作的返回值
+
+def get_directory(user, pk, results=()):
+    """ pk 为 "$<序号>" 时取同一批里前面新建的目录 """
+    if isinstance(pk, str) and pk.startswith('$'):
+        try:
+            pk = results[int(pk[1:])]['id']
+        except (ValueError, IndexError, KeyError, TypeError):
+            raise ApiError('引用了不存在的操作结果 {}'.format(pk))
+    return get_object_or_404(Directory, pk=pk, owner=user)
+
+
+def do_mkdir(user, data, results=()):
+    parent = get_directory(user, data.get('parent'), results)
+    name = clean_name(CreateDirectoryForm, data.get('name', ''))
+    return parent.create_subdir(name).to_dict() # 重名时抛出 NameConflict，返回 409
+
+
+def do_move(user, data, results=()):
+    """ kind 为 dir 或者 file，parent 和 name 都可以省略 """
+    kind = data.get('kind')
+    if kind not in ('dir', 'file'):
+        raise ApiError('kind 只能是 dir 或者 file')
+    model, form_class = (Directory, CreateDirectoryForm) if kind == 'dir' else (File, EditForm)
+    obj = get_object_or_404(model, pk=data.get('id'), owner=user)
+    parent = get_directory(user, data['parent'], results) if data.get('parent') is not None else None
+    name = clean_name(form_class, data['name']) if data.get('name') is not None else None
+    obj.move(parent, name)
+    return obj.to_dict()
+
+
+def do_delete(user, data, results=()):
+    """ 删除目录时递归地删除其中所有的文件和子目录，磁盘文件在事务提交之后由后台线程删除 """
+    kind = data.get('kind')
+    if kind == 'dir':
+        get_object_or_404(Directory, pk=data.get('id'), owner=user).rmdir()
+        transaction.on_commit(wake_blob_reaper)
+    elif kind == 'file':
+        Link.minus_one(get_object_or_404(File, pk=data.get('id'), owner=user))
+    else:
+        raise ApiError('kind 只能是 dir 或者 file')
+    return {'id': data.get('id'), 'kind': kind, 'deleted': True}
+
+
+OPERATIONS = {
+    'mkdir': do_mkdir,
+    'move': do_move,
+    'delete': do_delete,
+}
+
+
+###################
+####  接口  ####
+###################
+
+@api_view('GET')
+def stat(request):
+    """ 按路径查找，和网页的 URL 一样，根目录是空字符串 """
+    path = request.GET.get('path', '').strip('/')
+    found = find_by_path(request.user, path)
+    if found is None:
+        if path:
+            raise Http404
+        found = Directory.create_root_dir(request.user) # 主目录被删了，自动新建
+    return JsonResponse(dict(found.to_dict(), kind='file' if isinstance(found, File) else 'dir'))
+
+
+@api_view('POST')
+def dir_create(request):
+    return JsonResponse(do_mkdir(request.user, read_json(request)), status=201)
+
+
+@api_view('GET', 'PATCH', 'DELETE')
+def dir_detail(request, pk):
+    if request.method == 'GET':
+        directory = get_object_or_404(Directory, pk=pk, owner=request.user)
+        entries, next_cursor = list_directory(directory, request.user.username,
+                                              *get_listing_args(request))
+        return JsonResponse({'dir': directory.to_dict(), 'entries': entries, 'next': next_cursor})
+
+    data = dict(read_json(request), kind='dir', id=pk)
+    if request.method == 'PATCH':
+        return JsonResponse(do_move(request.user, data))
+    do_delete(request.user, data)
+    return HttpResponse(status=204)
+
+
+@api_view('POST')
+def dir_upload(request, pk):
+    """ 先用 Content-Length 检查配额，通过之后才解析请求体 """
+    directory = get_object_or_404(Directory, pk=pk, owner=request.user)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if not check_quota(request.user, length):
+        raise ApiError('抱歉，空间不足', status=413)
+    use_hashing_upload_handler(request)
+    files = request.FILES.getlist('files')
+    if not files:
+        raise ApiError('没有上传文件，字段名应为 files')
+    conflict = get_conflict_arg(request)
+    created = handle_uploaded_files(files, request.user, directory, conflict)
+    return JsonResponse({'files': [file.to_dict() for file in created]}, status=201)
+
+
+@api_view('GET')
+def dir_archive(request, pk):
+    directory = get_object_or_404(Directory, pk=pk, owner=request.user)
+    fmt = request.GET.get('format', 'zip')
+    compression = request.GET.get('compression', 'auto')
+    if fmt not in ARCHIVE_FORMATS:
+        raise ApiError('format 只能是 {}'.format(', '.join(sorted(ARCHIVE_FORMATS))))
+    if compression not in COMPRESSIONS:
+        raise ApiError('compression 只能是 {}'.format(', '.join(COMPRESSIONS)))
+    return get_archive_response(directory, fmt, compression)
+
+
+@api_view('GET', 'PATCH', 'DELETE')
+def file_detail(request, pk):
+    if request.method == 'GET':
+        return JsonResponse(get_object_or_404(File, pk=pk, owner=request.user).to_dict())
+
+    data = dict(read_json(request), kind='file', id=pk)
+    if request.method == 'PATCH':
+        return JsonResponse(do_move(request.user, data))
+    do_delete(request.user, data)
+    return HttpResponse(status=204)
+
+
+@api_view('GET', 'HEAD')
+def file_content(request, pk):
+    file = get_object_or_404(File, pk=pk, owner=request.user)
+    return get_download_response(request, file)
+
+
+@api_view('POST')
+def batch(request):
+    """ 所有操作在一个事务里执行，返回 {"results": [每个操作的结果]} """
+    operations = read_json(request).get('operations')
+    if not isinstance(operations, list) or not operations:
+        raise ApiError('operations 必须是非空的列表')
+    if len(operations) > settings.API_BATCH_MAX_OPERATIONS:
+        raise ApiError('一次最多 {} 个操作'.format(settings.API_BATCH_MAX_OPERATIONS))
+
+    results = []
+    try:
+        with transaction.atomic():
+            for operation in operations:
+                if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+                    raise ApiError('op 只能是 {}'.format(', '.join(sorted(OPERATIONS))))
+                results.append(OPERATIONS[operation['op']](request.user, operation, results))
+    except ApiError as e:
+        return JsonResponse({'error': str(e), 'index': len(results)}, status=e.status)
+    except NameConflict as e:
+        return JsonResponse({'error': str(e), 'index': len(results)}, status=409)
+    except ValueError as e:
+        return JsonResponse({'error': str(e), 'index': len(results)}, status=400)
+    except Http404:
+        return JsonResponse({'error': '文件或者目录不存在', 'index': len(results)}, status=404)
+    return JsonResponse({'results': results})
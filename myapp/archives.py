@@ -0,0 +1,177 @@
+"""
+    把整个目录打包成 ZIP 或者 tar 下载
+    边读 blob 边生成压缩包边发送，不在服务器上生成临时的压缩包，
+    每次最多只有一块 DOWNLOAD_CHUNK_SIZE 的数据在内存里
+
+    ZIP 写到不能 seek 的流里，zipfile 会在每个文件后面写 data descriptor，
+    超过 4GB 的文件和超过 65535 个文件时自动使用 ZIP64
+    ZIP 的中央目录要在最后写出，每个文件在内存里留一个 ZipInfo，和文件大小无关
+
+    已经压缩过的格式（图片、视频、压缩包）用 stored 模式，不再浪费 CPU 压缩
+"""
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .models import Directory, File
+from .utils import iter_file_range
+
+from urllib.parse import quote
+import zipfile
+import tarfile
+import time
+import os
+
+ARCHIVE_FORMATS = {
+    'zip': ('application/zip', '.zip'),
+    'tar': ('application/x-tar', '.tar'),
+}
+
+COMPRESSIONS = ('auto', 'store', 'deflate')
+
+
+class _Pipe(object):
+    """ 只能写的文件对象，写进来的数据由生成器取走；没有 tell，zipfile 会按流式写入处理 """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def get_archive_response(directory, fmt='zip', compression='auto'):
+    """
+        directory: 要打包的目录
+        fmt: zip 或者 tar；tar 不压缩
+        compression: ZIP 的压缩方式，auto 时按扩展名决定，已经压缩过的文件用 stored
+    """
+    content_type, ext = ARCHIVE_FORMATS[fmt]
+    entries = iter_subtree(directory)
+    if fmt == 'zip':
+        stream = iter_zip(entries, compression)
+    else:
+        stream = iter_tar(entries)
+    response = StreamingHttpResponse(stream, content_type=content_type)
+    name = (directory.name if directory.parent_id else directory.owner.username) + ext
+    response['Content-Disposition'] = 'attachment; filename={}'.format(quote(name))
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def iter_subtree(directory, batch=1000):
+    """
+        依次返回 (压缩包里的路径, File 或者 None)，None 表示目录
+        压缩包里最外层是目录自身，先列所有目录，再列所有文件，都按 pk 分批查询
+        File 对象只有打开文件需要的字段
+    """
+    top = directory.name if directory.parent_id else directory.owner.username
+    prefix = len(directory.path)
+
+    def relpath(path, *names):
+        return os.path.join(top, path[prefix:].lstrip('/'), *names).rstrip('/')
+
+    subtree = directory.get_subtree()
+    last_pk = 0
+    while True:
+        rows = list(subtree.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'path')[:batch])
+        if not rows:
+            break
+        for pk, path in rows:
+            yield relpath(path), None
+        last_pk = rows[-1][0]
+
+    files = directory.get_subtree_files()
+    last_pk = 0
+    while True:
+        rows = list(files.filter(pk__gt=last_pk).order_by('pk').values_list(
+            'pk', 'name', 'path', 'digest', 'size', 'datetime')[:batch])
+        if not rows:
+            break
+        for pk, name, path, digest, size, created in rows:
+            yield relpath(path, name), File(pk=pk, name=name, digest=digest, size=size, datetime=created)
+        last_pk = rows[-1][0]
+
+
+def is_compressed(name):
+    """ 按扩展名判断是不是已经压缩过的格式 """
+    return os.path.splitext(name)[1].lower() in settings.ARCHIVE_STORED_EXTENSIONS
+
+
+def _open(file):
+    """ 打开文件，blob 已经不在了（打包期间被删除）时返回 None，跳过这个文件 """
+    try:
+        return file.open()
+    except OSError:
+        return None
+
+
+def iter_zip(entries, compression='auto'):
+    pipe = _Pipe()
+    chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+    with zipfile.ZipFile(pipe, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for name, file in entries:
+            if file is None:
+                info = zipfile.ZipInfo(name + '/')
+                info.external_attr = (0o40755 << 16) | 0x10 # MS-DOS 的目录标记
+                archive.writestr(info, b'')
+                yield pipe.drain()
+                continue
+
+            f = _open(file)
+            if f is None:
+                continue
+            info = zipfile.ZipInfo(name, date_time=_zip_date_time(file.datetime))
+            info.external_attr = 0o644 << 16
+            info.file_size = file.size # zipfile 按这个大小决定是否使用 ZIP64
+            if compression == 'store' or (compression == 'auto' and is_compressed(name)):
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as dest:
+                for chunk in iter_file_range(lambda: f, 0, file.size, chunk_size):
+                    dest.write(chunk)
+                    yield pipe.drain()
+            yield pipe.drain()
+    yield pipe.drain() # 中央目录
+
+
+def _zip_date_time(value):
+    """ ZIP 只能记录 1980 年以后的本地时间 """
+    return max(time.localtime(value.timestamp())[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def iter_tar(entries):
+    """
+        直接生成 tar 的头部和数据块，不经过 tarfile.addfile，大文件不会整个读进内存
+        用 PAX 格式，文件名不限长度和编码，文件大小没有 8GB 的限制
+    """
+    chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+    for name, file in entries:
+        info = tarfile.TarInfo(name)
+        if file is None:
+            info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, time.time()
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+            continue
+
+        f = _open(file)
+        if f is None:
+            continue
+        info.size, info.mode, info.mtime = file.size, 0o644, file.datetime.timestamp()
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+        written = 0
+        for chunk in iter_file_range(lambda: f, 0, file.size, chunk_size):
+            written += len(chunk)
+            yield chunk
+        # 头部里已经写了文件大小，文件读不满时补零，保证后面的文件位置不错
+        yield bytes(file.size - written + (-file.size % tarfile.BLOCKSIZE))
+    yield bytes(tarfile.BLOCKSIZE * 2) # 结束标记
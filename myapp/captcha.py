@@ -0,0 +1,84 @@
+"""
+    验证码池
+    渲染一张验证码（画字、透视变换、滤镜、PNG 编码）很耗 CPU，登录高峰时不应该放在请求里做。
+    后台线程预先渲染好一批 (文本, PNG)，请求只需要取出一个；
+    取出的验证码马上从池里删掉，不会发给第二个人
+"""
+
+from django.conf import settings
+
+from .utils import get_captcha_text, render_captcha_png
+
+from collections import deque
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def render_captcha():
+    """ 返回 (验证码文本, PNG bytes) """
+    text = ''.join(get_captcha_text())
+    return text, render_captcha_png(text)
+
+
+class CaptchaPool(object):
+    """
+        size: 池里最多放多少个验证码
+        low_water: 少于这个数时唤醒后台线程补充
+        后台线程在第一次取验证码时才启动，所以 fork 出来的 worker 进程各有自己的线程
+    """
+
+    def __init__(self, size, low_water):
+        self.size = size
+        self.low_water = low_water
+        self._pool = deque() # append 和 popleft 本身是线程安全的
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self):
+        """ 取出一个验证码；池空了就在当前请求里渲染 """
+        try:
+            item = self._pool.popleft()
+        except IndexError:
+            item = None
+        if len(self._pool) < self.low_water:
+            self._start()
+            self._wakeup.set()
+        return item or render_captcha()
+
+    def fill(self):
+        """ 补满整个池，后台线程和测速时使用 """
+        while len(self._pool) < self.size:
+            self._pool.append(render_captcha())
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='captcha-pool', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.fill()
+            except Exception:
+                logger.exception('渲染验证码失败')
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_captcha():
+    """ 返回 (验证码文本, PNG bytes)，CAPTCHA_POOL_SIZE 为 0 时不使用验证码池 """
+    global _pool
+    if not settings.CAPTCHA_POOL_SIZE:
+        return render_captcha()
+    with _pool_lock:
+        if _pool is None:
+            _pool = CaptchaPool(settings.CAPTCHA_POOL_SIZE, settings.CAPTCHA_POOL_LOW_WATER)
+    return _pool.get()
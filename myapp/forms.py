@@ -72,6 +72,11 @@ class UploadForm(forms.Form):
         label='',
         widget=forms.ClearableFileInput(attrs={'multiple': True})
     )
+    conflict = forms.ChoiceField(
+        label='重名时',
+        choices=(('suffix', '自动改名'), ('replace', '覆盖为新版本'), ('reject', '放弃上传')),
+        required=False,
+    )
 
 
 class CreateDirectoryForm(forms.Form):
@@ -93,6 +98,32 @@ class CreateDirectoryForm(forms.Form):
             return name.strip()
 
 
+class MoveDirectoryForm(forms.Form):
+    """
+        移动或者重命名目录，和 mvdir view函数绑定
+        target 是目标上级目录的路径，空白表示根目录
+    """
+    name = forms.CharField(
+        label='目录名 ',
+        widget=forms.TextInput(attrs={'class': 'input'}),
+    )
+    target = forms.CharField(
+        label='移动到 ',
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'input'}),
+    )
+
+    def clean_name(self):
+        name = self.cleaned_data.get('name')
+        if '/' in name or '%' in name:
+            raise ValidationError('抱歉，目录名不可以包含 "/" 或 "%"')
+        else:
+            return name.strip()
+
+    def clean_target(self):
+        return self.cleaned_data.get('target', '').strip().strip('/')
+
+
 class EditForm(forms.Form):
     """
         编辑文件信息，
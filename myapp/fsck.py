@@ -0,0 +1,415 @@
+"""
+    磁盘和数据库的一致性检查与垃圾回收
+    需要依赖 django 环境才能运行，由 fsck 命令调用
+
+    磁盘上可能残留的东西：
+        计数已经归零、还没来得及删除的 blob（OrphanBlob）
+        os.rename 之后、Link.add_one 之前进程崩溃留下的、没有任何引用的 blob
+        上传中断留下的临时文件（uuid 命名）、断点续传的 .part 文件、删除中断留下的墓碑
+    数据库里可能出现的问题：
+        Link / Chunk 的计数和实际引用数对不上
+        有计数，磁盘上却没有对应的文件
+        没有任何 Link 和 File 的分块清单，Chunk 的计数因此一直不归零
+    启用 CHUNK_STORE 时，扫描到的还没有分块储存的大文件也会顺便切分
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import (Directory, File, Link, Chunk, FileChunk, OrphanBlob, UploadSession, Usage,
+                     get_media_abspath, get_chunk_abspath, get_quarantine_abspath, get_thumbnail_root,
+                     get_blob_abspath, iter_batches)
+from .handles import discard_upload_session
+from .tasks import reap_orphan_blobs, store_chunked_blob, is_chunk_candidate
+from .utils import iter_files_sorted, RateLimiter
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+import hashlib
+import time
+import os
+import re
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{40}$')
+TEMP_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+PART_RE = re.compile(r'^([0-9a-f-]{36})\.part$')
+TOMBSTONE_RE = re.compile(r'^([0-9a-f]{40})\.deleting-[0-9a-f]{32}$')
+
+
+class Collector(object):
+    """
+        dry_run: 只报告，不做任何修改
+        iops: 每秒最多处理多少个文件，0 表示不限制
+        bandwidth: 校验 sha1 时每秒最多读取多少字节，0 表示不限制
+        verify: 是否重新计算 blob 的 sha1，和文件名对比
+        log: 输出函数
+
+        所有结果计入 self.stats，reclaimed_bytes 为释放的磁盘空间
+    """
+
+    def __init__(self, dry_run=False, iops=0, bandwidth=0, verify=False, log=print):
+        self.dry_run = dry_run
+        self.verify = verify
+        self.log = log
+        self.iops = RateLimiter(iops)
+        self.bandwidth = RateLimiter(bandwidth)
+        self.stats = Counter()
+        self.now = time.time()
+        self.grace = settings.GC_GRACE_SECONDS
+
+    def run(self, limit=None):
+        """ 完整的一轮：清理 OrphanBlob 和没有引用的分块清单，增量扫描磁盘，清理隔离区，清理过期的上传会话 """
+        if not self.dry_run:
+            self.stats['reaped'] += reap_orphan_blobs()
+        self.release_orphan_manifests()
+        self.scan(limit)
+        self.purge_quarantine()
+        self.expire_upload_sessions()
+        return self.stats
+
+    ###################
+    ####  扫描磁盘  ####
+    ###################
+
+    def scan(self, limit=None):
+        """
+            从上次停下的位置继续扫描 media 目录，最多处理 limit 个文件
+            扫描到末尾后从头开始，位置记在隔离区目录下的 cursor 文件里
+        """
+        media_root = get_media_abspath()
+        chunk_root = get_chunk_abspath()
+        quarantine = get_quarantine_abspath()
+        cursor = self._read_cursor()
+        blobs, chunks = [], []
+        scanned = 0
+        last = None
+
+        for relpath, entry in iter_files_sorted(media_root, cursor, skip=(quarantine, get_thumbnail_root())):
+            self.iops.consume()
+            last = relpath
+            scanned += 1
+            in_chunks = entry.path.startswith(chunk_root + os.sep)
+            name = entry.name
+
+            if DIGEST_RE.match(name):
+                (chunks if in_chunks else blobs).append(entry)
+                if len(blobs) >= 500:
+                    self._check_blobs(blobs, chunk=False)
+                    blobs = []
+                if len(chunks) >= 500:
+                    self._check_blobs(chunks, chunk=True)
+                    chunks = []
+            elif TEMP_RE.match(name):
+                if self._is_stale(entry):
+                    self._remove(entry, 'temp')
+            elif PART_RE.match(name) and not in_chunks:
+                self._check_part(entry, PART_RE.match(name).group(1))
+            elif TOMBSTONE_RE.match(name):
+                self._check_tombstone(entry, TOMBSTONE_RE.match(name).group(1), in_chunks)
+
+            if limit and scanned >= limit:
+                break
+        else:
+            last = None # 扫描到了末尾，下次从头开始
+
+        self._check_blobs(blobs, chunk=False)
+        self._check_blobs(chunks, chunk=True)
+        self.stats['scanned'] += scanned
+        self._write_cursor(last)
+
+    def _check_blobs(self, entries, chunk):
+        """
+            一批 blob 一次查询数据库，没有任何引用的移入隔离区
+            有引用、还没有分块储存的大文件交给 store_chunked_blob
+        """
+        if not entries:
+            return
+        digests = [entry.name for entry in entries]
+        if chunk:
+            referenced = set(Chunk.objects.filter(digest__in=digests).values_list('digest', flat=True))
+        else:
+            referenced = set(Link.objects.filter(digest__in=digests).values_list('digest', flat=True))
+            referenced |= set(File.objects.filter(digest__in=digests).values_list('digest', flat=True))
+
+        for entry in entries:
+            if entry.name in referenced:
+                if self.verify and not self._verify(entry):
+                    self.stats['corrupt'] += 1
+                    self.log('sha1 不匹配: {}'.format(entry.path))
+                elif not chunk and is_chunk_candidate(entry.stat().st_size):
+                    self._chunk(entry)
+            elif self._is_stale(entry): # 刚放好、还没来得及提交计数的 blob 不动
+                self._quarantine(entry, chunk)
+
+    def _chunk(self, entry):
+        self.stats['unchunked'] += 1
+        self.log('分块储存: {}'.format(entry.path))
+        if not self.dry_run and store_chunked_blob(entry.name):
+            self.stats['chunked'] += 1
+
+    def _verify(self, entry):
+        hasher = hashlib.sha1()
+        with open(entry.path, 'rb') as f:
+            while True:
+                data = f.read(settings.UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                self.bandwidth.consume(len(data))
+                hasher.update(data)
+        return hasher.hexdigest() == entry.name
+
+    def _check_part(self, entry, session_id):
+        """ 断点续传的临时文件，会话已经不存在时删除，会话过期交给 expire_upload_sessions """
+        if self._is_stale(entry) and not UploadSession.objects.filter(pk=session_id).exists():
+            self._remove(entry, 'temp')
+
+    def _check_tombstone(self, entry, digest, chunk):
+        """
+            remove_blob 在改名之后、删除之前中断留下的墓碑
+            仍有引用并且原来的位置是空的就放回去，否则删除
+        """
+        if not self._is_stale(entry):
+            return
+        if chunk:
+            referenced = Chunk.objects.filter(digest=digest).exists()
+            path = get_blob_abspath(digest, get_chunk_abspath())
+        else:
+            referenced = Link.objects.filter(digest=digest).exists()
+            path = get_blob_abspath(digest)
+        if referenced and not os.path.exists(path):
+            self.stats['restored'] += 1
+            if not self.dry_run:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(entry.path, path)
+        else:
+            self._remove(entry, 'tombstone')
+
+    def release_orphan_manifests(self):
+        """
+            没有任何 Link 和 File 的分块清单，连同它对 Chunk 的引用一起释放
+            以前在请求里切分时，File 的事务失败或者计数归零时没能释放就会留下这样的清单
+            先锁住清单再确认没有引用：分块储存的线程写清单前会用加锁的读等这个事务结束
+        """
+        digests = list(FileChunk.objects.filter(index=0)
+                       .exclude(digest__in=Link.objects.values('digest'))
+                       .exclude(digest__in=File.objects.values('digest'))
+                       .values_list('digest', flat=True))
+        for digest in digests:
+            self.stats['orphan_manifests'] += 1
+            self.log('没有引用的分块清单: {}'.format(digest))
+            if self.dry_run:
+                continue
+            with transaction.atomic():
+                if not FileChunk.objects.select_for_update().filter(digest=digest).exists():
+                    continue
+                if Link.objects.filter(digest=digest).exists() or File.objects.filter(digest=digest).exists():
+                    continue
+                Chunk.release(digest)
+
+    ###################
+    ####   隔离区   ####
+    ###################
+
+    def _quarantine(self, entry, chunk):
+        """ 没有引用的 blob 先移入隔离区，过了 GC_QUARANTINE_SECONDS 仍没有引用才删除 """
+        self.stats['quarantined'] += 1
+        self.log('隔离: {}'.format(entry.path))
+        if self.dry_run:
+            return
+        target = os.path.join(get_quarantine_abspath(), 'chunks' if chunk else 'blobs', entry.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(entry.path, target)
+        os.utime(target) # 用 mtime 记录隔离的时间
+
+    def purge_quarantine(self):
+        """ 隔离区里重新被引用的放回原处，隔离够久的删除 """
+        for kind, root in (('blobs', get_media_abspath()), ('chunks', get_chunk_abspath())):
+            directory = os.path.join(get_quarantine_abspath(), kind)
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                self.iops.consume()
+                if kind == 'chunks':
+                    referenced = Chunk.objects.filter(digest=entry.name).exists()
+                else:
+                    referenced = Link.objects.filter(digest=entry.name).exists() or \
+                        File.objects.filter(digest=entry.name).exists()
+                if referenced:
+                    self.stats['restored'] += 1
+                    if not self.dry_run:
+                        path = get_blob_abspath(entry.name, root)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        os.replace(entry.path, path)
+                elif self.now - entry.stat().st_mtime > settings.GC_QUARANTINE_SECONDS:
+                    self._remove(entry, 'purged')
+
+    ###################
+    ####  上传会话  ####
+    ###################
+
+    def expire_upload_sessions(self):
+        """ 超过 UPLOAD_SESSION_MAX_AGE 没有完成的断点续传会话，连同临时文件一起删除 """
+        deadline = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_MAX_AGE)
+        for session in UploadSession.objects.filter(datetime__lt=deadline):
+            self.stats['expired_sessions'] += 1
+            if os.path.exists(session.get_temp_path()):
+                self.stats['reclaimed_bytes'] += os.path.getsize(session.get_temp_path())
+            if not self.dry_run:
+                discard_upload_session(session)
+
+    ###################
+    ####  重建计数  ####
+    ###################
+
+    def rebuild_links(self):
+        """
+            按 File 的 digest 分组重新统计引用数，修正 Link；
+            按 FileChunk 分组重新统计，修正 Chunk
+            没有任何 File 的 Link 删除，blob 交给 OrphanBlob 清理
+            有计数但服务器上没有内容的 digest 只报告，无法修复
+        """
+        counts = File.objects.values_list('digest').annotate(n=Count('id')).order_by('digest')
+        self._reconcile(Link, counts.iterator())
+        orphans = list(Link.objects.exclude(digest__in=File.objects.values('digest'))
+                       .values_list('digest', flat=True))
+        self._drop(Link, orphans)
+
+        chunk_counts = FileChunk.objects.values_list('chunk_id').annotate(n=Count('id')).order_by('chunk_id')
+        self._reconcile(Chunk, chunk_counts.iterator())
+
+        for batch in iter_batches(list(Link.objects.values_list('digest', flat=True))):
+            for digest in batch:
+                self.iops.consume()
+                if not File(digest=digest).is_stored():
+                    self.stats['missing'] += 1
+                    self.log('文件丢失: {}'.format(digest))
+        return self.stats
+
+    def _reconcile(self, model, counts):
+        """ counts: 按主键排好序的 (digest, 实际引用数) """
+        batch = []
+        for row in counts:
+            batch.append(row)
+            if len(batch) >= 500:
+                self._reconcile_batch(model, batch)
+                batch = []
+        self._reconcile_batch(model, batch)
+
+    def _reconcile_batch(self, model, batch):
+        stored = dict(model.objects.filter(pk__in=[digest for digest, _ in batch])
+                      .values_list('pk', 'links'))
+        for digest, n in batch:
+            if stored.get(digest) == n:
+                continue
+            self.stats['fixed_links'] += 1
+            self.log('{} {}: {} -> {}'.format(model.__name__, digest, stored.get(digest), n))
+            if self.dry_run:
+                continue
+            with transaction.atomic():
+                # 在锁住计数之后重新统计一次，期间的上传和删除不会被覆盖掉
+                if model is Link:
+                    Link.objects.select_for_update().filter(digest=digest).first()
+                    n = File.objects.filter(digest=digest).count()
+                    if not Link.objects.filter(digest=digest).update(links=n):
+                        Link.objects.create(digest=digest, links=n)
+                else:
+                    Chunk.objects.select_for_update().filter(digest=digest).first()
+                    n = FileChunk.objects.filter(chunk_id=digest).count()
+                    Chunk.objects.filter(digest=digest).update(links=n)
+
+    def _drop(self, model, digests):
+        """ 没有任何引用的计数直接删除，磁盘文件交给 OrphanBlob """
+        for digest in digests:
+            self.stats['fixed_links'] += 1
+            self.log('{} {}: 没有任何引用'.format(model.__name__, digest))
+        if self.dry_run:
+            return
+        for batch in iter_batches(digests):
+            with transaction.atomic():
+                released = list(Link.objects.filter(digest__in=batch)
+                                 .exclude(digest__in=File.objects.values('digest'))
+                                 .values_list('digest', flat=True))
+                Link.objects.filter(digest__in=released).delete()
+                OrphanBlob.add(released)
+
+    def rebuild_usage(self):
+        """
+            按文件重新统计每个目录（包括子目录）和每个用户的用量，修正有偏差的计数
+            每个用户一个事务，先锁住他的所有目录：同时新增或删除文件的请求会等这个事务结束后
+            再加减计数，而这里统计时看不到它们还没提交的文件，所以不会算重也不会算漏
+        """
+        owners = set(Directory.objects.values_list('owner_id', flat=True).distinct())
+        owners |= set(Usage.objects.values_list('owner_id', flat=True))
+        for owner_id in sorted(owners):
+            with transaction.atomic():
+                self._rebuild_owner_usage(owner_id)
+        return self.stats
+
+    def _rebuild_owner_usage(self, owner_id):
+        dirs = list(Directory.objects.select_for_update().filter(owner_id=owner_id)
+                    .values_list('pk', 'tree', 'size', 'file_count'))
+        own = {parent: (size, count) for parent, size, count in
+               File.objects.filter(owner_id=owner_id).values_list('parent')
+               .annotate(Sum('size'), Count('id')).order_by()}
+
+        totals = defaultdict(lambda: [0, 0])
+        for pk, tree, _, _ in dirs:
+            size, count = own.get(pk, (0, 0))
+            for ancestor in Directory(tree=tree).get_ancestor_pks():
+                totals[ancestor][0] += size
+                totals[ancestor][1] += count
+
+        for pk, tree, size, count in dirs:
+            if [size, count] != totals[pk]:
+                self._fix_usage('Directory {}'.format(pk), (size, count), totals[pk])
+                if not self.dry_run:
+                    Directory.objects.filter(pk=pk).update(size=totals[pk][0], file_count=totals[pk][1])
+
+        usage = Usage.objects.select_for_update().filter(owner_id=owner_id).first()
+        actual = [sum(size for size, _ in own.values()), sum(count for _, count in own.values())]
+        stored = (usage.size, usage.file_count) if usage else (0, 0)
+        if list(stored) != actual:
+            self._fix_usage('Usage {}'.format(owner_id), stored, actual)
+            if not self.dry_run:
+                Usage.objects.update_or_create(owner_id=owner_id,
+                                               defaults={'size': actual[0], 'file_count': actual[1]})
+
+    def _fix_usage(self, name, stored, actual):
+        self.stats['fixed_usage'] += 1
+        self.log('{}: {} 字节 {} 个文件 -> {} 字节 {} 个文件'.format(name, *(tuple(stored) + tuple(actual))))
+
+    ###################
+    ####    工具    ####
+    ###################
+
+    def _is_stale(self, entry):
+        return self.now - entry.stat().st_mtime > self.grace
+
+    def _remove(self, entry, kind):
+        size = entry.stat().st_size
+        self.stats[kind] += 1
+        self.stats['reclaimed_bytes'] += size
+        if not self.dry_run:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _cursor_path(self):
+        return os.path.join(get_quarantine_abspath(), 'cursor')
+
+    def _read_cursor(self):
+        try:
+            with open(self._cursor_path()) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _write_cursor(self, relpath):
+        if self.dry_run:
+            return
+        os.makedirs(get_quarantine_abspath(), exist_ok=True)
+        with open(self._cursor_path(), 'w') as f:
+            f.write(relpath or '')
@@ -7,68 +7,1027 @@
 """
 
 from django.conf import settings
-from django.db.models import F
-from .models import Directory, File, Link, get_media_abspath
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q, Sum, Case, When, Value
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, StreamingHttpResponse, HttpResponse, UnreadablePostError, Http404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.crypto import salted_hmac, constant_time_compare
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from .models import (Directory, File, Link, FileChunk, Usage, FileType, OrphanBlob, UploadSession,
+                     NameConflict, get_media_abspath, get_blob_abspath, get_path_hash, iter_batches)
+from .tasks import wake_blob_reaper, chunk_blob_later, is_chunk_candidate
+from .utils import parse_range_header, iter_file_range
+from .thumbnails import get_thumbnail, get_thumbnail_format, ThumbnailBusy
+from .previews import is_text, get_text_snippet
+from .uploadhandlers import HashingUploadedFile
+from functools import partial
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import threading
+import mimetypes
+import fcntl
+import datetime
+import random
 import hashlib
 import uuid
 import os
 import re
 
-def handle_repetitive_file(file):
-    """
-        处理同名的或者重复的文件
-        file: File object
+# you need 'brew install libmagic' under Mac OS
+import magic
 
-        通过遍历看是否有重复路径，如果有重复，则返回带序号的 path
-    """
+# 目录下已经有同名文件时的处理方式，见 create_file_object
+NAME_CONFLICTS = ('suffix', 'replace', 'reject')
+
+
+def get_conflict_arg(request):
+    """ 请求里的 conflict 参数，没有时用 UPLOAD_NAME_CONFLICT，不合法时抛出 ValueError """
+    conflict = request.POST.get('conflict') or settings.UPLOAD_NAME_CONFLICT
+    if conflict not in NAME_CONFLICTS:
+        raise ValueError('conflict 只能是 {}'.format(', '.join(NAME_CONFLICTS)))
+    return conflict
 
-    # 同一个用户的重名文件，与 digest 无关
-    if File.objects.filter(owner=file.owner, path=file.path, name=file.name).count() > 1:
-        base, ext = os.path.splitext(file.name)
-        file.name = '{}_{}{}'.format(base, file.pk, ext)
-        file.save()
 
-    Link.add_one(file)
+def suffix_name(name, suffix):
+    """ a.txt -> a_<suffix>.txt """
+    base, ext = os.path.splitext(name)
+    return '{}_{}{}'.format(base, suffix, ext)
 
 
-def handle_uploaded_files(files, owner, directory):
+def handle_uploaded_files(files, owner, directory, conflict='suffix'):
     """
         files: 接收到来自用户上传的一组文件
         owner: 用户的 user 对象
         directory: 用户上传文件时所在的目录
+        conflict: 目录下已经有同名文件时怎么办，见 create_file_object
 
         先给一个随机名字，然后一边接收，一边 hash，
-        最后用 hash 值来命名文件
+        所有文件都写完之后，用 hash 值来命名文件，再在一个事务里批量创建 File 对象，
+        返回新建的 File 对象列表
+
+        由 HashingFileUploadHandler 接收的文件在解析请求时已经写入 media 目录并算好了 sha1，
+        直接使用它的临时文件，不再复制
     """
-    # import pdb; pdb.set_trace()
     media_dir = get_media_abspath() # 所有文件的绝对路径
+    uploads = []
+    hashed = []
 
     for file in files:
-
-        digest = hashlib.sha1()
+        if isinstance(file, HashingUploadedFile):
+            hashed.append(file)
+            uploads.append((file.temporary_file_path(), file.digest, file.name, file.size, file.head))
+            continue
         temp_filename = os.path.join(media_dir, str(uuid.uuid1())) #　临时文件
-        with open(temp_filename, 'wb+') as destination:
+        head = bytearray() # 顺便留下开头一段，用来判断文件类型，不需要再读一次磁盘
+        digest = ingest_file(file, temp_filename, head=head)
+        uploads.append((temp_filename, digest, file.name, file.size, bytes(head)))
+    created = save_uploaded_files(uploads, owner, directory, conflict)
+    for file in hashed: # 临时文件已经交给 _settle_blob 在提交之后删除；出错时仍由 close 删除
+        file.saved = True
+    return created
+
+
+def ingest_file(src, temp_filename, hash_in_thread=None, head=None):
+    """
+        src: 可以 readinto 的文件对象，如 UploadedFile
+        temp_filename: 写入的临时文件
+        hash_in_thread: 是否在单独的线程里算 sha1，默认读取 UPLOAD_HASH_IN_THREAD
+        head: bytearray，不为 None 时把文件开头 PREVIEW_SNIFF_SIZE 字节复制进去
+
+        用 UPLOAD_CHUNK_SIZE 大小的缓冲区读写，读进 bytearray 之后
+        直接用 memoryview 交给 sha1 和磁盘，不产生额外的拷贝，返回 sha1 hexdigest
+        不 fsync，新的 blob 由 place_blob 统一 fsync
+
+        在线程里算 hash 时使用两块缓冲区轮流读写，
+        sha1 和磁盘写入都会释放 GIL，所以两者可以重叠
+    """
+    if hash_in_thread is None:
+        hash_in_thread = settings.UPLOAD_HASH_IN_THREAD
+    buffer_size = settings.UPLOAD_CHUNK_SIZE
+    buffers = [memoryview(bytearray(buffer_size)) for _ in range(2 if hash_in_thread else 1)]
+    digest = hashlib.sha1()
+    executor = ThreadPoolExecutor(max_workers=1) if hash_in_thread else None
+    pending = None # 上一块缓冲区的 hash 任务
+
+    try:
+        src.seek(0)
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        with open(temp_filename, 'wb') as destination:
+            i = 0
+            while True:
+                buf = buffers[i % len(buffers)]
+                n = src.readinto(buf)
+                if not n:
+                    break
+                chunk = buf[:n]
+                if head is not None and len(head) < settings.PREVIEW_SNIFF_SIZE:
+                    head += chunk[:settings.PREVIEW_SNIFF_SIZE - len(head)]
+                if executor:
+                    task = executor.submit(digest.update, chunk)
+                    destination.write(chunk)
+                    if pending: # 下一轮要覆盖上一块缓冲区，等它 hash 完
+                        pending.result()
+                    pending = task
+                else:
+                    destination.write(chunk)
+                    digest.update(chunk)
+                i += 1
+
+            if pending:
+                pending.result()
+    finally:
+        if executor:
+            executor.shutdown()
+
+    return digest.hexdigest()
+
+
+def save_uploaded_file(temp_filename, digest, name, size, owner, directory, head=None,
+                       conflict='suffix'):
+    """
+        temp_filename: 已经完整写入磁盘的临时文件
+        digest: 临时文件的 sha1 摘要
+        name, size: 用户看到的文件名和文件大小
+        owner, directory: 文件所有者和所在目录
+        head: 文件开头的一段，有的话顺便记下文件类型
+        conflict: 目录下已经有同名文件时怎么办，见 create_file_object
+
+        用 hash 值来命名临时文件，创建 File 对象，再处理重名和计数
+        普通上传和断点续传最后都走这里
+
+        临时文件要等计数提交之后才删除：如果同一个 digest 刚好在此期间被删光，
+        blob 会被删除方移走，这时用临时文件重新放回去，见 models.remove_blob
+    """
+    place_blob(temp_filename, digest, size)
+    try:
+        file = create_file_object(digest, name, size, owner, directory, conflict)
+    except Exception: # 包括 reject 时的 NameConflict，刚放好的 blob 没有计数
+        discard_blobs([digest])
+        raise
+    if head is not None:
+        mime, description = remember_file_type(digest, bytes(head))
+        if is_text(mime, description): # 文本文件在上传时就准备好预览摘要
+            transaction.on_commit(partial(get_text_snippet, file))
+    transaction.on_commit(partial(_settle_blob, temp_filename, digest, size))
+    return file
+
+
+def save_uploaded_files(uploads, owner, directory, conflict='suffix'):
+    """
+        uploads: [(临时文件, digest, 文件名, 大小, 文件开头一段), ...]
+        批量版的 save_uploaded_file，一次上传多个文件时，数据库查询数和文件个数无关
+        同一个 digest 的内容只放一次，每个临时文件都等提交之后再删除
+        出错回滚时（包括 reject 时的 NameConflict），放好的 blob 交给后台清理
+    """
+    if conflict == 'replace': # 同名的只有最后一个会保存（见 create_file_objects），前面的不用放
+        last = {clean_file_name(name): i for i, (_, _, name, _, _) in enumerate(uploads)}
+        kept = set(last.values())
+        for i, (temp_filename, _, _, _, _) in enumerate(uploads):
+            if i not in kept:
+                os.remove(temp_filename)
+        uploads = [upload for i, upload in enumerate(uploads) if i in kept]
+    if not uploads:
+        return []
+    sizes = {}
+    for temp_filename, digest, _, size, _ in uploads:
+        if digest not in sizes:
+            place_blob(temp_filename, digest, size)
+            sizes[digest] = size
+
+    try:
+        with transaction.atomic():
+            files = create_file_objects([(digest, name, size) for _, digest, name, size, _ in uploads],
+                                        owner, directory, conflict)
+            types = remember_file_types({digest: head for _, digest, _, _, head in uploads})
+            snippets = {} # 同样内容的文本文件只需要准备一次摘要
+            for file in files:
+                if file.digest not in snippets and is_text(*types[file.digest]):
+                    snippets[file.digest] = file
+            for file in snippets.values():
+                transaction.on_commit(partial(get_text_snippet, file))
+            for temp_filename, digest, _, size, _ in uploads:
+                transaction.on_commit(partial(_settle_blob, temp_filename, digest, size))
+    except Exception:
+        discard_blobs(sizes)
+        raise
+    return files
+
+
+def discard_blobs(digests):
+    """
+        放好 blob 之后事务回滚了，这些 blob 没有计数。记入 OrphanBlob 交给后台清理，
+        后台删除前会确认没有别的引用，同时上传了同样内容、已经有计数的不受影响
+        在外层的事务里调用时，外层回滚会连这条记录一起丢掉，剩下的由 fsck 清理
+    """
+    OrphanBlob.add(list(digests))
+    transaction.on_commit(wake_blob_reaper)
+
+
+def clean_file_name(name):
+    """ 给用户看的名字，去掉正斜杠和百分号，just in case；亲测 mac 下，名字带正斜杠的文件无法被上传 """
+    return re.sub(r'[%/]', '_', name)
+
+
+def place_blob(temp_filename, digest, size):
+    """
+        把临时文件的内容用硬链接放到 digest 对应的位置，临时文件保留
+        启用 CHUNK_STORE 时，大文件也先放完整的 blob，File 提交之后
+        由 chunk_blobs 命令在 web 进程之外切分（见 tasks.store_chunked_blob），不在请求里切分；
+        已经有分块清单时也放，清单可能正在被释放，硬链接几乎没有代价，多余的由 fsck 删除
+        UPLOAD_FSYNC 时只在真正放了新的 blob 时 fsync 一次，重复的内容不 fsync
+    """
+    abspath = get_blob_abspath(digest) # 服务器路径，用于储存
+    os.makedirs(os.path.dirname(abspath), exist_ok=True)
+    try:
+        os.link(temp_filename, abspath) # 原子操作，和临时文件共用同一份数据
+    except FileExistsError: # 同一个 digest 的 blob 内容一样，不需要再放一次
+        return
+    if settings.UPLOAD_FSYNC:
+        fd = os.open(abspath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _settle_blob(temp_filename, digest, size):
+    """
+        计数提交之后调用，确认 blob 仍在服务器上，然后删除临时文件
+        需要分块储存的大文件，CHUNK_STORE_THREAD 为 True 时交给本进程的后台线程，否则等 chunk_blobs 命令
+    """
+    if not File(digest=digest).is_stored():
+        place_blob(temp_filename, digest, size)
+    os.remove(temp_filename)
+    if is_chunk_candidate(size):
+        chunk_blob_later(digest)
+
+
+def create_file_object(digest, name, size, owner, directory, conflict='suffix', stored_only=False):
+    """
+        磁盘上已经有 digest 对应的 blob 时，创建 File 对象，再增加计数和用量
+        秒传时直接调用，不需要传输任何数据
+
+        不先查有没有同名文件，直接插入，(parent, name) 的唯一索引冲突时按 conflict 处理：
+            suffix: 和以前一样改名为 name_<pk>
+            replace: 已有的同名文件换成新的内容，作为新版本，返回已有的 File
+            reject: 抛出 NameConflict
+        没有重名时只有一条 INSERT
+
+        stored_only: 秒传时为 True，手上没有临时文件，不能像 Link.add_one 那样在计数器刚被删掉时
+                     重新创建（blob 可能正在被删除，没有东西可以放回去）。
+                     只给已有的计数器加一，计数器的行锁一直持有到提交，并发的删除不会把它减到零；
+                     计数器已经不在时什么都不做，返回 None，让客户端正常上传
+    """
+    file = File(
+        name = clean_file_name(name), # 给用户看的名字
+        owner = owner,
+        parent = directory,
+        digest = digest,    # 服务器上真正的名字
+        path = directory.path, # 用户路径，用户给用户展示，不包含文件名
+        size = size,
+    )
+    with transaction.atomic():
+        if stored_only and not Link.objects.filter(digest=digest).update(links=F('links') + 1):
+            return None
+        try:
+            with transaction.atomic():
+                file.save()
+        except IntegrityError:
+            existing = File.objects.select_for_update().filter(parent=directory, name=file.name).first()
+            if existing is None: # 不是重名，比如目录刚好被删掉了
+                raise
+            if conflict == 'reject':
+                raise NameConflict('目录下已经有同名的文件 {}'.format(file.name))
+            if conflict == 'replace':
+                replace_files([(existing, digest, size)], directory, linked=stored_only)
+                return existing
+            name, file.name = file.name, uuid.uuid4().hex # 临时的名字，拿到 pk 之后再改
+            file.save()
+            apply_suffixes([(file, name)])
+        if not stored_only:
+            Link.add_one(file)
+        directory.add_usage(size, 1)
+    return file
+
+
+def create_file_objects(items, owner, directory, conflict='suffix'):
+    """
+        items: [(digest, 文件名, 大小), ...]，磁盘上已经有这些 digest 的 blob
+        批量版的 create_file_object：先用一条查询找出目录下已有的同名文件，按 conflict 处理，
+        新文件用一条 bulk_create 插入，计数按 digest 汇总之后用 Link.add_many 增加，用量一次加完
+        replace 时同一次上传里的同名文件只保留最后一个
+
+        查询之后别的请求刚好插入了同名文件时，bulk_create 违反唯一索引，退回到逐个 create_file_object
+    """
+    entries = [(digest, clean_file_name(name), size) for digest, name, size in items]
+    if conflict == 'replace':
+        latest = OrderedDict()
+        for entry in entries:
+            latest.pop(entry[1], None)
+            latest[entry[1]] = entry
+        entries = list(latest.values())
+
+    with transaction.atomic(savepoint=False):
+        existing = {}
+        for batch in iter_batches(list({name for _, name, _ in entries})):
+            found = File.objects.filter(parent=directory, name__in=batch)
+            if conflict == 'replace':
+                found = found.select_for_update()
+            existing.update((file.name, file) for file in found)
+        if conflict == 'reject':
+            names = Counter(name for _, name, _ in entries)
+            clashes = sorted(name for name, n in names.items() if n > 1 or name in existing)
+            if clashes:
+                raise NameConflict('目录下已经有同名的文件 {}'.format(', '.join(clashes)))
+
+        files, new, suffixed, replacements = [], [], [], []
+        taken = set(existing)
+        for digest, name, size in entries:
+            if conflict == 'replace' and name in existing:
+                replacements.append((existing[name], digest, size))
+                files.append(existing[name])
+                continue
+            file = File(
+                name = uuid.uuid4().hex if name in taken else name, # 重名的先用临时的名字
+                owner = owner,
+                parent = directory,
+                digest = digest,
+                path = directory.path,
+                path_hash = get_path_hash(directory.path), # bulk_create 不调用 save
+                size = size,
+            )
+            if name in taken:
+                suffixed.append((file, name))
+            taken.add(name)
+            files.append(file)
+            new.append(file)
+
+        try:
+            with transaction.atomic():
+                File.objects.bulk_create(new)
+        except IntegrityError:
+            return [create_file_object(digest, name, size, owner, directory, conflict)
+                    for digest, name, size in entries]
+
+        # bulk_create 在 MySQL 上不返回 pk，名字在目录下是唯一的，按名字查回来
+        by_name = {file.name: file for file in new}
+        for batch in iter_batches(list(by_name)):
+            for pk, name in File.objects.filter(parent=directory, name__in=batch).values_list('pk', 'name'):
+                by_name[name].pk = pk
+        apply_suffixes(suffixed)
+
+        if new:
+            Link.add_many(Counter(file.digest for file in new))
+            directory.add_usage(sum(file.size for file in new), len(new))
+        replace_files(replacements, directory)
+    return files
+
+
+def apply_suffixes(pairs):
+    """
+        pairs: [(用临时名字插入的 File, 原来的名字)]
+        改名为 name_<pk>，500 个一批用 CASE 更新；
+        用户恰好已经有叫 name_<pk> 的文件时，逐个处理，再加一段随机串
+    """
+    if not pairs:
+        return
+    renamed = {file.pk: suffix_name(name, file.pk) for file, name in pairs}
+    try:
+        with transaction.atomic():
+            for batch in iter_batches(list(renamed)):
+                File.objects.filter(pk__in=batch).update(
+                    name=Case(*[When(pk=pk, then=Value(renamed[pk])) for pk in batch]))
+    except IntegrityError:
+        for pk, name in renamed.items():
+            try:
+                with transaction.atomic():
+                    File.objects.filter(pk=pk).update(name=name)
+            except IntegrityError:
+                renamed[pk] = suffix_name(name, uuid.uuid4().hex[:8])
+                File.objects.filter(pk=pk).update(name=renamed[pk])
+    for file, _ in pairs:
+        file.name = renamed[file.pk]
+
+
+def replace_files(replacements, directory, linked=False):
+    """
+        replacements: [(directory 下已有的 File, 新的 digest, 新的大小)]
+        linked: 新内容的计数已经由调用方加过了（秒传）
+        conflict 为 replace 时使用：已有的文件原地换成新的内容，保留 pk、文件名和链接，
+        上传时间改为现在，相当于一个新版本（不保留旧版本）
+        新内容增加计数，旧内容减少计数，归零的交给后台清理
+    """
+    if not replacements:
+        return
+    now = timezone.now()
+    added, removed = Counter(), Counter()
+    delta = 0
+    for file, digest, size in replacements:
+        File.objects.filter(pk=file.pk).update(digest=digest, size=size, datetime=now, source_mtime=None)
+        added[digest] += 1
+        removed[file.digest] += 1
+        delta += size - file.size
+        file.digest, file.size, file.datetime, file.source_mtime = digest, size, now, None
+    if linked: # 新的计数已经加过，只减旧的；先加后减，内容没变时计数不会减到零
+        added = Counter()
+    else: # 内容没变的文件计数不变
+        added, removed = added - removed, removed - added
+    Link.add_many(added)
+    if Link.remove_many(removed):
+        transaction.on_commit(wake_blob_reaper)
+    if delta:
+        directory.add_usage(delta, 0)
+
+
+def check_quota(user, size):
+    """
+        用户再写入 size 字节是否超出配额
+        只读用户的计数，不统计文件；并发上传时可能稍微超出一点
+    """
+    return Usage.get_for(user).has_room(size)
+
+
+def find_stored_blob(digest, size):
+    """
+        digest 已经有计数器，并且服务器上储存的内容大小和客户端声明的一致时，
+        返回 True，否则返回 False
+    """
+    if not Link.objects.filter(digest=digest).exists():
+        return False
+    try:
+        return os.path.getsize(File(digest=digest).get_full_path()) == size
+    except OSError: # 没有完整的 blob，可能是分块储存的，也可能计数器还在，文件却没了
+        stored = FileChunk.objects.filter(digest=digest).aggregate(size=Sum('chunk__size'))
+        return stored['size'] == size
+
+
+def make_preflight_challenge(digest, size):
+    """
+        随机选一段区间让客户端计算 sha1，证明它确实拥有这个文件
+        区间信息签名后交给客户端，服务器不需要保存任何状态
+    """
+    length = min(size, settings.UPLOAD_PREFLIGHT_SAMPLE_SIZE)
+    offset = random.randint(0, size - length)
+    token = signing.dumps({'digest': digest, 'offset': offset, 'length': length},
+                          salt='myapp.preflight')
+    return {'offset': offset, 'length': length, 'token': token}
 
-            for chunk in file.chunks(chunk_size=1024):
+
+def check_preflight_sample(digest, token, sample):
+    """ 校验客户端提交的区间 sha1 是否和服务器上的 blob 一致 """
+    try:
+        challenge = signing.loads(token, salt='myapp.preflight',
+                                  max_age=settings.UPLOAD_PREFLIGHT_MAX_AGE)
+    except signing.BadSignature: # 包括过期
+        return False
+    if challenge['digest'] != digest:
+        return False
+
+    hasher = hashlib.sha1()
+    for chunk in iter_file_range(File(digest=digest).open, challenge['offset'],
+                                 challenge['length'], settings.UPLOAD_CHUNK_SIZE):
+        hasher.update(chunk)
+    return hasher.hexdigest() == sample.lower()
+
+
+# 断点续传会话的 sha1 状态，session pk -> (offset, hash 对象)
+# hashlib 的状态无法序列化到数据库，所以只缓存在本进程里，每个 worker 进程各有一份；
+# PATCH 落到了别的 worker，或者被挤出缓存时，从磁盘把已上传的部分重新 hash 一遍。
+# 多进程部署时让前端代理按会话 URL 把请求固定到同一个 worker，可以避免重新 hash
+_upload_hashers = OrderedDict()
+_upload_hashers_lock = threading.Lock()
+
+
+def _get_upload_hasher(session):
+    """ 取出和 session.offset 对应的 hash 对象，取出后从缓存删除，避免被并发请求共用 """
+    with _upload_hashers_lock:
+        offset, hasher = _upload_hashers.pop(session.pk, (None, None))
+
+    if hasher is None or offset != session.offset:
+        hasher = hashlib.sha1()
+        if session.offset:
+            for chunk in iter_file_range(partial(open, session.get_temp_path(), 'rb'), 0, session.offset,
+                                         settings.UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+    return hasher
+
+
+def _put_upload_hasher(session, hasher):
+    with _upload_hashers_lock:
+        _upload_hashers[session.pk] = (session.offset, hasher)
+        while len(_upload_hashers) > settings.UPLOAD_HASHER_CACHE_SIZE:
+            _upload_hashers.popitem(last=False)
+
+
+def append_upload_chunk(session, stream, offset, length):
+    """
+        session: UploadSession
+        stream: 请求体，可以 read
+        offset: 请求头里的 Upload-Offset
+        length: 请求体的长度
+
+        把请求体写到临时文件的 offset 处，同时更新 sha1，返回新的 offset；
+        offset 和已上传的字节数对不上，或者同一个会话正有别的 PATCH 在写时返回 None
+        客户端中途断线时，已经收到的部分仍然记入 offset，下次从这里继续
+
+        传输可能要很久，不能一直锁着数据库里的会话，所以锁的是临时文件（flock）：
+        同时只有一个请求能写，进程退出时锁自动释放；拿到锁之后重新读一次 offset，
+        只有拿着锁的请求会推进它
+    """
+    path = session.get_temp_path()
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as destination:
+        try:
+            fcntl.flock(destination.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        session.offset = UploadSession.objects.filter(pk=session.pk).values_list('offset', flat=True).first()
+        if session.offset != offset: # 会话已经被删掉，或者别的请求刚写完
+            return None
+
+        hasher = _get_upload_hasher(session)
+        received = 0
+        destination.seek(offset)
+        destination.truncate() # 丢掉上次失败时写了一半、没有记入 offset 的数据
+        try:
+            while received < length:
+                chunk = stream.read(min(settings.UPLOAD_CHUNK_SIZE, length - received))
+                if not chunk:
+                    break
                 destination.write(chunk)
-                destination.flush()
-                digest.update(chunk)
-
-        digest = digest.hexdigest() # hash 对象转字符串
-        abspath = os.path.join(media_dir, digest) # 服务器路径，用于储存
-
-        file = File.objects.create( # 返回 file 对象
-            name = re.sub(r'[%/]', '_', file.name), # 给用户看的名字，去掉正斜杠和百分号，just in case
-                                               # 亲测 mac 下，名字带正斜杠的文件无法被上传
-            owner = owner,
-            parent = directory, 
-            digest = digest,    # 服务器上真正的名字
-            path = directory.path, # 用户路径，用户给用户展示，不包含文件名
-            size = file._size,
+                hasher.update(chunk)
+                received += len(chunk)
+        except UnreadablePostError: # 客户端断线
+            pass
+        destination.flush()
+
+        session.offset = offset + received
+        UploadSession.objects.filter(pk=session.pk, offset=offset).update(offset=session.offset)
+        _put_upload_hasher(session, hasher)
+    return session.offset
+
+
+def finalize_upload_session(session):
+    """
+        所有分块都上传完之后调用，返回 File 对象
+        sha1 在上传过程中已经算好，不需要重新读一遍文件
+    """
+    hasher = _get_upload_hasher(session)
+    path = session.get_temp_path()
+    with open(path, 'ab'): # 空文件不会有任何 PATCH，这里顺便创建；fsync 由 place_blob 负责
+        pass
+
+    file = save_uploaded_file(path, hasher.hexdigest(), session.name, session.size,
+                              session.owner, session.parent, conflict=session.conflict)
+    session.delete()
+    return file
+
+
+def discard_upload_session(session):
+    """ 放弃上传，删除临时文件和会话 """
+    with _upload_hashers_lock:
+        _upload_hashers.pop(session.pk, None)
+    if os.path.exists(session.get_temp_path()):
+        os.remove(session.get_temp_path())
+    session.delete()
+
+
+###################
+####  目录列表  ####
+###################
+
+def find_by_path(owner, path):
+    """
+        按用户看到的路径找文件或者目录，同名时文件优先，都没有时返回 None
+        每个模型最多查询一次，path_hash 用来走索引，path 用来排除 hash 碰撞
+    """
+    dirname, basename = os.path.dirname(path), os.path.basename(path)
+    file = File.objects.filter(owner=owner, path_hash=get_path_hash(dirname), path=dirname,
+                               name=basename).first()
+    if file:
+        return file
+    return Directory.objects.filter(owner=owner, path_hash=get_path_hash(path), path=path).first()
+
+
+# 排序方式 -> (子目录按哪个字段排序, 文件按哪个字段排序)，目录没有时间字段，pk 就是创建顺序
+LISTING_SORTS = {
+    'name': ('name', 'name'),
+    'size': ('size', 'size'),
+    'date': ('pk', 'datetime'),
+}
+
+
+def list_directory(directory, username, sort='name', reverse=False, cursor=None, limit=None):
+    """
+        directory: 要列出的目录
+        username: 目录所有者的用户名，用来拼出 URL，不需要每一行都去查 owner
+        sort: LISTING_SORTS 里的排序方式；reverse: 是否倒序
+        cursor: 上一页返回的 next_cursor，None 表示第一页
+        limit: 每页多少项，默认 LISTING_PAGE_SIZE
+
+        返回 (entries, next_cursor)，最后一页的 next_cursor 为 None
+        先列子目录，再列文件，每项是一个 dict，URL 都已经拼好
+
+        用 keyset 分页：记住上一页最后一项的排序字段和 pk，下一页从它后面开始，
+        不用 OFFSET，所以翻到多深都一样快；每页最多两条查询
+    """
+    limit = min(limit or settings.LISTING_PAGE_SIZE, settings.LISTING_MAX_PAGE_SIZE)
+    dir_field, file_field = LISTING_SORTS[sort]
+    state = load_listing_cursor(cursor)
+    prefix = '/{}/'.format(username)
+    entries = []
+
+    if state is None or state['kind'] == 'dir':
+        dirs = _keyset_page(Directory.objects.filter(parent=directory), dir_field, state, reverse)
+        for pk, name, path, size, count in dirs.values_list(
+                'pk', 'name', 'path', 'size', 'file_count')[:limit + 1]:
+            entries.append({'kind': 'dir', 'pk': pk, 'name': name, 'size': size,
+                            'file_count': count, 'url': prefix + path})
+        state = None # 子目录列完了，文件从头开始
+
+    if len(entries) <= limit:
+        files = _keyset_page(File.objects.filter(parent=directory), file_field, state, reverse)
+        for pk, name, path, size, digest, created in files.values_list(
+                'pk', 'name', 'path', 'size', 'digest', 'datetime')[:limit + 1 - len(entries)]:
+            entries.append({'kind': 'file', 'pk': pk, 'name': name, 'size': size, 'digest': digest,
+                            'datetime': created, 'url': prefix + (path + '/' if path else '') + name})
+
+    if len(entries) <= limit:
+        return entries, None
+    entries = entries[:limit]
+    last = entries[-1]
+    field = dir_field if last['kind'] == 'dir' else file_field
+    return entries, dump_listing_cursor(last['kind'], last[field], last['pk'])
+
+
+def get_listing_args(request):
+    """
+        目录列表的 Query String:
+        sort=name|size|date  排序方式，默认 name
+        order=asc|desc       默认 asc
+        after=...            上一页返回的位置，不传表示第一页
+        limit=...            每页多少项
+    """
+    sort = request.GET.get('sort')
+    if sort not in LISTING_SORTS:
+        sort = 'name'
+    try:
+        limit = max(int(request.GET.get('limit', 0)), 0)
+    except ValueError:
+        limit = 0
+    return sort, request.GET.get('order') == 'desc', request.GET.get('after'), limit
+
+
+def _keyset_page(queryset, field, state, reverse):
+    """ 按 (field, pk) 排序，state 不为空时只取排在它后面的 """
+    sign, op = ('-', 'lt') if reverse else ('', 'gt')
+    order = [sign + 'pk'] if field == 'pk' else [sign + field, sign + 'pk']
+    queryset = queryset.order_by(*order)
+    if state is None:
+        return queryset
+    if field == 'pk':
+        return queryset.filter(**{'pk__' + op: state['pk']})
+    return queryset.filter(Q(**{field + '__' + op: state['value']}) |
+                           Q(**{field: state['value'], 'pk__' + op: state['pk']}))
+
+
+def dump_listing_cursor(kind, value, pk):
+    """ 签名的分页位置，客户端只能原样交回来 """
+    if isinstance(value, datetime.datetime): # JSON 没有时间类型，标记出来，和文件名区分开
+        value = {'datetime': value.isoformat()}
+    return signing.dumps({'kind': kind, 'value': value, 'pk': pk}, salt='myapp.listing')
+
+
+def load_listing_cursor(cursor):
+    """ 解开 dump_listing_cursor 的结果，无效时返回 None，也就是从第一页开始 """
+    if not cursor:
+        return None
+    try:
+        state = signing.loads(cursor, salt='myapp.listing')
+    except signing.BadSignature:
+        return None
+    if isinstance(state['value'], dict):
+        state['value'] = parse_datetime(state['value']['datetime'])
+    return state
+
+
+###################
+####  文件类型  ####
+###################
+
+_file_types = OrderedDict() # digest -> (mime, description)，最近用过的放在最后
+_file_types_lock = threading.Lock()
+
+
+def detect_file_type(head):
+    """ head: 文件开头的一段。返回 libmagic 判断的 (mime, description) """
+    return magic.from_buffer(head, mime=True), magic.from_buffer(head)
+
+
+def remember_file_type(digest, head):
+    """ 判断 digest 的文件类型并写入 FileType，已经有记录时什么都不做。返回 (mime, description) """
+    mime, description = detect_file_type(head)
+    file_type, created = FileType.objects.get_or_create(
+        digest=digest, defaults={'mime': mime, 'description': description[:1024]})
+    return file_type.mime, file_type.description
+
+
+def remember_file_types(heads):
+    """
+        heads: {digest: 文件开头一段}
+        批量版的 remember_file_type，已经有记录的 digest 不再判断，返回 {digest: (mime, description)}
+    """
+    types = {}
+    for batch in iter_batches(list(heads)):
+        for digest, mime, description in FileType.objects.filter(digest__in=batch) \
+                                                         .values_list('digest', 'mime', 'description'):
+            types[digest] = (mime, description)
+    missing = [FileType(digest=digest, mime=mime, description=description[:1024])
+               for digest, (mime, description) in
+               ((digest, detect_file_type(head)) for digest, head in heads.items() if digest not in types)]
+    if not missing:
+        return types
+    try:
+        with transaction.atomic():
+            FileType.objects.bulk_create(missing)
+    except IntegrityError: # 别的请求同时上传了同样的内容，逐个处理
+        for file_type in missing:
+            FileType.objects.get_or_create(digest=file_type.digest, defaults={
+                'mime': file_type.mime, 'description': file_type.description})
+    for file_type in missing:
+        types[file_type.digest] = (file_type.mime, file_type.description)
+    return types
+
+
+def get_file_type(file):
+    """
+        返回 (mime, description)，如 ('image/png', 'PNG image data, 10 x 10, ...')
+        依次查本进程的 LRU 和 FileType 表，都没有时才读文件开头判断，并记下来
+        同一个 digest 的内容不会变，结果永远有效
+    """
+    with _file_types_lock:
+        result = _file_types.get(file.digest)
+        if result is not None:
+            _file_types.move_to_end(file.digest)
+            return result
+
+    result = FileType.objects.filter(digest=file.digest).values_list('mime', 'description').first()
+    if result is None: # 缓存 FileType 之前上传的文件
+        with file.open() as f: # 分块储存的文件没有完整的 blob，只能读开头一段来判断
+            result = remember_file_type(file.digest, f.read(settings.PREVIEW_SNIFF_SIZE))
+
+    with _file_types_lock:
+        _file_types[file.digest] = tuple(result)
+        while len(_file_types) > settings.FILE_TYPE_CACHE_SIZE:
+            _file_types.popitem(last=False)
+    return tuple(result)
+
+
+def set_content_headers(response, file, preview=False):
+    """
+        下载和预览共用的 Content-Type / Content-Disposition 逻辑
+        预览时按文件名猜类型，猜不出来再用 libmagic 的结果，让浏览器直接显示；
+        下载时强制浏览器另存为，文件名需要 quote 以支持中文
+    """
+    if preview:
+        filetype = mimetypes.guess_type(file.name)[0] or get_file_type(file)[0]
+        if not filetype:
+            filetype = 'application/octet-stream'
+        response['Content-Type'] = filetype
+    else:
+        response['Content-Type'] = 'application/force-download'
+        response['Content-Disposition'] = 'attachment; filename={}'.format(quote(file.name))
+
+
+def get_download_response(request, file, preview=False):
+    """
+        request: 下载请求，用于读取 Range / If-Range / If-None-Match 等头部
+        file: File object，调用方必须已经按 owner=request.user 查出来，这里不再检查权限
+        preview: 是否为预览
+
+        返回流式的下载响应，不会把整个文件读进内存：
+            完整文件用 FileResponse，WSGI 服务器提供 wsgi.file_wrapper 时会走 sendfile
+            单个区间返回 206 和对应的字节
+            多个区间返回 206 multipart/byteranges
+        blob 按 sha1 命名，内容不会变，所以 digest 可以直接作为强 ETag
+
+        配置了 SENDFILE_BACKEND 时，Django 只负责权限和条件请求，
+        真正的传输（包括 Range）交给前端代理
+    """
+    size = file.size
+    etag = '"{}"'.format(file.digest)
+    last_modified = int(file.datetime.timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None: # 304 或者 412
+        return response
+
+    if settings.SENDFILE_BACKEND and not file.is_chunked():
+        response = get_sendfile_response(file, preview)
+        set_cache_headers(response, etag, last_modified)
+        return response
+
+    ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+    if ranges is not None and not _if_range_passes(request, etag, last_modified):
+        ranges = None # 客户端缓存的版本已经过期，返回整个文件
+    if ranges and len(ranges) > settings.DOWNLOAD_MAX_RANGES:
+        ranges = None # 区间太多，不值得拆开，直接返回整个文件
+
+    chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+
+    if ranges is None:
+        response = FileResponse(file.open())
+        response.block_size = chunk_size
+        response['Content-Length'] = str(size)
+        set_content_headers(response, file, preview)
+
+    elif not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            iter_file_range(file.open, start, end - start + 1, chunk_size), status=206)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        set_content_headers(response, file, preview)
+
+    else:
+        response = _get_multipart_range_response(file, ranges, preview, chunk_size)
+
+    response['Accept-Ranges'] = 'bytes'
+    set_cache_headers(response, etag, last_modified)
+    return response
+
+
+def get_thumbnail_response(request, file, size):
+    """
+        返回 file 的缩略图，没有缓存时先生成
+        缩略图和原文件一样不会变，可以一直缓存
+    """
+    etag = '"{}-{}"'.format(file.digest, size)
+    last_modified = int(file.datetime.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    try:
+        path = get_thumbnail(file, size)
+    except ThumbnailBusy:
+        response = HttpResponse('缩略图正在生成，请稍后再试', status=503)
+        response['Retry-After'] = '5'
+        return response
+    if path is None:
+        raise Http404
+
+    response = FileResponse(open(path, 'rb'), content_type='image/{}'.format(get_thumbnail_format()[0].lower()))
+    set_cache_headers(response, etag, last_modified)
+    return response
+
+
+def set_cache_headers(response, etag, last_modified):
+    """
+        同一个 digest 的内容永远不变，浏览器可以一直缓存，
+        但文件需要登录才能访问，所以只允许私有缓存
+    """
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if response.status_code in (200, 206):
+        patch_cache_control(response, private=True, immutable=True,
+                            max_age=settings.DOWNLOAD_CACHE_MAX_AGE)
+
+
+def get_sendfile_response(file, preview=False):
+    """
+        返回一个空的响应，由前端代理根据头部直接发送磁盘上的 blob
+        代理的 internal location 不检查权限，file 必须是按 owner 查出来的
+            'nginx': X-Accel-Redirect，指向映射到 MEDIA_ROOT 的 internal location
+            'xsendfile': X-Sendfile，Apache mod_xsendfile 和 lighttpd 使用绝对路径
+        Content-Length 和 Range 都由代理处理
+    """
+    backend = settings.SENDFILE_BACKEND
+    response = HttpResponse()
+    set_content_headers(response, file, preview)
+
+    if backend == 'nginx':
+        relpath = os.path.relpath(file.get_full_path(), get_media_abspath())
+        url = settings.SENDFILE_URL.rstrip('/') + '/' + relpath.replace(os.sep, '/')
+        response['X-Accel-Redirect'] = quote(url)
+    elif backend == 'xsendfile':
+        response['X-Sendfile'] = file.get_full_path()
+    else:
+        raise ImproperlyConfigured('未知的 SENDFILE_BACKEND: {!r}'.format(backend))
+    return response
+
+
+def _if_range_passes(request, etag, last_modified):
+    """
+        If-Range 可以是 ETag，也可以是日期，必须和当前文件完全一致，Range 才有效
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag # 弱 ETag 永远不匹配
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _get_multipart_range_response(file, ranges, preview, chunk_size):
+    """
+        多个区间时按 multipart/byteranges 返回，
+        每一段都带着自己的 Content-Type 和 Content-Range
+    """
+    headers = HttpResponse()
+    set_content_headers(headers, file, preview)
+    content_type = headers['Content-Type']
+    boundary = uuid.uuid4().hex
+
+    parts = []
+    length = 0
+    for start, end in ranges:
+        part_header = (
+            '--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'
+            .format(boundary, content_type, start, end, file.size).encode()
         )
+        parts.append((part_header, start, end - start + 1))
+        length += len(part_header) + end - start + 1 + 2
+    closing = '--{}--\r\n'.format(boundary).encode()
+    length += len(closing)
+
+    def stream():
+        for part_header, start, part_length in parts:
+            yield part_header
+            yield from iter_file_range(file.open, start, part_length, chunk_size)
+            yield b'\r\n'
+        yield closing
+
+    response = StreamingHttpResponse(stream(), status=206)
+    response['Content-Type'] = 'multipart/byteranges; boundary={}'.format(boundary)
+    response['Content-Length'] = str(length)
+    if headers.has_header('Content-Disposition'):
+        response['Content-Disposition'] = headers['Content-Disposition']
+    return response
+
+
+def set_captcha(request, response, captcha_text):
+    """
+        记下这次发出的验证码
+        CAPTCHA_STATELESS 为 True 时放进签名的 cookie，不创建也不写 session；
+        否则放进 session
+    """
+    if settings.CAPTCHA_STATELESS:
+        response.set_cookie(settings.CAPTCHA_COOKIE_NAME, make_captcha_token(captcha_text),
+                            max_age=settings.CAPTCHA_MAX_AGE, httponly=True)
+    else:
+        set_captcha_to_session(request, captcha_text)
+
+
+def check_captcha(request, captcha_text):
+    """ 用户输入的验证码是否和发给他的一致 """
+    if settings.CAPTCHA_STATELESS:
+        return check_captcha_token(request.COOKIES.get(settings.CAPTCHA_COOKIE_NAME, ''), captcha_text)
+    key = request.session.session_key
+    try:
+        real_captcha = request.session[key].get('captcha')
+    except KeyError:
+        real_captcha = ''
+    return bool(real_captcha) and real_captcha == captcha_text.lower()
+
+
+def make_captcha_token(captcha_text):
+    """
+        签名的验证码 token，服务器不需要保存任何状态
+        token 里只有答案的 HMAC，没有答案本身；nonce 用来保证每个 token 只能用一次
+    """
+    nonce = uuid.uuid4().hex
+    answer = salted_hmac('myapp.captcha', nonce + ''.join(captcha_text).lower()).hexdigest()
+    return signing.dumps({'nonce': nonce, 'answer': answer}, salt='myapp.captcha')
+
+
+def check_captcha_token(token, captcha_text):
+    """
+        校验 token 和用户输入的验证码
+        不管答对还是答错，token 都只能用一次，否则可以拿同一个 token 反复猜
+        用过的 nonce 记在 cache 里，过期的 token 本身就无效，所以只需要记 CAPTCHA_MAX_AGE 秒
+    """
+    try:
+        data = signing.loads(token, salt='myapp.captcha', max_age=settings.CAPTCHA_MAX_AGE)
+    except signing.BadSignature: # 包括过期
+        return False
+    if not cache.add('captcha-nonce:' + data['nonce'], True, settings.CAPTCHA_MAX_AGE):
+        return False # 已经用过了
+    answer = salted_hmac('myapp.captcha', data['nonce'] + captcha_text.lower()).hexdigest()
+    return constant_time_compare(answer, data['answer'])
 
-        os.rename(temp_filename, abspath)
-        handle_repetitive_file(file)
 
 def set_captcha_to_session(request, captcha_text):
     """
@@ -0,0 +1,401 @@
+"""
+    把服务器本地的目录树导入到用户的目录下，由 import_tree 命令调用
+    需要依赖 django 环境才能运行
+
+    增量同步：File.source_mtime 记录导入时源文件的修改时间，
+    大小和修改时间都没变的文件不再读取；变了的重新算 sha1，内容相同时只更新修改时间
+
+    sha1 在进程池里计算。内容服务器上没有的文件，先在 media 目录下做一份临时文件
+    （reflink / 硬链接 / 复制），同时重新计算临时文件的 sha1，和第一次的结果一致才使用，
+    避免导入期间源文件被修改；之后和普通上传一样由 place_blob 放到 digest 对应的位置
+
+    数据库按批写入：每批的 File 用一条 bulk_create，Link 用 Link.add_many 按增加的数量分组 UPDATE，
+    用量按目录汇总之后加减，整批在一个事务里
+
+    目标目录下已有的同名文件：以前导入的（source_mtime 不为空）原地更新；
+    网页上传的按 conflict 处理，和网页上传时一样（见 handles.NAME_CONFLICTS）
+"""
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Case, When, Value
+
+from .models import Directory, File, Link, Usage, get_media_abspath, get_path_hash, iter_batches
+from .handles import (place_blob, clean_file_name, apply_suffixes, discard_blobs, _settle_blob,
+                      NAME_CONFLICTS)
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, defaultdict, namedtuple
+from functools import partial
+import hashlib
+import fcntl
+import errno
+import uuid
+import os
+
+FICLONE = 0x40049409 # linux/fs.h，btrfs、xfs 等支持写时复制的文件系统可以用
+
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+
+# 一个需要读取的源文件；file 为要原地更新的已有文件，没有时为 None
+# suffixed: 和网页上传的文件重名，conflict 为 suffix，新文件插入之后改名为 name_<pk>
+Item = namedtuple('Item', ['source', 'directory', 'name', 'size', 'mtime', 'file', 'suffixed'])
+
+
+def hash_file(path, chunk_size):
+    """ 在进程池里运行，返回 sha1，文件读不了时返回 None """
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, chunk_size), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def materialize(source, temp, mode, chunk_size, fsync):
+    """
+        在进程池里运行，把源文件做成 media 目录下的临时文件 temp，返回 temp 的 sha1
+        auto 时先尝试 reflink，不支持时复制；hardlink 跨文件系统时也退回到复制
+        失败时返回 None，不留下临时文件
+    """
+    try:
+        if mode in ('auto', 'reflink'):
+            try:
+                with open(source, 'rb') as src, open(temp, 'wb') as dest:
+                    fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                return hash_file(temp, chunk_size)
+            except OSError as e:
+                if mode == 'reflink' or e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                                                        errno.EINVAL, errno.ENOSYS):
+                    raise
+        elif mode == 'hardlink':
+            try:
+                os.link(source, temp)
+                return hash_file(temp, chunk_size)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        digest = hashlib.sha1() # 复制的同时计算 sha1，只读一次
+        with open(source, 'rb') as src, open(temp, 'wb') as dest:
+            for chunk in iter(partial(src.read, chunk_size), b''):
+                digest.update(chunk)
+                dest.write(chunk)
+            if fsync:
+                dest.flush()
+                os.fsync(dest.fileno())
+        return digest.hexdigest()
+    except OSError:
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+        return None
+
+
+class Importer(object):
+    """
+        owner: 导入到哪个用户
+        target: 导入到的目录
+        workers: 计算 sha1 的进程数
+        batch: 每批处理多少个需要读取的文件，每批写一次数据库
+        mode: 临时文件的做法，见 LINK_MODES；hardlink 和源文件共用数据，源文件以后被原地修改时
+              服务器上的内容也会变，只适合不会再修改的源文件
+        check_quota: 是否检查用户的配额，超出时抛出 ValueError，已经导入的批次保留
+        conflict: 和网页上传的文件重名时怎么办，见 handles.NAME_CONFLICTS，默认 UPLOAD_NAME_CONFLICT；
+                  reject 时跳过这个文件
+        log: 输出函数
+
+        所有结果计入 self.stats
+    """
+
+    def __init__(self, owner, target, workers=None, batch=500, mode='auto', check_quota=True,
+                 conflict=None, log=print):
+        self.conflict = conflict or settings.UPLOAD_NAME_CONFLICT
+        if self.conflict not in NAME_CONFLICTS:
+            raise ValueError('conflict 只能是 {}'.format(', '.join(NAME_CONFLICTS)))
+        self.owner = owner
+        self.target = target
+        self.workers = workers or os.cpu_count()
+        self.batch = batch
+        self.mode = mode
+        self.check_quota = check_quota
+        self.log = log
+        self.chunk_size = settings.UPLOAD_CHUNK_SIZE
+        self.stats = Counter()
+
+    def run(self, root):
+        """ 导入 root 下的所有文件和目录，root 自身的内容放到 target 下 """
+        pending = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            self.executor = executor
+            for item in self.walk(root, self.target):
+                pending.append(item)
+                if len(pending) >= self.batch:
+                    self.import_batch(pending)
+                    pending = []
+            if pending:
+                self.import_batch(pending)
+        return self.stats
+
+    ###################
+    ####  遍历目录  ####
+    ###################
+
+    def walk(self, root, directory):
+        """
+            逐个目录遍历，没变的文件直接跳过，需要读取的文件返回 Item
+            每个目录查询一次已有的子目录和文件，缺少的子目录马上创建
+        """
+        try:
+            with os.scandir(root) as it:
+                # 不需要替换字符的名字排在前面，替换之后重名时保留原本就叫这个名字的文件
+                entries = sorted(it, key=lambda entry: ('%' in entry.name, entry.name))
+        except OSError as e:
+            self.log('无法读取 {}: {}'.format(root, e))
+            self.stats['errors'] += 1
+            return
+
+        subdirs = {d.name: d for d in Directory.objects.filter(parent=directory)}
+        existing = File.objects.filter(parent=directory).only('name', 'size', 'digest', 'source_mtime')
+        files = {file.name: file for file in existing}
+        # 以前按 suffix 导入、改名为 name_<pk> 的文件，按原来的名字找回来，重复运行时不会再导入一份
+        suffixed = {}
+        for file in files.values():
+            base, ext = os.path.splitext(file.name)
+            if file.source_mtime is not None and base.endswith('_{}'.format(file.pk)):
+                suffixed[base[:-len('_{}'.format(file.pk))] + ext] = file
+
+        children = []
+        seen = set()
+        for entry in entries:
+            name = clean_file_name(entry.name) # 和网页上传一样
+            if entry.is_symlink():
+                self.stats['symlinks_skipped'] += 1
+            elif entry.is_dir():
+                children.append((entry.path, name))
+            elif entry.is_file():
+                if name in seen: # 替换字符之后和前面的文件重名（如 a%b 和 a_b），目录下不能有同名文件
+                    self.log('跳过重名的文件 {}'.format(entry.path))
+                    self.stats['name_conflicts'] += 1
+                    continue
+                seen.add(name)
+                stat = entry.stat()
+                file = files.get(name)
+                rename = False
+                if file and file.source_mtime is None: # 网页上传的同名文件
+                    if self.conflict == 'reject':
+                        self.log('目录下已经有同名的文件，跳过 {}'.format(entry.path))
+                        self.stats['name_conflicts'] += 1
+                        continue
+                    if self.conflict == 'suffix':
+                        file = suffixed.get(name)
+                        rename = file is None
+                if file and file.size == stat.st_size and file.source_mtime == stat.st_mtime_ns:
+                    self.stats['unchanged'] += 1
+                    continue
+                yield Item(entry.path, directory, name, stat.st_size, stat.st_mtime_ns, file, rename)
+
+        for path, name in children:
+            subdir = subdirs.get(name)
+            if subdir is None:
+                # 替换字符之后重名的目录（如 a%b 和 a_b）合并到同一个目录下
+                subdir = subdirs[name] = directory.create_subdir(name)
+                self.stats['dirs_created'] += 1
+                self.log('新建目录 {}'.format(subdir.path))
+            yield from self.walk(path, subdir)
+
+    ###################
+    ####  按批导入  ####
+    ###################
+
+    def import_batch(self, items):
+        """ 计算 sha1，准备好服务器上没有的内容，再把整批写入数据库 """
+        chunk_size = self.chunk_size
+        digests = list(self.executor.map(partial(hash_file, chunk_size=chunk_size),
+                                         [item.source for item in items], chunksize=8))
+        ready = []
+        for item, digest in zip(items, digests):
+            if digest is None:
+                self.log('无法读取 {}'.format(item.source))
+                self.stats['errors'] += 1
+            else:
+                self.stats['bytes_hashed'] += item.size
+                ready.append((item, digest))
+
+        touched = [(item, digest) for item, digest in ready if item.file and item.file.digest == digest]
+        ready = [(item, digest) for item, digest in ready if not (item.file and item.file.digest == digest)]
+
+        new_size = sum(item.size - (item.file.size if item.file else 0) for item, _ in ready)
+        if self.check_quota and new_size > 0 and not Usage.get_for(self.owner).has_room(new_size):
+            raise ValueError('超出了用户 {} 的配额'.format(self.owner.username))
+
+        available, temps = self.prepare_blobs(ready)
+        ready = [(item, digest) for item, digest in ready if digest in available]
+        with transaction.atomic():
+            ready = self.lock_reused_blobs(ready, temps)
+            linked = self.write_batch(ready, touched)
+            for digest, (temp, size) in temps.items():
+                transaction.on_commit(partial(_settle_blob, temp, digest, size))
+            discard_blobs([digest for digest in temps if digest not in linked]) # 重名被跳过的
+
+    def prepare_blobs(self, ready):
+        """
+            服务器上还没有的内容，做成临时文件并放到 digest 对应的位置
+            返回 (可以使用的 digest 集合, {digest: (临时文件, 大小)})，临时文件等事务提交之后再删除
+        """
+        available = set()
+        for batch in iter_batches(list({digest for _, digest in ready})):
+            available.update(Link.objects.filter(digest__in=batch).values_list('digest', flat=True))
+
+        needed = {}
+        for item, digest in ready:
+            if digest not in available and digest not in needed:
+                needed[digest] = item
+        media_dir = get_media_abspath()
+        jobs = [(item.source, os.path.join(media_dir, str(uuid.uuid1())), digest, item.size)
+                for digest, item in needed.items()]
+        results = self.executor.map(
+            partial(materialize, mode=self.mode, chunk_size=self.chunk_size, fsync=settings.UPLOAD_FSYNC),
+            [source for source, _, _, _ in jobs], [temp for _, temp, _, _ in jobs], chunksize=4)
+
+        temps = {}
+        for (source, temp, digest, size), result in zip(jobs, results):
+            if result != digest: # 读取失败，或者导入期间源文件被修改了，下次同步再导入
+                self.log('读取失败或者导入期间被修改了 {}'.format(source))
+                self.stats['changed_during_import'] += 1
+                if result is not None:
+                    os.remove(temp)
+                continue
+            place_blob(temp, digest, size)
+            self.stats['bytes_copied'] += size
+            available.add(digest)
+            temps[digest] = (temp, size)
+        return available, temps
+
+    def lock_reused_blobs(self, ready, temps):
+        """
+            在写入的事务里调用。服务器上本来就有的内容没有临时文件，计数器被删掉时没办法把 blob 放回去，
+            所以先锁住这些计数器，锁到提交为止，之后的 Link.add_many 只会给它们加一；
+            prepare_blobs 之后计数器已经被删掉的（blob 可能已经被清理），这一批先跳过，下次同步再导入
+        """
+        reused = list({digest for _, digest in ready if digest not in temps})
+        present = set()
+        for batch in iter_batches(reused):
+            present.update(Link.objects.select_for_update().filter(digest__in=batch)
+                           .values_list('digest', flat=True))
+        kept = []
+        for item, digest in ready:
+            if digest in temps or digest in present:
+                kept.append((item, digest))
+            else:
+                self.log('导入期间内容被删除了 {}'.format(item.source))
+                self.stats['changed_during_import'] += 1
+        return kept
+
+    def write_batch(self, ready, touched):
+        """
+            ready: [(Item, digest)]，新文件和内容变了的文件
+            touched: [(Item, digest)]，修改时间变了、内容没变的文件，只更新 source_mtime
+            返回增加了计数的 digest
+        """
+        if touched:
+            File.objects.filter(pk__in=[item.file.pk for item, _ in touched]).update(
+                source_mtime=Case(*[When(pk=item.file.pk, then=Value(item.mtime)) for item, _ in touched]))
+            self.stats['touched'] += len(touched)
+
+        updated, new = [], []
+        for item, digest in ready:
+            if item.file and File.objects.filter(pk=item.file.pk).update( # 内容变了，原地更新，保留 pk
+                    digest=digest, size=item.size, source_mtime=item.mtime):
+                updated.append((item, digest))
+            else: # 新文件，或者要更新的文件刚被删掉了
+                new.append((item._replace(file=None), digest))
+        created, replaced = self.insert_files(new)
+        updated += replaced
+
+        added = Counter() # digest -> 增加的引用数
+        removed = Counter()
+        usage = defaultdict(lambda: [0, 0]) # 目录 pk -> [大小, 文件数]
+        directories = {}
+        for item, digest in updated + created:
+            directories[item.directory.pk] = item.directory
+            added[digest] += 1
+            usage[item.directory.pk][0] += item.size
+            if item.file:
+                removed[item.file.digest] += 1
+                usage[item.directory.pk][0] -= item.file.size
+            else:
+                usage[item.directory.pk][1] += 1
+        self.stats['updated'] += len(updated)
+        self.stats['created'] += len(created)
+
+        Link.add_many(added)
+        Link.remove_many(removed)
+        for pk, (size, count) in usage.items():
+            if size or count:
+                directories[pk].add_usage(size, count)
+        return added
+
+    def insert_files(self, new):
+        """
+            new: [(Item, digest)]，要新建的文件
+            一条 bulk_create 插入，suffixed 的先用临时的名字，插入之后改名为 name_<pk>
+            遍历之后别的请求刚好在同一个目录下上传了同名的文件时违反唯一索引，退回到逐个插入，
+            撞上的按 conflict 处理
+            返回 (新建的 [(Item, digest)], 改为替换已有文件的 [(Item, digest)]，item.file 为被替换的文件)
+        """
+        files = [self.new_file(item, digest) for item, digest in new]
+        try:
+            with transaction.atomic():
+                File.objects.bulk_create(files, batch_size=500)
+        except IntegrityError:
+            return self.insert_one_by_one(new)
+
+        # bulk_create 在 MySQL 上不返回 pk，临时的名字是唯一的，按名字查回来
+        by_name = {file.name: (file, item.name) for file, (item, _) in zip(files, new) if item.suffixed}
+        for batch in iter_batches(list(by_name)):
+            for pk, name in File.objects.filter(owner=self.owner, name__in=batch).values_list('pk', 'name'):
+                by_name[name][0].pk = pk
+        apply_suffixes(list(by_name.values()))
+        return new, []
+
+    def insert_one_by_one(self, new):
+        created, replaced = [], []
+        for item, digest in new:
+            file = self.new_file(item, digest)
+            try:
+                with transaction.atomic():
+                    file.save()
+            except IntegrityError:
+                if self.conflict == 'replace':
+                    other = File.objects.select_for_update().filter(parent=item.directory, name=item.name).first()
+                    if other and File.objects.filter(pk=other.pk).update(
+                            digest=digest, size=item.size, source_mtime=item.mtime):
+                        replaced.append((item._replace(file=other), digest))
+                        continue
+                if self.conflict != 'suffix' or item.suffixed: # 临时的名字不会重名，只能是同名的文件又被删掉了
+                    self.log('目录下已经有同名的文件，跳过 {}'.format(item.source))
+                    self.stats['name_conflicts'] += 1
+                    continue
+                item = item._replace(suffixed=True)
+                file = self.new_file(item, digest)
+                file.save()
+            if item.suffixed:
+                apply_suffixes([(file, item.name)])
+            created.append((item, digest))
+        return created, replaced
+
+    def new_file(self, item, digest):
+        return File(
+            name = uuid.uuid4().hex if item.suffixed else item.name, # 重名的先用临时的名字
+            owner = self.owner,
+            parent = item.directory,
+            digest = digest,
+            path = item.directory.path,
+            path_hash = get_path_hash(item.directory.path), # bulk_create 不调用 save
+            size = item.size,
+            source_mtime = item.mtime,
+        )
@@ -0,0 +1,31 @@
+"""
+    给用户创建 JSON API 的令牌，令牌只显示这一次
+    python manage.py apitoken alice --name laptop
+    python manage.py apitoken alice --revoke      # 删除这个用户所有的令牌
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.models import ApiToken
+
+
+class Command(BaseCommand):
+    help = '创建或者删除 JSON API 的令牌'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--name', default='', help='令牌的备注，方便区分')
+        parser.add_argument('--revoke', action='store_true', help='删除这个用户所有的令牌')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('用户 {} 不存在'.format(options['username']))
+
+        if options['revoke']:
+            deleted, _ = ApiToken.objects.filter(user=user).delete()
+            self.stdout.write('删除了 {} 个令牌'.format(deleted))
+            return
+        self.stdout.write(ApiToken.create_for(user, options['name']))
@@ -0,0 +1,63 @@
+"""
+    测试单个进程（单核）每秒能产生多少个验证码：
+        legacy: 原来的做法，每次都重新读取字体文件
+        render: 字体只读一次，每次请求时渲染
+        pool: 从验证码池里取，池空了就补满，补充的时间也计入，是持续的速度
+    单核上 pool 不会比 render 快：池只是把渲染挪到请求之外，削平登录高峰，
+    峰值时每个进程能直接取出的最多只有 CAPTCHA_POOL_SIZE 个
+
+    python manage.py bench_captcha --count 500
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.captcha import CaptchaPool, render_captcha
+from myapp.utils import get_captcha_font
+
+import time
+
+
+def legacy_render():
+    """ 原来 views.captcha 的做法：每次都读取字体文件 """
+    get_captcha_font.cache_clear()
+    return render_captcha()
+
+
+def pool_getter(size, count):
+    """
+        一共取 count 个，每取 size 个补满一次，补充由当前线程完成，计入测得的时间
+        最后一次只补剩下要取的个数，不多渲染
+    """
+    pool = CaptchaPool(size=size, low_water=0) # low_water 为 0 时不会启动后台线程
+    taken = 0
+
+    def get():
+        nonlocal taken
+        if taken % size == 0:
+            pool.size = min(size, count - taken)
+            pool.fill()
+        taken += 1
+        return pool.get()
+    return get
+
+
+class Command(BaseCommand):
+    help = '测试每秒能产生多少个验证码（单核）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='每种方式产生多少个验证码')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        methods = [
+            ('legacy', legacy_render),
+            ('render', render_captcha),
+            ('pool', pool_getter(settings.CAPTCHA_POOL_SIZE or count, count)),
+        ]
+        for name, method in methods:
+            start = time.perf_counter()
+            for _ in range(count):
+                method()
+            elapsed = time.perf_counter() - start
+            self.stdout.write('{:>8}: {:.0f} 个/秒'.format(name, count / elapsed))
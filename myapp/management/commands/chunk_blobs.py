@@ -0,0 +1,35 @@
+"""
+    把还没有分块储存的大文件切分成 chunk，CHUNK_STORE 为 True 时使用
+
+    python manage.py chunk_blobs                 # 处理完所有待切分的文件
+    python manage.py chunk_blobs --interval 60   # 作为常驻的后台任务每分钟检查一次
+
+    切分是纯 Python 实现，很占 CPU，所以放在 web 进程之外运行；
+    待切分的文件直接从数据库里查出来，中断之后重新运行即可继续。
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from myapp.tasks import chunk_pending_blobs
+
+import time
+
+
+class Command(BaseCommand):
+    help = '把还没有分块储存的大文件切分成 chunk，可以在线运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=0,
+                            help='每次最多切分多少个文件，0 表示不限制')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='每隔多少秒运行一次，0 表示只运行一次')
+
+    def handle(self, *args, **options):
+        while True:
+            created = chunk_pending_blobs(options['limit'] or None)
+            self.stdout.write('分块储存了 {} 个文件'.format(created))
+            if not options['interval']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,69 @@
+"""
+    给同一个目录下重名的子目录和文件改名，Directory 和 File 的 (parent, name) 加上唯一索引之前运行一次：
+    python manage.py dedupe_names
+    每组重名的保留最早创建的那个，其余的和上传时一样改名为 name_<pk>
+    目录改名时子树里的 path 跟着一起改
+
+    在 migrate 之前运行，那时表里还没有 path_hash、tree、size 等新的列，
+    所以只读写旧表结构里就有的 name、path、parent；重名的目录 path 也相同，
+    子树按 parent 一层一层找，不能按 path 前缀找。path_hash 和 tree 之后由
+    fill_path_hash、fill_dir_tree 补上
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from myapp.handles import suffix_name
+from myapp.models import Directory, File
+
+import uuid
+import os
+
+
+def rename_directory(pk, name):
+    """ 给目录改名，子孙目录和其中文件的 path 一起改，只用到旧表结构里就有的列 """
+    parent_path = Directory.objects.filter(pk=pk).values_list('parent__path', flat=True).get()
+    paths = {pk: os.path.join(parent_path, name)}
+    Directory.objects.filter(pk=pk).update(name=name, path=paths[pk])
+    level = [pk]
+    while level:
+        for file_pk, parent in File.objects.filter(parent__in=level).values_list('pk', 'parent'):
+            File.objects.filter(pk=file_pk).update(path=paths[parent])
+        children = list(Directory.objects.filter(parent__in=level).values_list('pk', 'parent', 'name'))
+        for child, parent, child_name in children:
+            paths[child] = os.path.join(paths[parent], child_name)
+            Directory.objects.filter(pk=child).update(path=paths[child])
+        level = [child for child, _, _ in children]
+
+
+class Command(BaseCommand):
+    help = '给同一个目录下重名的子目录和文件改名，可以重复运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只列出重名的目录和文件，不改名')
+
+    def handle(self, *args, **options):
+        # 先处理目录，目录改名会改掉其中文件的 path，不影响文件按 (parent, name) 分组
+        for model in (Directory, File):
+            groups = list(model.objects.filter(parent__isnull=False).values_list('parent', 'name')
+                          .annotate(n=Count('pk')).filter(n__gt=1).order_by())
+            renamed = 0
+            for parent, name, n in groups:
+                with transaction.atomic():
+                    pks = list(model.objects.select_for_update().filter(parent=parent, name=name)
+                               .order_by('pk').values_list('pk', flat=True))
+                    for pk in pks[1:]:
+                        new_name = suffix_name(name, pk)
+                        while model.objects.filter(parent=parent, name=new_name).exists():
+                            new_name = suffix_name(name, '{}_{}'.format(pk, uuid.uuid4().hex[:8]))
+                        self.stdout.write('{} -> {}'.format(name, new_name))
+                        renamed += 1
+                        if options['dry_run']:
+                            continue
+                        if model is Directory:
+                            rename_directory(pk, new_name)
+                        else:
+                            model.objects.filter(pk=pk).update(name=new_name)
+            self.stdout.write('{}: {} 组重名，改名了 {} 个{}'.format(
+                model.__name__, len(groups), renamed, '（dry run）' if options['dry_run'] else ''))
@@ -0,0 +1,32 @@
+"""
+    给已有的 Directory 补上 tree
+    新增 tree 字段并迁移数据库之后运行一次：
+    python manage.py fill_dir_tree
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myapp.models import Directory
+
+
+class Command(BaseCommand):
+    help = '给已有的 Directory 补上 tree，可以重复运行'
+
+    def handle(self, *args, **options):
+        updated = 0
+        with transaction.atomic():
+            # 从根目录开始一层一层往下算，每层一条查询读出所有目录
+            level = [(pk, tree, '') for pk, tree in
+                     Directory.objects.filter(parent=None).values_list('pk', 'tree')]
+            while level:
+                trees = {}
+                for pk, tree, parent_tree in level:
+                    trees[pk] = '{}{}/'.format(parent_tree, pk)
+                    if tree != trees[pk]:
+                        Directory.objects.filter(pk=pk).update(tree=trees[pk])
+                        updated += 1
+                children = Directory.objects.filter(parent_id__in=list(trees)) \
+                    .values_list('pk', 'tree', 'parent_id')
+                level = [(pk, tree, trees[parent_id]) for pk, tree, parent_id in children]
+        self.stdout.write('Directory: 更新了 {} 行'.format(updated))
@@ -0,0 +1,34 @@
+"""
+    给已有的 File 和 Directory 补上 path_hash
+    新增 path_hash 字段并迁移数据库之后运行一次：
+    python manage.py fill_path_hash
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myapp.models import Directory, File, get_path_hash
+
+
+class Command(BaseCommand):
+    help = '给已有的 File 和 Directory 补上 path_hash，可以重复运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000, help='每个事务更新多少行')
+
+    def handle(self, *args, **options):
+        for model in (Directory, File):
+            updated = 0
+            last_pk = 0
+            while True:
+                rows = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', 'path', 'path_hash')[:options['batch']])
+                if not rows:
+                    break
+                with transaction.atomic():
+                    for pk, path, path_hash in rows:
+                        if path_hash != get_path_hash(path):
+                            model.objects.filter(pk=pk).update(path_hash=get_path_hash(path))
+                            updated += 1
+                last_pk = rows[-1][0]
+            self.stdout.write('{}: 更新了 {} 行'.format(model.__name__, updated))
@@ -0,0 +1,68 @@
+"""
+    检查磁盘和数据库是否一致，清理没有引用的文件
+
+    python manage.py fsck                     # 扫描一轮，没有引用的 blob 移入隔离区
+    python manage.py fsck --fix-links         # 同时按 File 重新统计并修正 Link / Chunk 的计数
+    python manage.py fsck --fix-usage         # 同时按 File 重新统计并修正目录和用户的用量
+    python manage.py fsck --interval 3600     # 作为常驻的后台任务每小时运行一次
+
+    扫描是增量的，--limit 限制每次处理的文件数，下次从上次停下的位置继续。
+    没有引用的 blob 不会立即删除，在隔离区里放 GC_QUARANTINE_SECONDS 秒，
+    期间重新被引用的会放回原处。
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from myapp.fsck import Collector
+
+import time
+
+
+class Command(BaseCommand):
+    help = '检查磁盘和数据库是否一致，清理没有引用的文件，可以在线运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix-links', action='store_true',
+                            help='按实际引用数修正 Link 和 Chunk 的计数')
+        parser.add_argument('--fix-usage', action='store_true',
+                            help='按实际的文件修正目录和用户的用量')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='只报告，不做任何修改')
+        parser.add_argument('--verify', action='store_true',
+                            help='重新计算有引用的 blob 的 sha1，和文件名对比')
+        parser.add_argument('--limit', type=int, default=0,
+                            help='本次最多扫描多少个文件，0 表示扫描到末尾')
+        parser.add_argument('--iops', type=int, default=0,
+                            help='每秒最多处理多少个文件，0 表示不限制')
+        parser.add_argument('--bandwidth', type=float, default=0,
+                            help='--verify 时每秒最多读取多少 MB，0 表示不限制')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='每隔多少秒运行一次，0 表示只运行一次')
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_once(options)
+            if not options['interval']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
+
+    def run_once(self, options):
+        log = self.stdout.write if options['verbosity'] > 1 else (lambda message: None)
+        collector = Collector(
+            dry_run=options['dry_run'],
+            iops=options['iops'],
+            bandwidth=int(options['bandwidth'] * 1024 * 1024),
+            verify=options['verify'],
+            log=log,
+        )
+        collector.run(options['limit'] or None)
+        if options['fix_links']:
+            collector.rebuild_links()
+        if options['fix_usage']:
+            collector.rebuild_usage()
+
+        stats = collector.stats
+        self.stdout.write(' '.join('{}={}'.format(key, stats[key]) for key in sorted(stats)))
+        self.stdout.write('释放了 {:.1f} MB'.format(stats['reclaimed_bytes'] / 1024 / 1024))
@@ -0,0 +1,70 @@
+"""
+    把服务器本地的目录树导入到用户的目录下，可以重复运行，只导入新增和修改过的文件
+
+    python manage.py import_tree alice /mnt/nas/photos                 # 导入到 alice 的根目录
+    python manage.py import_tree alice /mnt/nas/photos --into 照片      # 导入到已有的目录下
+    python manage.py import_tree alice /mnt/nas/photos --link hardlink  # 源文件不会再修改时，不占额外空间
+
+    源目录里删除的文件不会从网盘里删除；以前导入的文件原地更新，
+    和网页上传的文件重名时按 --conflict 处理，默认和网页上传一样用 UPLOAD_NAME_CONFLICT
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.handles import NAME_CONFLICTS
+from myapp.importer import Importer, LINK_MODES
+from myapp.models import Directory, get_path_hash
+
+import os
+
+
+class Command(BaseCommand):
+    help = '把服务器本地的目录树导入到用户的目录下，增量同步'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('source', help='服务器上要导入的目录')
+        parser.add_argument('--into', default='', help='导入到用户的哪个目录下，默认根目录')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='计算 sha1 的进程数，默认和 CPU 核数一样')
+        parser.add_argument('--batch', type=int, default=500,
+                            help='每批处理多少个文件，每批一个事务')
+        parser.add_argument('--link', choices=LINK_MODES, default='auto',
+                            help='auto 时优先 reflink，不支持时复制；hardlink 和源文件共用数据')
+        parser.add_argument('--ignore-quota', action='store_true', help='不检查用户的配额')
+        parser.add_argument('--conflict', choices=NAME_CONFLICTS,
+                            help='和网页上传的文件重名时：suffix 改名为 name_<pk>，replace 覆盖，reject 跳过')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('用户 {} 不存在'.format(options['username']))
+        if not os.path.isdir(options['source']):
+            raise CommandError('{} 不是目录'.format(options['source']))
+
+        path = options['into'].strip('/')
+        target = Directory.objects.filter(owner=user, path_hash=get_path_hash(path), path=path).first()
+        if target is None:
+            if path:
+                raise CommandError('目录 {} 不存在'.format(path))
+            target = Directory.create_root_dir(user)
+
+        log = self.stdout.write if options['verbosity'] > 1 else (lambda message: None)
+        importer = Importer(
+            user, target,
+            workers=options['workers'] or None,
+            batch=options['batch'],
+            mode=options['link'],
+            check_quota=not options['ignore_quota'],
+            conflict=options['conflict'],
+            log=log,
+        )
+        try:
+            importer.run(options['source'])
+        except ValueError as e: # 超出配额，已经导入的批次保留，下次从这里继续
+            raise CommandError(str(e))
+        finally:
+            stats = importer.stats
+            self.stdout.write(' '.join('{}={}'.format(key, stats[key]) for key in sorted(stats)))
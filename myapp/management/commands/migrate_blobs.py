@@ -0,0 +1,79 @@
+"""
+    把已有的 blob 和 chunk 搬到 BLOB_LAYOUT 指定的目录布局
+
+    先把 BLOB_LAYOUT 改成 'sharded' 并重启服务，再运行：
+    python manage.py migrate_blobs
+
+    搬动用的是同一个文件系统内的 os.replace，是原子操作；
+    没搬完的 blob 仍然可以通过 locate_blob_abspath 找到，所以不需要停机。
+    sharded 布局下不进入已有的分层目录，已经搬好的 blob 不会再被扫描到，中断之后重新运行即可继续。
+    改动了 BLOB_SHARD_DEPTH 时，旧的分层目录里的 blob 也要搬，加上 --rescan-shards。
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.models import (get_media_abspath, get_chunk_abspath, get_blob_abspath,
+                          get_quarantine_abspath, get_thumbnail_root)
+
+import time
+import os
+import re
+
+
+class Command(BaseCommand):
+    help = '把已有的 blob 搬到 BLOB_LAYOUT 指定的目录布局，可以在线运行，中断后重新运行即可继续'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=0,
+                            help='本次最多搬动多少个文件，0 表示不限制')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='每搬动一个文件后暂停的秒数，减轻线上磁盘压力')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='只打印需要搬动的文件，不实际搬动')
+        parser.add_argument('--rescan-shards', action='store_true',
+                            help='也扫描已有的分层目录，改动了 BLOB_SHARD_DEPTH 之后使用')
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+        moved = 0
+        for root in (get_media_abspath(), get_chunk_abspath()):
+            for path in self.iter_blobs(root, options['rescan_shards']):
+                digest = os.path.basename(path)
+                target = get_blob_abspath(digest, root)
+                if path == target:
+                    continue
+                if options['dry_run']:
+                    self.stdout.write('{} -> {}'.format(path, target))
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(path, target) # 目标已经存在时内容相同，直接覆盖
+                    if options['sleep']:
+                        time.sleep(options['sleep'])
+                moved += 1
+                if moved % 10000 == 0:
+                    self.stdout.write('已处理 {} 个文件'.format(moved))
+                if limit and moved >= limit:
+                    self.stdout.write('达到 --limit，已处理 {} 个文件'.format(moved))
+                    return
+        self.stdout.write('完成，共处理 {} 个文件'.format(moved))
+
+    def iter_blobs(self, root, rescan_shards=False):
+        """
+            遍历 root 下所有以 sha1 命名的文件，跳过临时文件、隔离区、缩略图和 chunks 目录
+            （chunks 目录作为单独的根目录处理）
+            sharded 布局下除非 rescan_shards，也跳过分层目录：搬进去的 blob 已经在目标位置上
+        """
+        chunk_dir = get_chunk_abspath()
+        skip = {chunk_dir, get_quarantine_abspath(), get_thumbnail_root()}
+        shard = None
+        if settings.BLOB_LAYOUT == 'sharded' and not rescan_shards:
+            shard = re.compile(r'^[0-9a-f]{{{}}}$'.format(settings.BLOB_SHARD_WIDTH))
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root:
+                dirnames[:] = [name for name in dirnames
+                               if os.path.join(dirpath, name) not in skip
+                               and not (shard and shard.match(name))]
+            for name in filenames:
+                if re.match(r'^[0-9a-f]{40}$', name):
+                    yield os.path.join(dirpath, name)
@@ -0,0 +1,37 @@
+"""
+    myapp 的中间件
+"""
+
+from django.http import HttpResponse
+
+from .handles import check_quota
+
+
+class QuotaMiddleware(object):
+    """
+        普通上传的请求体在 CsrfViewMiddleware 读取 request.POST 时就会被解析并写入临时文件，
+        等到 view 里再检查配额就晚了。所以在 process_view 里先用请求声明的 Content-Length
+        检查一次，超出配额时直接返回 413，一个字节也不读
+
+        需要放在 CsrfViewMiddleware 前面
+    """
+    checked_views = ('myapp:upload',)
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method != 'POST' or request.resolver_match.view_name not in self.checked_views:
+            return None
+        if not request.user.is_authenticated:
+            return None
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if not check_quota(request.user, length): # Content-Length 包括表单的其他部分，只会多算不会少算
+            return HttpResponse('抱歉，空间不足', status=413)
+        return None
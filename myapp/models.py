@@ -1,32 +1,183 @@
 from django.contrib.auth.models import User
 from django.db import models
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q, Sum, Case, When, Value
+from django.db.models.functions import Concat, Substr
 from django.utils import timezone
 
+from .utils import ConcatFile
+
+from collections import Counter, defaultdict
+import hashlib
+import glob
+import uuid
 import os
 
 
+class NameConflict(ValueError):
+    """ 目录下已经有同名的文件，API 返回 409 """
+
+
 def get_media_abspath():
     """
-        所有文件都直接放到 media 目录下，不再做不必要的划分，增加麻烦！
+        所有文件都放到 media 目录下，具体的目录布局见 get_blob_abspath
     """
     return settings.MEDIA_ROOT
 
 
+def iter_batches(items, size=500):
+    """ 把很长的列表切成小段，避免 IN 查询的参数太多（SQLite 最多 999 个） """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_path_hash(path):
+    """
+        path 最长 4096 个字符，MySQL 无法直接给它建索引，
+        所以另存一份 path 的 sha1，查询时同时比较 path_hash 和 path
+    """
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+
+def get_blob_abspath(digest, root=None):
+    """
+        digest: blob 的 sha1
+        root: blob 所在的根目录，默认是 media 目录
+
+        返回 blob 应该储存的服务器路径，由 BLOB_LAYOUT 决定：
+            'flat': 直接放在根目录下，如 root/abcdef...
+            'sharded': 按 digest 的前缀分层，如 root/ab/cd/abcdef...
+                       层数和每层的长度由 BLOB_SHARD_DEPTH 和 BLOB_SHARD_WIDTH 决定
+        文件数量达到百万级时，单个目录太大，查找、备份都会变慢，应该用 sharded
+    """
+    root = root or get_media_abspath()
+    layout = settings.BLOB_LAYOUT
+    if layout == 'flat':
+        return os.path.join(root, digest)
+    elif layout == 'sharded':
+        width = settings.BLOB_SHARD_WIDTH
+        shards = [digest[i * width:(i + 1) * width] for i in range(settings.BLOB_SHARD_DEPTH)]
+        return os.path.join(root, *shards, digest)
+    raise ImproperlyConfigured('未知的 BLOB_LAYOUT: {!r}'.format(layout))
+
+
+def locate_blob_abspath(digest, root=None):
+    """
+        返回 blob 实际所在的服务器路径
+        从 flat 迁移到 sharded 期间，还没有搬走的 blob 仍然在根目录下，
+        新布局下找不到时再看看根目录，所以迁移时不需要停机
+    """
+    path = get_blob_abspath(digest, root)
+    if settings.BLOB_LAYOUT != 'flat' and not os.path.exists(path):
+        legacy = os.path.join(root or get_media_abspath(), digest)
+        if os.path.exists(legacy):
+            return legacy
+    return path
+
+
+def remove_blob(path, is_referenced):
+    """
+        path: blob 的服务器路径
+        is_referenced: 无参数函数，返回 blob 现在是否又被引用了
+        计数归零并提交之后调用，返回 blob 是否存在
+
+        先把 blob 改名成墓碑，再检查引用，而不是检查完再删除：
+            检查时已经有人提交了新的计数，就把墓碑放回去；
+            检查之后才有人提交计数，上传方提交后会发现 blob 不见了，用自己的临时文件放回去
+        这样不需要任何锁，blob 也不会在仍被引用时丢失
+    """
+    tombstone = '{}.deleting-{}'.format(path, uuid.uuid4().hex)
+    try:
+        os.rename(path, tombstone)
+    except FileNotFoundError:
+        return False
+    if is_referenced():
+        try:
+            os.link(tombstone, path)
+        except FileExistsError: # 上传方已经放回去了
+            pass
+    os.remove(tombstone)
+    return True
+
+
+def get_chunk_abspath():
+    """
+        分块储存的 chunk 放在 media 下单独的目录，和完整的 blob 分开
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'chunks')
+
+
+def get_quarantine_abspath():
+    """
+        fsck 找到的没有引用的 blob 先移到这里，过一段时间仍没有引用才删除
+    """
+    return os.path.join(settings.MEDIA_ROOT, '.quarantine')
+
+
+def get_thumbnail_root():
+    """ 缩略图缓存的目录，里面的东西都可以删掉，需要时重新生成 """
+    return os.path.join(settings.MEDIA_ROOT, 'thumbnails')
+
+
+def get_thumbnail_abspath(digest, size, ext):
+    """
+        缩略图按 digest 和尺寸缓存，内容相同的文件共用缩略图
+        MEDIA_ROOT/thumbnails/ab/abcdef...-256.webp
+    """
+    return os.path.join(get_thumbnail_root(), digest[:2], '{}-{}.{}'.format(digest, size, ext))
+
+
+def remove_thumbnails(digest):
+    """ 删除 digest 所有尺寸的缩略图 """
+    for path in glob.glob(get_thumbnail_abspath(digest, '*', '*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
 class Directory(models.Model):
     """
-        name: 用户能看到的文件目录名. todo: 同级目录下不允许重复
+        name: 用户能看到的文件目录名，同一个目录下不能重复
         parent: 上级目录，如果本身是根目录则 parent 为空字符
         path: 用户能看到的相对路径，需要用 get_full_path 才能转换成绝对路径
+        tree: 从根目录到自身的 pk 路径，如 '1/5/9/'，由 save 自动填写
+              path 太长，不能建索引；tree 很短，按前缀查询整棵子树可以走索引，
+              改名不影响 tree，移动目录时整棵子树的 tree 一条 UPDATE 就能改完
     """
     name = models.CharField(max_length=256) # 如 / home
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     parent = models.ForeignKey('Directory', null=True, on_delete=models.CASCADE) # 只有根目录没有 parent
     path = models.CharField(max_length=4096, default='')
+    path_hash = models.CharField(max_length=40, default='') # 由 save 自动填写，用于索引
+    tree = models.CharField(max_length=700, default='')
+    size = models.BigIntegerField(default=0) # 自身和所有子孙目录下文件的总大小，由 add_usage 维护
+    file_count = models.IntegerField(default=0) # 自身和所有子孙目录下的文件数
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'path_hash']), # 根据 URL 查找目录
+            models.Index(fields=['owner', 'parent']), # 查找根目录和子目录
+            models.Index(fields=['tree']), # 按前缀查找子树
+        ]
+        # 同一个目录下不能有同名的子目录，同时用于分页列出子目录；根目录的 parent 为 NULL，不受限制
+        unique_together = ('parent', 'name')
 
     def __str__(self):
         return self.name or '/'
 
+    def save(self, *args, **kwargs):
+        self.path_hash = get_path_hash(self.path)
+        if self.tree:
+            super().save(*args, **kwargs)
+            return
+        with transaction.atomic(): # 新建的目录要先有 pk 才能算出 tree
+            super().save(*args, **kwargs)
+            self.tree = '{}{}/'.format(self.parent.tree if self.parent_id else '', self.pk)
+            Directory.objects.filter(pk=self.pk).update(tree=self.tree)
+
     @classmethod
     def create_root_dir(cls, user):
         """
@@ -40,21 +191,144 @@ class Directory(models.Model):
                 )
         return directory
 
+    def create_subdir(self, name):
+        """ 在自身下新建子目录，已经有同名的子目录时抛出 NameConflict """
+        try:
+            with transaction.atomic():
+                return Directory.objects.create(
+                    name = name,
+                    owner_id = self.owner_id,
+                    parent = self,
+                    path = os.path.join(self.path, name),
+                )
+        except IntegrityError:
+            raise NameConflict('已经有同名的目录 {}'.format(name))
+
     def get_url(self):
         return '/{}/{}'.format(self.owner.username, self.path)
 
-    def rmdir(self):
+    def to_dict(self):
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'parent': self.parent_id,
+            'path': self.path,
+            'size': self.size,
+            'file_count': self.file_count,
+            'url': self.get_url(),
+        }
+
+    def get_ancestor_pks(self):
+        """ 自身和所有上级目录的 pk，从 tree 里直接读出，不需要查询 """
+        return [int(pk) for pk in self.tree.split('/') if pk]
+
+    def add_usage(self, size, count):
         """
-            删除子目录和子目录下的文件，以及自身包含的文件和自身
+            自身、所有上级目录以及用户的用量加上 size 字节、count 个文件，可以是负数
+            直接在数据库里加减，不先读再写；需要和增删文件放在同一个事务里
         """
-        for subdir in Directory.objects.filter(parent=self):
-            for file in subdir.file_set.all():
-                Link.minus_one(file)
+        Directory.objects.filter(pk__in=self.get_ancestor_pks()).update(
+            size=F('size') + size, file_count=F('file_count') + count)
+        Usage.add(self.owner_id, size, count)
 
-        for file in self.file_set.all():
-            Link.minus_one(file)
+    def get_subtree(self):
+        """
+            自身和所有子孙目录，按 tree 前缀一次查出
+        """
+        if not self.tree: # 还没有运行 fill_dir_tree 的旧数据，按 path 前缀查，不走索引
+            subtree = Directory.objects.filter(owner=self.owner)
+            if self.path:
+                subtree = subtree.filter(Q(path=self.path) | Q(path__startswith=self.path + '/'))
+            return subtree
+        return Directory.objects.filter(tree__startswith=self.tree)
+
+    def get_subtree_files(self):
+        """ 自身和所有子孙目录下的文件 """
+        if not self.tree:
+            return File.objects.filter(parent__in=self.get_subtree())
+        return File.objects.filter(parent__tree__startswith=self.tree)
+
+    def get_subtree_size(self):
+        """ 整棵子树的文件总大小，一条查询 """
+        return self.get_subtree_files().aggregate(size=Sum('size'))['size'] or 0
+
+    def move(self, parent=None, name=None):
+        """
+            parent: 移动到这个目录下，为 None 时不移动
+            name: 新的目录名，为 None 时不改名
+            整棵子树的 path、tree 和其中文件的 path 都用一条 UPDATE 改完，
+            path_hash 在 Python 里算好之后按 500 个目录一批用 CASE 更新
+            目标目录下已经有同名的子目录时抛出 NameConflict
+        """
+        parent = parent or self.parent
+        name = name or self.name
+        if parent is None:
+            raise ValueError('根目录不能移动或改名')
+        if parent.owner_id != self.owner_id:
+            raise ValueError('不能移动到其他用户的目录下')
+        if not self.tree or not parent.tree:
+            raise ValueError('请先运行 python manage.py fill_dir_tree')
+        if parent.tree.startswith(self.tree):
+            raise ValueError('不能把目录移动到自身或者子目录下')
+
+        old_path, new_path = self.path, os.path.join(parent.path, name)
+        old_tree, new_tree = self.tree, '{}{}/'.format(parent.tree, self.pk)
+        with transaction.atomic():
+            # 先检查再改，不要等改完整棵子树才被唯一索引拦下；并发时仍由唯一索引保证
+            siblings = Directory.objects.select_for_update().filter(parent=parent, name=name)
+            if siblings.exclude(pk=self.pk).exists():
+                raise NameConflict('目标目录下已经有同名的目录 {}'.format(name))
+            subtree = self.get_subtree()
+            rows = list(subtree.select_for_update().values_list('pk', 'size', 'file_count'))
+            pks = [pk for pk, _, _ in rows]
+            # 用量从原来的上级目录转到新的上级目录，共同的上级目录不变
+            size, count = next((size, count) for pk, size, count in rows if pk == self.pk)
+            old_ancestors = set(self.get_ancestor_pks()[:-1])
+            new_ancestors = set(parent.get_ancestor_pks())
+            Directory.objects.filter(pk__in=old_ancestors - new_ancestors).update(
+                size=F('size') - size, file_count=F('file_count') - count)
+            Directory.objects.filter(pk__in=new_ancestors - old_ancestors).update(
+                size=F('size') + size, file_count=F('file_count') + count)
+            # 先改文件，子查询里还要用旧的 tree 找到这些目录
+            self.get_subtree_files().update(
+                path=Concat(Value(new_path), Substr('path', len(old_path) + 1)))
+            Directory.objects.filter(pk__in=pks).update(
+                path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+                tree=Concat(Value(new_tree), Substr('tree', len(old_tree) + 1)))
+            try:
+                Directory.objects.filter(pk=self.pk).update(name=name, parent=parent)
+            except IntegrityError:
+                raise NameConflict('目标目录下已经有同名的目录 {}'.format(name))
+
+            # 一个目录下所有文件的 path 和目录自身的一样，path_hash 也一样
+            paths = dict(Directory.objects.filter(pk__in=pks).values_list('pk', 'path'))
+            for batch in iter_batches(pks):
+                hashes = [When(pk=pk, then=Value(get_path_hash(paths[pk]))) for pk in batch]
+                Directory.objects.filter(pk__in=batch).update(path_hash=Case(*hashes))
+                hashes = [When(parent_id=pk, then=Value(get_path_hash(paths[pk]))) for pk in batch]
+                File.objects.filter(parent_id__in=batch).update(path_hash=Case(*hashes))
+
+        self.name, self.parent, self.path, self.tree = name, parent, new_path, new_tree
+        self.path_hash = get_path_hash(new_path)
 
-        self.delete()
+    def rmdir(self):
+        """
+            删除自身、所有子孙目录，以及其中的文件
+            文件按 digest 分组后批量减少计数，计数归零的 digest 记入 OrphanBlob，
+            由后台清理磁盘文件，不在请求里删除。返回计数归零的 digest 列表
+        """
+        with transaction.atomic():
+            subtree = self.get_subtree()
+            files = self.get_subtree_files()
+            # 锁住这些文件，同时单独删除其中某个文件的请求会等待，之后发现文件已经不在了
+            rows = list(files.select_for_update().values_list('digest', 'size'))
+            digests = Counter(digest for digest, _ in rows)
+            self.add_usage(-sum(size for _, size in rows), -len(rows))
+
+            orphans = Link.remove_many(digests)
+            files.delete()
+            subtree.delete()
+        return orphans
 
 
 class File(models.Model):
@@ -74,25 +348,90 @@ class File(models.Model):
 
     name = models.CharField(max_length=256)
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
-    size = models.IntegerField(default=0) 
+    size = models.BigIntegerField(default=0) # 字节，超过 2GB 的文件在 MySQL 的 INT 里放不下
     parent = models.ForeignKey(Directory, on_delete=models.CASCADE)
     digest = models.CharField(max_length=40) 
     path = models.CharField(max_length=4096, default='')
+    path_hash = models.CharField(max_length=40, default='') # 由 save 自动填写，用于索引
     datetime = models.DateTimeField(auto_now_add=True)
+    source_mtime = models.BigIntegerField(null=True, blank=True) # import_tree 导入时源文件的修改时间（纳秒）
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'path_hash', 'name']), # 根据 URL 查找文件
+            models.Index(fields=['digest']), # 计数和去重
+            # 分页列出目录下的文件，按大小、上传时间排序；按名字排序用下面的唯一索引
+            models.Index(fields=['parent', 'size']),
+            models.Index(fields=['parent', 'datetime']),
+        ]
+        # 同一个目录下不能有同名文件，重名由插入时的唯一索引冲突发现，见 handles.create_file_object
+        # 已有重名文件的数据库先运行 python manage.py dedupe_names 再迁移
+        unique_together = ('parent', 'name')
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.path_hash = get_path_hash(self.path)
+        super().save(*args, **kwargs)
+
     def get_full_path(self):
         """ 文件的服务器路径 """
-        return os.path.join(get_media_abspath(), self.digest)
+        return locate_blob_abspath(self.digest)
+
+    def open(self):
+        """
+            以二进制只读方式打开文件内容
+            分块储存的文件没有完整的 blob，按清单把 chunk 拼接起来
+        """
+        try:
+            return open(self.get_full_path(), 'rb')
+        except FileNotFoundError:
+            if os.path.exists(get_blob_abspath(self.digest)): # 刚好被 migrate_blobs 搬走了
+                return open(get_blob_abspath(self.digest), 'rb')
+            parts = [(item.offset, item.chunk.size, item.chunk.get_full_path())
+                     for item in FileChunk.objects.filter(digest=self.digest).select_related('chunk')]
+            if not parts and self.size:
+                raise
+            return ConcatFile(parts)
+
+    def get_parts(self):
+        """
+            文件内容所在的磁盘文件 [(offset, size, 服务器路径), ...]，可以交给 ConcatFile
+            完整的 blob 只有一段，分块储存的文件每个 chunk 一段
+            用于把文件交给其他进程读取，File 对象本身不能跨进程传递
+        """
+        for path in (self.get_full_path(), get_blob_abspath(self.digest)):
+            try:
+                return [(0, os.path.getsize(path), path)]
+            except FileNotFoundError:
+                pass
+        return [(item.offset, item.chunk.size, item.chunk.get_full_path())
+                for item in FileChunk.objects.filter(digest=self.digest).select_related('chunk')]
+
+    def is_stored(self):
+        """ 服务器上是否有这个文件的内容，完整的 blob 或者分块清单 """
+        return os.path.exists(self.get_full_path()) or \
+            FileChunk.objects.filter(digest=self.digest).exists()
+
+    def is_chunked(self):
+        """ 是否分块储存，分块储存的文件不能交给前端代理直接发送 """
+        return not os.path.exists(self.get_full_path()) and \
+            FileChunk.objects.filter(digest=self.digest).exists()
 
     def remove_from_disk(self):
         """ 
             删除磁盘上的文件，而不是只减少计数器+删除 File 对象 
             用于发现重复文件后，清除新添加的文件，保留用户的 File 对象，改写其 path 值
+            分块储存的文件则释放它引用的所有 chunk
+            在计数归零并提交之后调用，删除前会再确认一次没有新的引用
         """
-        os.remove(self.get_full_path())
+        is_referenced = Link.objects.filter(digest=self.digest).exists
+        if not remove_blob(self.get_full_path(), is_referenced) and not is_referenced():
+            Chunk.release(self.digest)
+        if not is_referenced():
+            remove_thumbnails(self.digest)
+            FileType.objects.filter(digest=self.digest).delete()
 
     def get_url(self):
         """
@@ -103,6 +442,41 @@ class File(models.Model):
         else:
             return '/{}/{}'.format(self.owner.username, self.name)
 
+    def to_dict(self):
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'parent': self.parent_id,
+            'size': self.size,
+            'digest': self.digest,
+            'datetime': self.datetime,
+            'url': self.get_url(),
+        }
+
+    def move(self, parent=None, name=None):
+        """
+            parent: 移动到这个目录下，为 None 时不移动
+            name: 新的文件名，为 None 时不改名
+            目标目录下已经有同名文件时抛出 NameConflict；用量从原来的目录转到新的目录
+        """
+        parent = parent or self.parent
+        name = name or self.name
+        if parent.owner_id != self.owner_id:
+            raise ValueError('不能移动到其他用户的目录下')
+        with transaction.atomic():
+            if parent.pk != self.parent_id:
+                self.parent.add_usage(-self.size, -1)
+                parent.add_usage(self.size, 1)
+            # 不用 save()，文件如果刚好被别的请求删掉，save() 会重新插入一行
+            # 不先查有没有同名文件，由唯一索引检查，异常时整个事务回滚
+            try:
+                File.objects.filter(pk=self.pk).update(
+                    name=name, parent=parent, path=parent.path, path_hash=get_path_hash(parent.path))
+            except IntegrityError:
+                raise NameConflict('目标目录下已经有同名的文件 {}'.format(name))
+        self.name, self.parent, self.path = name, parent, parent.path
+        self.path_hash = get_path_hash(parent.path)
+
     def get_size(self): # Byte
         """
             make the file size more human-readable
@@ -119,6 +493,49 @@ class File(models.Model):
         return size
 
 
+class Usage(models.Model):
+    """
+        用户的用量和配额
+        size, file_count: 用户所有文件的总大小和文件数，由 Directory.add_usage 维护
+        quota: 用户可以使用的字节数，为空时使用 USER_QUOTA
+
+        上传前只比较计数，不用 SUM(File.size) 现算；计数有偏差时由 fsck --fix-usage 修正
+    """
+    owner = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE)
+    size = models.BigIntegerField(default=0)
+    file_count = models.IntegerField(default=0)
+    quota = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return '{}/{}'.format(self.size, self.get_quota())
+
+    @classmethod
+    def add(cls, owner_id, size, count):
+        """ 和 Link.add_one 一样，直接在数据库里加减，没有记录时创建 """
+        with transaction.atomic():
+            if cls.objects.filter(owner_id=owner_id).update(
+                    size=F('size') + size, file_count=F('file_count') + count):
+                return
+            usage, created = cls.objects.get_or_create(
+                owner_id=owner_id, defaults={'size': size, 'file_count': count})
+            if not created:
+                cls.objects.filter(owner_id=owner_id).update(
+                    size=F('size') + size, file_count=F('file_count') + count)
+
+    @classmethod
+    def get_for(cls, user):
+        return cls.objects.get_or_create(owner=user)[0]
+
+    def get_quota(self):
+        """ 用户可以使用的字节数，None 表示不限制 """
+        return self.quota if self.quota is not None else settings.USER_QUOTA
+
+    def has_room(self, size):
+        """ 再写入 size 字节是否超出配额 """
+        quota = self.get_quota()
+        return quota is None or self.size + size <= quota
+
+
 class Link(models.Model):
     """
         记录文件的摘要和links数
@@ -144,45 +561,279 @@ class Link(models.Model):
         """
             新增文件后调用。使得计数器加一
             如果对应的 digest 没有计数器，则创建计数器，并 links = 1
+
+            直接在数据库里 links = links + 1，不先读再写，并发上传同一个文件时计数不会丢；
+            digest 是主键，两个请求同时创建计数器时，get_or_create 会退回到读取已有的那个
         """
-        nums = File.objects.filter(digest=file.digest).count()
-        link_objects = cls.objects.filter(digest=file.digest)
-        if link_objects:
-            link = link_objects[0]
-            link.links = nums
-            link.save()
-        else:
-            link = cls.objects.create(digest=file.digest, links=nums) # nums 为1
+        with transaction.atomic():
+            if cls.objects.filter(digest=file.digest).update(links=F('links') + 1):
+                return
+            link, created = cls.objects.get_or_create(digest=file.digest, defaults={'links': 1})
+            if not created:
+                cls.objects.filter(digest=file.digest).update(links=F('links') + 1)
+
+    @classmethod
+    def add_many(cls, counts):
+        """
+            counts: {digest: 增加的数量}，批量上传和导入时使用
+            已有的计数器按增加的数量分组，每组一条 UPDATE；没有的批量创建，
+            创建时和别的请求冲突了就逐个处理
+            查出来的计数器用 select_for_update 锁到事务结束，否则在查询和 UPDATE 之间被删掉的
+            计数器既不会加一也不会重新创建，新文件就没有计数了
+        """
+        by_count = defaultdict(list)
+        for digest, n in counts.items():
+            by_count[n].append(digest)
+        with transaction.atomic(savepoint=False):
+            existing = set()
+            for n, group in by_count.items():
+                for batch in iter_batches(group):
+                    existing.update(cls.objects.select_for_update().filter(digest__in=batch)
+                                    .values_list('digest', flat=True))
+                    cls.objects.filter(digest__in=batch).update(links=F('links') + n)
+            missing = [cls(digest=digest, links=n) for digest, n in counts.items() if digest not in existing]
+            if not missing:
+                return
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(missing)
+            except IntegrityError:
+                for link in missing:
+                    if not cls.objects.filter(digest=link.digest).update(links=F('links') + link.links):
+                        cls.objects.create(digest=link.digest, links=link.links)
+
+    @classmethod
+    def remove_many(cls, counts):
+        """
+            counts: {digest: 减少的数量}，删除目录、替换文件内容时使用
+            减去同样数量的 digest 放在一条 UPDATE 里；计数归零的删除并记入 OrphanBlob，
+            由后台清理磁盘文件。返回计数归零的 digest 列表
+        """
+        by_count = defaultdict(list)
+        for digest, n in counts.items():
+            by_count[n].append(digest)
+        with transaction.atomic(savepoint=False):
+            for n, group in by_count.items():
+                for batch in iter_batches(group):
+                    cls.objects.filter(digest__in=batch).update(links=F('links') - n)
+
+            orphans = []
+            for batch in iter_batches(list(counts)):
+                released = cls.objects.filter(digest__in=batch, links__lt=1)
+                orphans.extend(released.values_list('digest', flat=True))
+                released.delete()
+            OrphanBlob.add(orphans)
+        return orphans
 
     @classmethod
     def minus_one(cls, file):
         """ 
             删除文件后调用。使得计数器减一
             如果对应的 digest 的计数器为 0，那么从磁盘删除掉这个文件
+
+            计数器只有 links < 1 时才会被删除，并发删除时只有一个请求会删掉它；
+            磁盘上的文件等事务提交之后再删除，事务回滚时不会误删
         """
-        link = cls.objects.get(digest=file.digest)
-        link.links -= 1
-        
-        if link.links < 1:
-            file.remove_from_disk()
-            link.delete()
-        else:
-            link.save()
+        with transaction.atomic():
+            if not file.delete()[0]: # 同一个文件已经被别的请求删掉了，不能再减一次
+                return
+            file.parent.add_usage(-file.size, -1)
+            cls.objects.filter(digest=file.digest).update(links=F('links') - 1)
+            deleted, _ = cls.objects.filter(digest=file.digest, links__lt=1).delete()
+            if deleted:
+                transaction.on_commit(file.remove_from_disk)
+
+
+class Chunk(models.Model):
+    """
+        内容定义分块（CDC）储存的数据块，文件名是 chunk 的 sha1
+        和 Link 一样记录引用数，引用数为 0 时从磁盘删除
+
+        大文件只改动了一小部分时，新旧版本绝大部分 chunk 相同，
+        只需要多储存改动附近的几个 chunk
+    """
+    digest = models.CharField(max_length=40, primary_key=True)
+    size = models.IntegerField()
+    links = models.IntegerField(default=0)
+
+    def __str__(self):
+        return self.digest
+
+    def get_full_path(self):
+        """ chunk 的服务器路径 """
+        return locate_blob_abspath(self.digest, get_chunk_abspath())
+
+    @classmethod
+    def add_many(cls, counts, sizes):
+        """
+            counts: {chunk digest: 增加的引用数}，sizes: {chunk digest: 大小}
+            和 Link.add_many 一样：已有的锁住之后按增加的数量分组 UPDATE，没有的批量创建
+        """
+        by_count = defaultdict(list)
+        for digest, n in counts.items():
+            by_count[n].append(digest)
+        with transaction.atomic(savepoint=False):
+            existing = set()
+            for n, group in by_count.items():
+                for batch in iter_batches(group):
+                    existing.update(cls.objects.select_for_update().filter(digest__in=batch)
+                                    .values_list('digest', flat=True))
+                    cls.objects.filter(digest__in=batch).update(links=F('links') + n)
+            missing = [cls(digest=digest, size=sizes[digest], links=n)
+                       for digest, n in counts.items() if digest not in existing]
+            if not missing:
+                return
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(missing)
+            except IntegrityError: # 别的文件同时切出了同样的 chunk
+                for chunk in missing:
+                    if not cls.objects.filter(digest=chunk.digest).update(links=F('links') + chunk.links):
+                        cls.objects.create(digest=chunk.digest, size=chunk.size, links=chunk.links)
 
-        file.delete()
+    @classmethod
+    def release(cls, digest):
+        """
+            digest: 整个文件的 sha1
+            文件的 Link 计数归零后调用，删除清单，清单里每个 chunk 的引用数减一，
+            引用数归零的 chunk 从磁盘删除
+            清单用 select_for_update 锁住，后台清理和 fsck 同时释放同一份清单时不会减两次
+        """
+        with transaction.atomic():
+            manifest = FileChunk.objects.filter(digest=digest)
+            # 同一个 chunk 可能出现多次
+            counter = Counter(manifest.select_for_update().values_list('chunk_id', flat=True))
+            manifest.delete()
+            for chunk_id, n in counter.items():
+                cls.objects.filter(pk=chunk_id).update(links=F('links') - n)
+            released = []
+            for chunk in cls.objects.filter(pk__in=counter, links__lt=1):
+                # 带上 links < 1 再删一次，期间被重新引用的 chunk 不会被删掉
+                if cls.objects.filter(pk=chunk.pk, links__lt=1).delete()[0]:
+                    released.append(chunk)
+
+        for chunk in released:
+            remove_blob(chunk.get_full_path(), cls.objects.filter(pk=chunk.pk).exists)
+
+
+class FileChunk(models.Model):
+    """
+        分块储存的文件清单：digest 对应的文件由哪些 chunk 按顺序拼成
+        和 Link 一样与 digest 绑定，而不是和 File 绑定，重复的文件共用一份清单
 
+        digest: 整个文件的 sha1
+        index:  chunk 在文件中的序号
+        offset: chunk 在文件中的起始位置
+    """
+    digest = models.CharField(max_length=40, db_index=True)
+    index = models.IntegerField()
+    offset = models.BigIntegerField()
+    chunk = models.ForeignKey(Chunk, on_delete=models.PROTECT)
 
+    class Meta:
+        unique_together = ('digest', 'index')
+        ordering = ['digest', 'index']
 
+    def __str__(self):
+        return '{}[{}]'.format(self.digest, self.index)
 
 
+class FileType(models.Model):
+    """
+        libmagic 对 digest 对应内容的判断结果
+        内容按 sha1 储存，永远不变，所以只需要判断一次；
+        上传时用已经在内存里的开头一段判断，老文件在第一次预览时补上
+    """
+    digest = models.CharField(max_length=40, primary_key=True)
+    mime = models.CharField(max_length=255) # 如 image/png
+    description = models.CharField(max_length=1024) # 如 PNG image data, 10 x 10, 8-bit/color RGB
+
+    def __str__(self):
+        return self.mime
+
 
+class ApiToken(models.Model):
+    """
+        JSON API 的访问令牌，请求头 Authorization: Token <令牌>
+        数据库里只保存令牌的 sha1，令牌本身只在创建时显示一次，数据库泄露也不能直接拿来用
+    """
+    digest = models.CharField(max_length=40, primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=64, blank=True) # 方便用户区分，如 laptop
+    datetime = models.DateTimeField(auto_now_add=True)
 
+    def __str__(self):
+        return '{} ({})'.format(self.user, self.name)
 
+    @classmethod
+    def create_for(cls, user, name=''):
+        """ 新建令牌，返回令牌本身 """
+        key = uuid.uuid4().hex + uuid.uuid4().hex
+        cls.objects.create(digest=hashlib.sha1(key.encode()).hexdigest(), user=user, name=name)
+        return key
 
+    @classmethod
+    def get_user(cls, key):
+        """ 令牌对应的用户，令牌无效或者用户被停用时返回 None """
+        token = cls.objects.select_related('user').filter(
+            digest=hashlib.sha1(key.encode()).hexdigest()).first()
+        if token is None or not token.user.is_active:
+            return None
+        return token.user
 
 
+class OrphanBlob(models.Model):
+    """
+        计数已经归零、等待从磁盘删除的 digest
+        批量删除目录时不在请求里删除磁盘文件，而是记在这里，由后台线程或者 fsck 命令清理
+        清理前会再确认一次没有新的引用，见 File.remove_from_disk
+    """
+    digest = models.CharField(max_length=40, primary_key=True)
+    datetime = models.DateTimeField(auto_now_add=True)
 
+    def __str__(self):
+        return self.digest
 
+    @classmethod
+    def add(cls, digests):
+        """ 批量记录，已经在等待清理的 digest 跳过 """
+        for batch in iter_batches(digests):
+            existing = set(cls.objects.filter(digest__in=batch).values_list('digest', flat=True))
+            cls.objects.bulk_create([cls(digest=digest) for digest in batch if digest not in existing])
 
 
+class UploadSession(models.Model):
+    """
+        断点续传的上传会话
+        客户端先声明文件名和大小，然后按 offset 分块上传，断线后查询 offset 继续传，
+        最后 finalize，走和普通上传一样的 File / Link 去重逻辑
+
+        id:     会话 id，同时也是临时文件的名字
+        parent: 上传完成后文件所在的目录
+        size:   客户端声明的文件总大小
+        offset: 已经写入临时文件的字节数
+        conflict: 完成时目录下已经有同名文件怎么办，创建会话时指定
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=256)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    parent = models.ForeignKey(Directory, on_delete=models.CASCADE)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    conflict = models.CharField(max_length=8, default='suffix') # 重名时怎么办，见 handles.NAME_CONFLICTS
+    datetime = models.DateTimeField(auto_now_add=True)
 
+    def __str__(self):
+        return '{} ({}/{})'.format(self.name, self.offset, self.size)
+
+    def get_temp_path(self):
+        """ 临时文件的服务器路径，加 .part 后缀以区别于普通上传的临时文件 """
+        return os.path.join(get_media_abspath(), '{}.part'.format(self.pk))
+
+    def to_dict(self):
+        return {
+            'id': str(self.pk),
+            'name': self.name,
+            'size': self.size,
+            'offset': self.offset,
+        }
@@ -0,0 +1,112 @@
+"""
+    文本文件的预览摘要
+    只读文件开头 TEXT_PREVIEW_HEAD_SIZE 和末尾 TEXT_PREVIEW_TAIL_SIZE 字节，
+    再大的日志文件预览一次也只需要几 KB 的 IO，不会整个解码
+
+    解码后的摘要按 digest 缓存在缩略图目录下，内容相同的文件共用；
+    按 CSV / JSON / 日志 / 普通文本渲染的部分和文件名有关，每次请求时再做
+"""
+
+from django.conf import settings
+from django.utils.html import escape
+
+from .models import get_thumbnail_abspath
+from .utils import detect_text_encoding, decode_text_window
+
+import json
+import uuid
+import csv
+import os
+
+TEXT_MIME_TYPES = ('application/json', 'application/csv', 'application/x-ndjson', 'application/xml')
+
+
+def is_text(mime, description):
+    """ 根据 libmagic 的结果判断是不是文本文件 """
+    return mime.startswith('text/') or mime in TEXT_MIME_TYPES or ' text' in description
+
+
+def get_text_snippet(file):
+    """
+        返回文件的摘要，依次查磁盘缓存，没有时读文件生成
+        {'encoding': 编码, 'head': 开头的文本, 'tail': 末尾的文本, 'complete': 是否是整个文件}
+        complete 为 True 时 head 就是全文，tail 为空
+    """
+    path = get_thumbnail_abspath(file.digest, 'text', 'json')
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    snippet = make_text_snippet(file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(snippet, f, ensure_ascii=False)
+    os.replace(temp, path)
+    return snippet
+
+
+def make_text_snippet(file):
+    """ 读文件开头和末尾的一小段，判断编码并解码，不读中间的部分 """
+    head_size, tail_size = settings.TEXT_PREVIEW_HEAD_SIZE, settings.TEXT_PREVIEW_TAIL_SIZE
+    size = file.size
+    complete = size <= head_size + tail_size
+    with file.open() as f:
+        head = _read_exactly(f, size if complete else head_size)
+        if not complete:
+            f.seek(size - tail_size)
+            tail = _read_exactly(f, tail_size)
+
+    encoding = detect_text_encoding(head, settings.TEXT_PREVIEW_ENCODINGS) or 'latin-1'
+    max_lines = settings.TEXT_PREVIEW_MAX_LINES
+    head_lines = decode_text_window(head, encoding).splitlines()
+    if complete and len(head_lines) <= max_lines:
+        return {'encoding': encoding, 'head': '\n'.join(head_lines), 'tail': '', 'complete': True}
+
+    if not complete and len(head_lines) > 1:
+        head_lines = head_lines[:-1] # 最后一行被截断了
+    tail = '' if complete else decode_text_window(tail, encoding, from_middle=True)
+    return {
+        'encoding': encoding,
+        'head': '\n'.join(head_lines[:max_lines]),
+        'tail': '\n'.join(tail.splitlines()[-max_lines:]),
+        'complete': False,
+    }
+
+
+def _read_exactly(f, n):
+    """ 分块储存的文件每次 read 只读到当前 chunk 的末尾，需要循环读 """
+    data = bytearray()
+    while len(data) < n:
+        chunk = f.read(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def render_text_preview(file):
+    """ 按文件名决定怎么显示摘要，返回 HTML 片段，文件内容都经过转义 """
+    snippet = get_text_snippet(file)
+    ext = os.path.splitext(file.name)[1].lower()
+    head = snippet['head']
+    more = '' if snippet['complete'] else '<p>... ...</p>'
+    title = '<h2>{} 摘要 <small>{}</small></h2>'.format(escape(file.name), escape(snippet['encoding']))
+
+    if ext in ('.csv', '.tsv'):
+        rows = csv.reader(head.splitlines(), delimiter='\t' if ext == '.tsv' else ',')
+        body = ''.join('<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(escape(cell)) for cell in row))
+                       for row in rows)
+        return '{}<table>{}</table>{}'.format(title, body, more)
+
+    if ext == '.json' and snippet['complete']:
+        try:
+            head = json.dumps(json.loads(head), ensure_ascii=False, indent=2)
+        except ValueError:
+            pass
+
+    if snippet['tail']: # 大文件同时显示最后几行，日志最重要的往往在末尾
+        return '{}<pre>{}</pre>{}<pre>{}</pre>'.format(title, escape(head), more, escape(snippet['tail']))
+    return '{}<pre>{}</pre>{}'.format(title, escape(head), more)
@@ -0,0 +1,210 @@
+"""
+    在请求之外运行的后台任务
+    需要依赖 django 环境才能运行
+"""
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import (File, Link, Chunk, FileChunk, OrphanBlob, get_chunk_abspath, get_blob_abspath,
+                     remove_blob)
+from .utils import iter_cdc_chunks
+
+from collections import Counter
+import threading
+import logging
+import hashlib
+import queue
+import uuid
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def reap_orphan_blobs(limit=None):
+    """
+        删除 OrphanBlob 中记录的磁盘文件，返回处理的个数
+        remove_from_disk 会再确认一次没有新的引用，被重新上传的文件不会被删掉
+    """
+    reaped = 0
+    for orphan in OrphanBlob.objects.order_by('datetime')[:limit]:
+        File(digest=orphan.digest).remove_from_disk()
+        orphan.delete()
+        reaped += 1
+    return reaped
+
+
+_reaper_event = threading.Event()
+_reaper_lock = threading.Lock()
+_reaper_thread = None
+
+
+def wake_blob_reaper():
+    """
+        唤醒本进程的后台线程清理 OrphanBlob，线程在第一次调用时启动
+        BLOB_REAPER_THREAD 为 False 时什么也不做，交给定期运行的 fsck 命令清理
+    """
+    global _reaper_thread
+    if not settings.BLOB_REAPER_THREAD:
+        return
+    with _reaper_lock:
+        if _reaper_thread is None or not _reaper_thread.is_alive():
+            _reaper_thread = threading.Thread(target=_reaper_loop, name='blob-reaper', daemon=True)
+            _reaper_thread.start()
+    _reaper_event.set()
+
+
+def _reaper_loop():
+    while True:
+        _reaper_event.wait()
+        _reaper_event.clear()
+        try:
+            while reap_orphan_blobs(limit=100):
+                pass
+        except Exception:
+            logger.exception('清理 OrphanBlob 失败')
+        finally:
+            close_old_connections()
+
+
+###################
+####  分块储存  ####
+###################
+
+def is_chunk_candidate(size):
+    """ CHUNK_STORE 时，这么大的文件需要分块储存 """
+    return settings.CHUNK_STORE and size >= settings.CHUNK_STORE_MIN_FILE_SIZE
+
+
+def store_chunked_blob(digest):
+    """
+        digest: 整个文件的 sha1，File 已经提交，完整的 blob 在服务器上
+
+        按内容定义分块（CDC）切分完整的 blob，新的 chunk 写入 chunks 目录，
+        写好清单之后删除完整的 blob。切分是纯 Python 实现，很慢，所以在请求之外运行，
+        期间下载仍然读完整的 blob
+        返回是否新建了清单；计数已经归零时什么都不做
+
+        切分时不持有任何锁；写清单时锁住 Link，并用加锁的读确认还没有清单，
+        多个线程或者进程同时处理同一个 digest 时只有一个会写清单，不会违反 (digest, index) 的唯一约束
+        已经有清单时（比如同样的内容又上传了一次），只删除多余的完整 blob
+    """
+    if not _has_manifest(digest):
+        manifest = _split_blob(digest)
+        if manifest is None: # 切分之前计数已经归零，blob 被删掉了
+            return False
+    else:
+        manifest = None
+
+    created = False
+    with transaction.atomic():
+        if not Link.objects.select_for_update().filter(digest=digest).exists():
+            return False # 计数归零了，切分时新写的 chunk 没有引用，由 fsck 清理
+        if manifest is not None and not _has_manifest(digest, lock=True):
+            Chunk.add_many(Counter(chunk_digest for chunk_digest, _ in manifest), dict(manifest))
+            items, offset = [], 0
+            for index, (chunk_digest, size) in enumerate(manifest):
+                items.append(FileChunk(digest=digest, index=index, offset=offset, chunk_id=chunk_digest))
+                offset += size
+            FileChunk.objects.bulk_create(items, batch_size=500)
+            created = True
+
+    if created:
+        # 切分时已经存在、没有重写的 chunk 可能在写清单之前刚好被释放删掉了；
+        # 清单提交之后这些 chunk 不会再被删除，再切分一次补上缺的
+        if any(not os.path.exists(Chunk(digest=chunk_digest).get_full_path()) for chunk_digest, _ in manifest):
+            _split_blob(digest)
+
+    # 清单已经提交，打开文件时找不到完整的 blob 会改用清单；
+    # 和 remove_blob 删除时一样先改名再检查：清单刚好被释放了，就把完整的 blob 放回去
+    remove_blob(File(digest=digest).get_full_path(), lambda: not _has_manifest(digest))
+    return created
+
+
+def _has_manifest(digest, lock=False):
+    manifest = FileChunk.objects.filter(digest=digest)
+    if lock: # 等正在释放这份清单的事务结束
+        manifest = manifest.select_for_update()
+    return manifest.exists()
+
+
+def _split_blob(digest):
+    """ 切分完整的 blob，新的 chunk 写入磁盘，返回 [(chunk digest, 大小)]，blob 不在时返回 None """
+    chunk_dir = get_chunk_abspath()
+    manifest = []
+    try:
+        with open(File(digest=digest).get_full_path(), 'rb') as f:
+            chunks = iter_cdc_chunks(f, settings.CHUNK_MIN_SIZE, settings.CHUNK_AVG_SIZE,
+                                     settings.CHUNK_MAX_SIZE)
+            for data in chunks:
+                chunk_digest = hashlib.sha1(data).hexdigest()
+                manifest.append((chunk_digest, len(data)))
+                if not os.path.exists(Chunk(digest=chunk_digest).get_full_path()):
+                    _write_chunk(chunk_dir, chunk_digest, data)
+    except FileNotFoundError:
+        return None
+    return manifest
+
+
+def _write_chunk(chunk_dir, chunk_digest, data):
+    chunk_path = get_blob_abspath(chunk_digest, chunk_dir)
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    chunk_temp = os.path.join(chunk_dir, str(uuid.uuid1()))
+    with open(chunk_temp, 'wb') as destination:
+        destination.write(data)
+        if settings.UPLOAD_FSYNC:
+            destination.flush()
+            os.fsync(destination.fileno())
+    os.replace(chunk_temp, chunk_path)
+
+
+def chunk_pending_blobs(limit=None):
+    """
+        切分还没有分块储存的大文件，由 chunk_blobs 命令调用，返回新建了几份清单
+        要处理的 digest 直接从数据库里查（够大、还没有清单），不需要另外记录队列，
+        进程在切分到一半时退出也不会漏掉
+    """
+    if not settings.CHUNK_STORE:
+        return 0
+    pending = (File.objects.filter(size__gte=settings.CHUNK_STORE_MIN_FILE_SIZE)
+               .exclude(digest__in=FileChunk.objects.values('digest'))
+               .values_list('digest', flat=True).distinct())
+    created = 0
+    for digest in list(pending[:limit]):
+        try:
+            created += store_chunked_blob(digest)
+        except Exception: # 一个文件失败不影响其他文件，下次运行还会再试
+            logger.exception('分块储存 {} 失败'.format(digest))
+    return created
+
+
+_chunk_queue = queue.Queue()
+_chunker_lock = threading.Lock()
+_chunker_thread = None
+
+
+def chunk_blob_later(digest):
+    """
+        交给本进程的后台线程分块储存，线程在第一次调用时启动，只在 CHUNK_STORE_THREAD 为 True 时使用
+        切分时一直占着 GIL，会拖慢同一个进程里的请求，队列也只在内存里，所以默认不用，
+        由 chunk_blobs 命令在 web 进程之外切分；进程在处理完之前退出时，也由 chunk_blobs 补上
+    """
+    global _chunker_thread
+    if not settings.CHUNK_STORE_THREAD:
+        return
+    with _chunker_lock:
+        if _chunker_thread is None or not _chunker_thread.is_alive():
+            _chunker_thread = threading.Thread(target=_chunker_loop, name='blob-chunker', daemon=True)
+            _chunker_thread.start()
+    _chunk_queue.put(digest)
+
+
+def _chunker_loop():
+    while True:
+        digest = _chunk_queue.get()
+        try:
+            store_chunked_blob(digest)
+        except Exception:
+            logger.exception('分块储存 {} 失败'.format(digest))
+        finally:
+            close_old_connections()
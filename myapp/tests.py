@@ -0,0 +1,365 @@
+"""
+    python manage.py test myapp
+
+    多线程的测试需要真正的数据库（MySQL），sqlite 的内存测试库不能同时打开多个连接，会跳过
+"""
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+
+from .handles import find_by_path, list_directory, handle_uploaded_files, LISTING_SORTS
+from .importer import Importer
+from .models import Directory, File, Link, UploadSession, Usage
+
+from datetime import timedelta
+import threading
+import tempfile
+import shutil
+import fcntl
+import os
+
+
+class TempMediaMixin(object):
+    """ 会写磁盘的测试放在临时的 MEDIA_ROOT 里，不碰真正的 media 目录 """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class LinkConcurrencyTest(TransactionTestCase):
+    """ 很多线程同时对同一个 digest 加减计数，计数不能丢，也不能在还有文件时被删掉 """
+
+    threads = 16
+    rounds = 20
+    digest = 'f' * 40
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='password123')
+        self.root = Directory.create_root_dir(self.user)
+
+    def run_threads(self, target):
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker(n):
+            try:
+                barrier.wait() # 所有线程同时开始，尽量撞在一起
+                target(n)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def new_file(self, name):
+        file = File.objects.create(name=name, owner=self.user, parent=self.root, digest=self.digest, size=1)
+        Link.add_one(file)
+        return file
+
+    def test_add_one(self):
+        self.run_threads(lambda n: [self.new_file('{}-{}'.format(n, i)) for i in range(self.rounds)])
+        self.assertEqual(Link.objects.get(digest=self.digest).links, self.threads * self.rounds)
+
+    def test_add_and_minus_one(self):
+        """ 有一个文件一直在，计数不会归零；其余的文件加一之后马上减一 """
+        self.new_file('keep')
+
+        def churn(n):
+            for i in range(self.rounds):
+                file = self.new_file('{}-{}'.format(n, i))
+                Link.minus_one(file)
+
+        self.run_threads(churn)
+        self.assertEqual(Link.objects.get(digest=self.digest).links, 1)
+        self.assertEqual(File.objects.filter(digest=self.digest).count(), 1)
+
+    def test_crossing_zero(self):
+        """ 计数反复归零：计数器被删掉又重新创建，每个文件在被删除之前都要有计数 """
+        missing = []
+
+        def churn(n):
+            for i in range(self.rounds):
+                file = self.new_file('{}-{}'.format(n, i))
+                if not Link.objects.filter(digest=self.digest, links__gte=1).exists():
+                    missing.append(file.pk)
+                Link.minus_one(file)
+
+        self.run_threads(churn)
+        self.assertEqual(missing, [])
+        self.assertFalse(Link.objects.filter(digest=self.digest).exists())
+        self.assertFalse(File.objects.filter(digest=self.digest).exists())
+
+
+class PathLookupQueryTest(TestCase):
+    """ 按 URL 找文件和目录的查询数是固定的，不随路径的深度增加 """
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='password123')
+        self.root = Directory.create_root_dir(self.user)
+        self.client.force_login(self.user)
+
+    def make_path(self, depth):
+        """ 建 depth 层目录，最深的目录里放一个文件，返回 (目录的路径, 文件的路径) """
+        directory = self.root
+        for i in range(depth):
+            directory = directory.create_subdir('{}-{}'.format(depth, i))
+        File.objects.create(name='a.txt', owner=self.user, parent=directory, path=directory.path,
+                            digest='0' * 40, size=1)
+        return directory.path, directory.path + '/a.txt'
+
+    def test_find_by_path(self):
+        for depth in (1, 10):
+            dir_path, file_path = self.make_path(depth)
+            with self.assertNumQueries(1): # 文件优先，找到就不再查目录
+                self.assertEqual(find_by_path(self.user, file_path).name, 'a.txt')
+            with self.assertNumQueries(2):
+                self.assertEqual(find_by_path(self.user, dir_path).path, dir_path)
+
+    def detail_queries(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/alice/' + path)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_detail(self):
+        shallow_dir, shallow_file = self.make_path(1)
+        deep_dir, deep_file = self.make_path(12)
+        self.detail_queries('') # 第一次访问会建 session，不算在内
+        self.assertEqual(self.detail_queries(shallow_file), self.detail_queries(deep_file))
+        self.assertEqual(self.detail_queries(shallow_dir), self.detail_queries(deep_dir))
+
+
+class ListDirectoryTest(TestCase):
+    """ 目录列表用 keyset 分页：每页的查询数固定，翻页不漏也不重 """
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='password123')
+        self.root = Directory.create_root_dir(self.user)
+        self.client.force_login(self.user)
+
+    def fill(self, directory, dirs, files):
+        """ 放 dirs 个子目录和 files 个文件，大小和时间都有重复，排序时要靠 pk 区分 """
+        for i in range(dirs):
+            directory.create_subdir('d{:03}'.format(i))
+        File.objects.bulk_create([
+            File(name='f{:03}'.format(i), owner=self.user, parent=directory, digest='0' * 40, size=i % 3)
+            for i in range(files)])
+        first = File.objects.filter(parent=directory).order_by('pk').first()
+        if first:
+            for n, pk in enumerate(File.objects.filter(parent=directory).values_list('pk', flat=True)):
+                File.objects.filter(pk=pk).update(datetime=first.datetime + timedelta(seconds=n % 4))
+
+    def page_queries(self, directory, cursor=None):
+        with CaptureQueriesContext(connection) as queries:
+            entries, cursor = list_directory(directory, 'alice', cursor=cursor, limit=10)
+        return len(queries), cursor
+
+    def test_queries_per_page(self):
+        small = self.root.create_subdir('small')
+        large = self.root.create_subdir('large')
+        self.fill(small, 5, 20)
+        self.fill(large, 50, 500)
+
+        # 第一页：子目录和文件各一条
+        self.assertEqual(self.page_queries(small)[0], 2)
+        self.assertEqual(self.page_queries(large)[0], 1) # 子目录就够一页了
+
+        # 翻到文件中间的一页：只查文件
+        _, cursor = self.page_queries(small)
+        self.assertEqual(self.page_queries(small, cursor)[0], 1)
+        cursor = None
+        for _ in range(30):
+            _, cursor = self.page_queries(large, cursor)
+        self.assertEqual(self.page_queries(large, cursor)[0], 1)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            self.client.get('/{}/list/'.format(small.pk))
+        with CaptureQueriesContext(connection) as large_queries:
+            self.client.get('/{}/list/'.format(large.pk))
+        self.assertEqual(len(small_queries), len(large_queries))
+
+    def test_index_lists_root(self):
+        """ 登录后的首页就是根目录，和 /alice/ 列出的一样 """
+        File.objects.create(name='root.txt', owner=self.user, parent=self.root, digest='0' * 40, size=1)
+        self.root.create_subdir('sub')
+        for url in ('/', '/alice/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([entry['name'] for entry in response.context['entries']], ['sub', 'root.txt'])
+            self.assertContains(response, 'root.txt')
+
+    def test_cursor_covers_everything(self):
+        self.fill(self.root, 7, 23)
+        for sort in LISTING_SORTS:
+            for reverse in (False, True):
+                expected, cursor = list_directory(self.root, 'alice', sort, reverse, limit=1000)
+                self.assertIsNone(cursor)
+                for limit in (1, 3, 7, 10):
+                    seen, cursor = [], None
+                    while True:
+                        entries, cursor = list_directory(self.root, 'alice', sort, reverse, cursor, limit)
+                        self.assertLessEqual(len(entries), limit)
+                        seen.extend(entries)
+                        if cursor is None:
+                            break
+                    keys = [(entry['kind'], entry['pk']) for entry in seen]
+                    self.assertEqual(keys, [(entry['kind'], entry['pk']) for entry in expected],
+                                     (sort, reverse, limit))
+                self.assertEqual(len(expected), 30)
+
+
+class UploadTargetTest(TempMediaMixin, TestCase):
+    """ 普通上传只能传到自己的目录，用量记在自己头上 """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice', password='password123')
+        self.bob = User.objects.create_user('bob', password='password123')
+        self.alice_root = Directory.create_root_dir(self.alice)
+        self.bob_root = Directory.create_root_dir(self.bob)
+        self.client.force_login(self.alice)
+
+    def upload(self, name, size):
+        return self.client.post('/upload/', {'files': SimpleUploadedFile(name, b'x' * size)})
+
+    @override_settings(USER_QUOTA=3000)
+    def test_other_users_directory(self):
+        self.client.get('/bob/') # session 里的当前目录变成了 bob 的根目录
+        for name in ('a.bin', 'b.bin'): # 每次都没超出 alice 的配额，加起来超出了
+            self.assertEqual(self.upload(name, 2000).status_code, 404)
+        self.assertFalse(File.objects.filter(parent=self.bob_root).exists())
+        self.assertEqual(Usage.get_for(self.bob).size, 0)
+
+    def test_own_directory(self):
+        self.client.get('/alice/')
+        response = self.upload('a.bin', 100)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(File.objects.filter(parent=self.alice_root, name='a.bin').exists())
+        self.assertEqual(Usage.get_for(self.alice).size, 100)
+
+
+class UploadSessionTest(TempMediaMixin, TestCase):
+    """ 断点续传的 PATCH：传输期间不锁数据库里的会话，同一个会话同时只能有一个 PATCH 在写 """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('alice', password='password123')
+        self.root = Directory.create_root_dir(self.user)
+        self.client.force_login(self.user)
+        self.session = UploadSession.objects.create(name='a.bin', owner=self.user, parent=self.root, size=6)
+        self.url = '/upload/sessions/{}/'.format(self.session.pk)
+
+    def patch(self, offset, data):
+        return self.client.generic('PATCH', self.url, data, content_type='application/offset+octet-stream',
+                                   HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_append_and_finalize(self):
+        self.assertEqual(self.patch(0, b'abc')['Upload-Offset'], '3')
+        self.assertEqual(self.patch(0, b'abc').status_code, 409) # offset 已经变了
+        self.assertEqual(self.patch(3, b'def')['Upload-Offset'], '6')
+        response = self.client.post(self.url + 'finalize/')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['digest'], '1f8ac10f23c5b5bc1167bda84b833e5c057a77d2')
+
+    def test_concurrent_patch(self):
+        """ 另一个请求正拿着临时文件的锁在写，这个 PATCH 直接返回 409，不等待 """
+        with open(self.session.get_temp_path(), 'wb') as other:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            response = self.patch(0, b'abc')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '0')
+        self.assertEqual(self.patch(0, b'abc')['Upload-Offset'], '3')
+
+
+class ImportConflictTest(TempMediaMixin, TestCase):
+    """ import_tree 遇到网页上传的同名文件时按 conflict 处理，重复导入不会多出文件 """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('alice', password='password123')
+        self.root = Directory.create_root_dir(self.user)
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source, ignore_errors=True)
+        for name in ('a.txt', 'b.txt'):
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(b'import-' + name.encode())
+        handle_uploaded_files([SimpleUploadedFile('a.txt', b'web')], self.user, self.root)
+
+    def run_import(self, conflict, hook=None):
+        importer = Importer(self.user, self.root, workers=1, conflict=conflict, log=lambda message: None)
+        if hook: # 遍历完之后、写数据库之前插进来的上传
+            prepare_blobs = importer.prepare_blobs
+            importer.prepare_blobs = lambda ready: (prepare_blobs(ready), hook())[0]
+        importer.run(self.source)
+        return importer.stats
+
+    def listing(self):
+        return sorted(File.objects.filter(parent=self.root).values_list('name', 'size'))
+
+    def test_reject(self):
+        for _ in range(2):
+            self.assertEqual(self.run_import('reject')['name_conflicts'], 1)
+            self.assertEqual(self.listing(), [('a.txt', 3), ('b.txt', 12)])
+
+    def test_suffix(self):
+        self.run_import('suffix')
+        suffixed = File.objects.get(parent=self.root, name__startswith='a_')
+        self.assertEqual(self.run_import('suffix')['unchanged'], 2)
+        self.assertEqual(self.listing(), [('a.txt', 3), (suffixed.name, 12), ('b.txt', 12)])
+
+    def test_replace(self):
+        self.run_import('replace')
+        self.assertEqual(self.listing(), [('a.txt', 12), ('b.txt', 12)])
+        self.assertEqual(Link.objects.filter(links__gt=0).count(), 2) # 网页上传的内容不再被引用
+
+    def test_upload_during_import(self):
+        """ 写数据库时撞上唯一索引，退回到逐个插入，没撞上的照常插入 """
+        upload = lambda: handle_uploaded_files([SimpleUploadedFile('b.txt', b'web-b')], self.user, self.root)
+        stats = self.run_import('suffix', hook=upload)
+        self.assertEqual(stats['created'], 2)
+        names = [name for name, size in self.listing()]
+        self.assertEqual(len(names), 4)
+        self.assertIn('b.txt', names)
+        self.assertEqual(Usage.get_for(self.user).size, 3 + 5 + 12 + 12)
+
+
+class OwnerScopeTest(TestCase):
+    """ 按 pk 操作目录和文件的页面只认自己的东西，别人的 pk 一律 404 """
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='password123')
+        self.bob = User.objects.create_user('bob', password='password123')
+        Directory.create_root_dir(self.alice)
+        bob_root = Directory.create_root_dir(self.bob)
+        self.directory = bob_root.create_subdir('sub')
+        self.file = File.objects.create(name='a.txt', owner=self.bob, parent=bob_root, digest='0' * 40, size=1)
+        Link.add_one(self.file)
+        self.client.force_login(self.alice)
+
+    def test_other_users_objects(self):
+        directory_urls = ['/{}/mkdir/', '/{}/mvdir/', '/{}/rmdir/']
+        file_urls = ['/{}/edit/', '/{}/delete/']
+        for urls, pk in ((directory_urls, self.directory.pk), (file_urls, self.file.pk)):
+            for url in urls:
+                url = url.format(pk)
+                self.assertEqual(self.client.get(url).status_code, 404, url)
+                self.assertEqual(self.client.post(url, {'name': 'x', 'target': '', 'confirm': 'y'}).status_code,
+                                 404, url)
+        self.assertTrue(Directory.objects.filter(pk=self.directory.pk, name='sub').exists())
+        self.assertFalse(Directory.objects.filter(parent=self.directory).exists())
+        self.assertTrue(File.objects.filter(pk=self.file.pk, name='a.txt').exists())
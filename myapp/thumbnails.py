@@ -0,0 +1,148 @@
+"""
+    缩略图
+    按 digest 和尺寸缓存在磁盘上，内容相同的文件共用缩略图，同一张缩略图只生成一次
+
+    解码大图片很耗 CPU 和内存，所以放到单独的进程池里生成：
+    同时解码的图片数不超过 THUMBNAIL_WORKERS，排队的不超过 THUMBNAIL_MAX_PENDING，
+    像素数超过 THUMBNAIL_MAX_PIXELS 的图片不解码
+"""
+
+from django.conf import settings
+
+from PIL import Image, ImageOps, features
+
+from .models import get_thumbnail_abspath
+from .utils import ConcatFile
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import threading
+import uuid
+import io
+import os
+
+
+class ThumbnailBusy(Exception):
+    """ 排队生成的缩略图太多，或者等待超时 """
+
+
+_executor = None
+_lock = threading.RLock() # 已经完成的 future 会在 add_done_callback 里同步调用回调
+_pending = {} # (digest, size) -> Future，同一张缩略图同时只生成一次
+_slots = None
+
+
+def get_thumbnail_format():
+    """ 返回 (Pillow 的格式名, 扩展名)，Pillow 不支持 WebP 时退回 JPEG """
+    if settings.THUMBNAIL_FORMAT == 'WEBP' and features.check('webp'):
+        return 'WEBP', 'webp'
+    return 'JPEG', 'jpg'
+
+
+def get_thumbnail(file, size):
+    """
+        返回 file 在 size 尺寸下的缩略图的服务器路径，没有缓存时在进程池里生成
+        不是图片、图片太大或者解码失败时返回 None；排队太多或者等待超时抛出 ThumbnailBusy
+    """
+    global _slots
+    fmt, ext = get_thumbnail_format()
+    path = get_thumbnail_abspath(file.digest, size, ext)
+    try:
+        return path if os.path.getsize(path) else None # 空文件表示生成失败过，不再重试
+    except FileNotFoundError:
+        pass
+
+    key = (file.digest, size)
+    with _lock:
+        future = _pending.get(key)
+        if future is None:
+            if _slots is None:
+                _slots = threading.BoundedSemaphore(settings.THUMBNAIL_MAX_PENDING)
+            if not _slots.acquire(blocking=False):
+                raise ThumbnailBusy
+            try:
+                future = _submit(file.get_parts(), path, size, fmt)
+            except Exception: # 没有提交成功就不会有 _finish 来释放名额
+                _slots.release()
+                raise
+            _pending[key] = future
+            future.add_done_callback(partial(_finish, key))
+    try:
+        return path if future.result(timeout=settings.THUMBNAIL_TIMEOUT) else None
+    except TimeoutError: # 缩略图仍然会在后台生成好，下次请求直接读缓存
+        raise ThumbnailBusy
+    except BrokenProcessPool: # 工作进程被杀掉了（比如解码时内存超限），这次不生成，下次用新的进程池重试
+        _discard_executor(future.executor)
+        return None
+
+
+def _submit(parts, path, size, fmt):
+    """ 提交给进程池，进程池已经坏掉时换一个新的再提交一次 """
+    args = (render_thumbnail, parts, path, size, fmt, settings.THUMBNAIL_QUALITY, settings.THUMBNAIL_MAX_PIXELS)
+    executor = _get_executor()
+    try:
+        future = executor.submit(*args)
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        executor = _get_executor()
+        future = executor.submit(*args)
+    future.executor = executor # 结果是 BrokenProcessPool 时用来确认坏掉的是哪个进程池
+    return future
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS)
+        return _executor
+
+
+def _discard_executor(executor):
+    """
+        丢掉坏掉的进程池，下次 _get_executor 时新建
+        一个工作进程异常退出后整个 ProcessPoolExecutor 都不能再用，不重建的话以后所有的缩略图都会失败
+        同时有多个请求发现时只丢一次，不会把别人刚建好的新进程池也丢掉
+    """
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _finish(key, future):
+    with _lock:
+        _pending.pop(key, None)
+        _slots.release()
+
+
+def render_thumbnail(parts, dest, size, fmt, quality, max_pixels):
+    """
+        在进程池里运行，不依赖 django
+        parts: File.get_parts() 的返回值
+        dest: 缩略图的服务器路径
+
+        先写入临时文件再改名，其他进程不会读到写了一半的缩略图
+        返回是否生成成功；失败时写入空文件，以后不再重试
+    """
+    Image.MAX_IMAGE_PIXELS = max_pixels # 超过两倍时 Pillow 直接拒绝打开
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp = '{}.tmp-{}'.format(dest, uuid.uuid4().hex)
+    ok = True
+    try:
+        with io.BufferedReader(ConcatFile(parts)) as f, Image.open(f) as img:
+            if img.width * img.height > max_pixels: # Image.open 只读文件头，还没有解码
+                raise ValueError('too many pixels')
+            img.draft('RGB', (size, size)) # JPEG 可以直接按 1/2、1/4、1/8 缩小解码
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size), Image.LANCZOS)
+            if img.mode not in ('RGB', 'RGBA') or (fmt == 'JPEG' and img.mode != 'RGB'):
+                img = img.convert('RGBA' if fmt != 'JPEG' and 'A' in img.getbands() else 'RGB')
+            img.save(temp, fmt, quality=quality)
+    except Exception: # 不是图片、图片损坏或者太大，都只是不能生成缩略图
+        ok = False
+        open(temp, 'wb').close()
+    os.replace(temp, dest)
+    return ok
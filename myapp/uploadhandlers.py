@@ -0,0 +1,108 @@
+"""
+    上传文件的 upload handler
+    django 默认把超过 2.5MB 的文件先写到 /tmp，handle_uploaded_files 再读出来写一遍到 media 目录；
+    这里在解析 multipart 的同时直接写入 media 目录下的临时文件并计算 sha1，
+    之后只需要把临时文件链接到 digest 对应的位置，每个文件只写一次磁盘，也不用再读一遍
+
+    需要在读取 request.POST / request.FILES 之前装上，见 use_hashing_upload_handler
+"""
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .models import get_media_abspath
+
+import hashlib
+import uuid
+import os
+
+
+class HashingUploadedFile(UploadedFile):
+    """
+        已经写入 media 目录下临时文件的上传文件，digest 是 sha1，head 是文件开头一段
+        读取时才打开文件，上传几千个小文件也不会占用几千个文件描述符
+
+        请求结束时 django 会 close 所有上传文件，临时文件如果没有被 handle_uploaded_files
+        接手（saved 为 False，比如表单验证失败），在这时删除
+    """
+
+    def __init__(self, path, name, content_type, size, charset, content_type_extra, digest, head):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.path = path
+        self.digest = digest
+        self.head = head
+        self.saved = False
+
+    def temporary_file_path(self):
+        return self.path
+
+    def open(self, mode='rb'):
+        if self.file is None or self.file.closed:
+            self.file = open(self.path, mode)
+        else:
+            self.file.seek(0)
+        return self
+
+    def read(self, *args, **kwargs):
+        if self.file is None:
+            self.open()
+        return self.file.read(*args, **kwargs)
+
+    def readinto(self, b):
+        if self.file is None:
+            self.open()
+        return self.file.readinto(b)
+
+    def seek(self, *args):
+        if self.file is None:
+            self.open()
+        return self.file.seek(*args)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if not self.saved:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class HashingFileUploadHandler(FileUploadHandler):
+    """
+        每个文件写入 media 目录下 uuid 命名的临时文件，同时计算 sha1，
+        并留下开头 PREVIEW_SNIFF_SIZE 字节用来判断文件类型
+        上传中断时留下的临时文件由 fsck 命令清理
+        这里不 fsync，大多数上传的内容服务器上已经有了，临时文件马上会被删掉；
+        新的 blob 由 place_blob 在放到 digest 对应的位置时 fsync 一次
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.chunk_size = settings.UPLOAD_CHUNK_SIZE # 每个请求读一次设置，不在 import 时固定下来
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.path = os.path.join(get_media_abspath(), str(uuid.uuid1()))
+        self.file = open(self.path, 'wb') # 叫 file，请求解析失败时 django 会负责关闭
+        self.digest = hashlib.sha1()
+        self.head = bytearray()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.digest.update(raw_data)
+        if len(self.head) < settings.PREVIEW_SNIFF_SIZE:
+            self.head += raw_data[:settings.PREVIEW_SNIFF_SIZE - len(self.head)]
+        return None # 后面的 handler 不需要再处理这块数据
+
+    def file_complete(self, file_size):
+        self.file.close()
+        return HashingUploadedFile(self.path, self.file_name, self.content_type, file_size,
+                                   self.charset, self.content_type_extra,
+                                   self.digest.hexdigest(), bytes(self.head))
+
+
+def use_hashing_upload_handler(request):
+    """ 在 view 里、读取 request.POST 之前调用，这个请求的上传文件改用 HashingFileUploadHandler """
+    request.upload_handlers = [HashingFileUploadHandler(request)]
@@ -1,5 +1,5 @@
 from django.conf.urls import url
-from . import views
+from . import views, api
 
 app_name = 'myapp'
 
@@ -12,13 +12,32 @@ urlpatterns = [
     url(r'^login/', views.login, name='login'),
     url(r'^logout/', views.logout, name='logout'),
     url(r'^captcha/', views.captcha, name='captcha'),    
+    # 断点续传，要放在 upload/ 前面
+    url(r'^upload/sessions/$', views.upload_session_create, name='upload_session_create'),
+    url(r'^upload/sessions/(?P<pk>[0-9a-f-]+)/$', views.upload_session, name='upload_session'),
+    url(r'^upload/sessions/(?P<pk>[0-9a-f-]+)/finalize/$', views.upload_session_finalize,
+        name='upload_session_finalize'),
+    url(r'^upload/preflight/$', views.upload_preflight, name='upload_preflight'), # 秒传
     url(r'^upload/', views.upload, name='upload'),
     url(r'^download/(?P<pk>\d+)', views.download, name='download'),
     url(r'^preview/(?P<pk>\d+)', views.preview, name='preview'),
+    url(r'^thumbnail/(?P<pk>\d+)/(?P<size>\d+)/$', views.thumbnail, name='thumbnail'),
+    url(r'^(?P<pk>\d+)/list/$', views.listing, name='listing'), # 目录列表，JSON
     url(r'^(?P<pk>\d+)/mkdir/', views.mkdir, name='mkdir'), # 创建目录
+    url(r'^(?P<pk>\d+)/mvdir/', views.mvdir, name='mvdir'), # 移动或重命名目录
     url(r'^(?P<pk>\d+)/rmdir/', views.rmdir, name='rmdir'), # 递归地删除目录
+    url(r'^(?P<pk>\d+)/archive/$', views.archive, name='archive'), # 打包下载整个目录
     url(r'^(?P<pk>\d+)/edit', views.edit, name='edit'), # 编辑文件
     url(r'^(?P<pk>\d+)/delete', views.delete, name='delete'), # 编辑文件
+    # JSON API，见 api.py
+    url(r'^api/v1/stat/$', api.stat, name='api_stat'),
+    url(r'^api/v1/dirs/$', api.dir_create, name='api_dir_create'),
+    url(r'^api/v1/dirs/(?P<pk>\d+)/$', api.dir_detail, name='api_dir'),
+    url(r'^api/v1/dirs/(?P<pk>\d+)/files/$', api.dir_upload, name='api_upload'),
+    url(r'^api/v1/dirs/(?P<pk>\d+)/archive/$', api.dir_archive, name='api_archive'),
+    url(r'^api/v1/files/(?P<pk>\d+)/$', api.file_detail, name='api_file'),
+    url(r'^api/v1/files/(?P<pk>\d+)/content/$', api.file_content, name='api_file_content'),
+    url(r'^api/v1/batch/$', api.batch, name='api_batch'),
     # 既是文件详情页，又是目录的详情页
     # 因为可以容纳的 URL pattern 类型非常多，所以一定要放到最后
     url(r'^(?P<username>[_\da-zA-Z]+)/(?P<path>.*)', views.detail, name='detail'),    
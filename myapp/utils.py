@@ -4,8 +4,14 @@
 """
 
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
+import functools
+import hashlib
 import random
 import string
+import bisect
+import codecs
+import time
+import io
 import os
 
 def get_captcha_text():
@@ -15,6 +21,13 @@ def get_captcha_text():
     chars = list(string.ascii_uppercase + string.digits)
     return random.sample(chars, 4)
 
+@functools.lru_cache()
+def get_captcha_font(size=25):
+    """ 字体文件在每个进程里只读取一次 """
+    app_dir = os.path.dirname(__file__)
+    font_path = os.path.join(app_dir, 'static/myapp/fonts/Andale_Mono')
+    return ImageFont.truetype(font_path, size)
+
 def get_captcha_image(captcha_text):
     """
         captcha_text: 长度为 4 的字母或者数字字符串
@@ -29,10 +42,8 @@ def get_captcha_image(captcha_text):
      #实例化一支画笔
     draw1=ImageDraw.Draw(img1,mode="RGB")
 
-    #定义要使用的字体，先获取字体文件的路径
-    app_dir = os.path.dirname(__file__)
-    font_path = os.path.join(app_dir, 'static/myapp/fonts/Andale_Mono')
-    font1 = ImageFont.truetype(font_path, 25)
+    #定义要使用的字体，只在第一次用到时读取字体文件
+    font1 = get_captcha_font(25)
 
     for i in range(4):
 
@@ -54,9 +65,284 @@ def get_captcha_image(captcha_text):
               float(random.randint(1, 2)) / 500
               ]
     img1 = img1.transform(size, Image.PERSPECTIVE, params)
-    img1 = img1.filter(ImageFilter.EDGE_ENHANCE_MORE)        
+    img1 = img1.filter(ImageFilter.EDGE_ENHANCE_MORE)
     return img1
 
+def render_captcha_png(captcha_text):
+    """ 返回验证码图片的 PNG bytes """
+    stream = io.BytesIO()
+    get_captcha_image(captcha_text).save(stream, format='png')
+    return stream.getvalue()
+
+
+def parse_range_header(header, size):
+    """
+        header: HTTP Range 头的值，如 'bytes=0-499,1000-'
+        size: 文件总长度
+        返回 [(start, end), ...]，end 包含在内
+
+        头部不存在或者格式不对时返回 None，此时按整个文件处理；
+        所有区间都落在文件之外时返回 []，此时应返回 416
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if start == '': # 后缀区间，如 bytes=-500 表示最后 500 字节
+                length = int(end)
+                start, end = max(size - length, 0), size - 1
+                if length <= 0 or start > end:
+                    continue
+            else:
+                start = int(start)
+                if end:
+                    end = int(end)
+                    if end < start: # 语法错误，整个 Range 头作废
+                        return None
+                else:
+                    end = size - 1
+                if start >= size:
+                    continue
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+    return ranges
+
+
+def iter_file_range(opener, start, length, chunk_size):
+    """
+        opener: 无参数的函数，返回一个可以 seek 的二进制文件对象
+        按 chunk_size 分块读出文件中 [start, start + length) 这一段
+        文件在第一次迭代时才打开，迭代结束或被 close 时自动关闭
+    """
+    with opener() as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class ConcatFile(io.RawIOBase):
+    """
+        把多个文件按顺序拼接成一个只读的文件对象，支持 seek
+        parts: [(offset, size, filename), ...]，按 offset 排好序
+
+        每次 read 最多只读到当前这一段的末尾，和普通的 RawIOBase 一样，
+        调用者需要循环读取
+    """
+
+    def __init__(self, parts):
+        super().__init__()
+        self.parts = parts
+        self.offsets = [offset for offset, _, _ in parts]
+        self.size = parts[-1][0] + parts[-1][1] if parts else 0
+        self.pos = 0
+        self._current = None # (段序号, 打开的文件)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        self.pos = max(pos, 0)
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.pos) - 1
+        offset, size, filename = self.parts[index]
+        if self._current is None or self._current[0] != index:
+            self._close_current()
+            self._current = (index, open(filename, 'rb'))
+        f = self._current[1]
+        f.seek(self.pos - offset)
+        n = f.readinto(memoryview(b)[:offset + size - self.pos])
+        self.pos += n
+        return n
+
+    def _close_current(self):
+        if self._current is not None:
+            self._current[1].close()
+            self._current = None
+
+    def close(self):
+        self._close_current()
+        super().close()
+
+
+# FastCDC 的 gear 表，由 sha1 生成，保证不同进程、不同版本切出来的 chunk 一致
+_GEAR = [int.from_bytes(hashlib.sha1(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+def cdc_cut_point(data, min_size, avg_size, max_size):
+    """
+        FastCDC：返回 data 中第一个切分点
+        前 min_size 字节不计算 hash；达到 avg_size 之前用更严格的 mask，
+        之后用更宽松的 mask，使 chunk 大小集中在 avg_size 附近
+        data 不足 max_size 时（文件末尾）可能返回 len(data)
+    """
+    n = len(data)
+    if n <= min_size:
+        return n
+    bits = avg_size.bit_length() - 1
+    mask_s = ((1 << (bits + 2)) - 1) << (64 - bits - 2) # 取高位，受最近 64 个字节影响
+    mask_l = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    end = min(n, max_size)
+    normal = min(avg_size, end)
+    gear = _GEAR
+    h = 0
+    i = min_size
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not h & mask_s:
+            return i
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not h & mask_l:
+            return i
+    return end
+
+
+def iter_cdc_chunks(f, min_size, avg_size, max_size):
+    """
+        f: 二进制文件对象
+        按内容定义分块（CDC）切分整个文件，依次返回每个 chunk 的 bytes
+        同样的内容无论前面插入或删除了多少字节，都会切出同样的 chunk
+    """
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size: # 保证切分点不是因为缓冲区不够长
+            data = f.read(max(max_size, 1024 * 1024))
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        cut = cdc_cut_point(buf, min_size, avg_size, max_size)
+        yield bytes(buf[:cut])
+        del buf[:cut]
+
+
+def iter_files_sorted(root, start_after=None, skip=()):
+    """
+        root: 要遍历的目录
+        start_after: 上次遍历到的相对路径，这个路径以及之前的文件都跳过
+        skip: 不进入的目录（绝对路径）
+
+        逐级按名字排序遍历 root 下的所有文件，返回 (相对路径, os.DirEntry)
+        顺序固定，所以可以记住上次的位置，分多次遍历完；
+        完全在 start_after 之前的目录直接跳过，不会再列出里面的文件
+    """
+    after = tuple(start_after.split('/')) if start_after else ()
+
+    def walk(dirpath, parts):
+        with os.scandir(dirpath) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            path = parts + (entry.name,)
+            if after and path < after[:len(path)]:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in skip:
+                    yield from walk(entry.path, path)
+            elif path > after:
+                yield '/'.join(path), entry
+
+    if os.path.isdir(root):
+        yield from walk(root, ())
+
+
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'), # 要放在 UTF-16 前面，两者的 BOM 开头一样
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def detect_text_encoding(data, encodings=('utf-8', 'gb18030')):
+    """
+        data: 文件开头的一段字节
+        encodings: 按顺序尝试的编码
+        有 BOM 时按 BOM 判断，否则返回第一个能解码 data 的编码，都不行时返回 None
+        data 末尾可能截断了一个多字节字符，所以用增量解码，末尾不完整的字符不算错
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+    for encoding in encodings:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(data, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def decode_text_window(data, encoding, from_middle=False):
+    """
+        解码从文件中截取的一段字节，不要求两头是完整的字符
+        末尾不完整的字符直接丢掉；from_middle 为 True 时这一段不是从文件开头截取的，
+        开头可能是半个字符，最多跳过 3 个字节找到能解码的位置，再丢掉不完整的第一行
+    """
+    for skip in range(4 if from_middle else 1):
+        try:
+            text = codecs.getincrementaldecoder(encoding)().decode(data[skip:], final=False)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        text = codecs.getincrementaldecoder(encoding)('replace').decode(data, final=False)
+    if from_middle and '\n' in text:
+        text = text.split('\n', 1)[1]
+    return text
+
+
+class RateLimiter(object):
+    """
+        令牌桶限速，rate 为每秒允许的数量（次数或者字节数），0 表示不限制
+        用于在线上运行的后台任务，避免占满磁盘 IO
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+
+    def consume(self, amount=1):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        self.allowance -= amount
+        if self.allowance < 0: # 透支了，睡到补回来为止
+            time.sleep(-self.allowance / self.rate)
+
 
 if __name__ == '__main__':
     """ 测试代码 """
@@ -1,26 +1,37 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.http import (HttpResponse, StreamingHttpResponse, Http404,
+                         JsonResponse, HttpResponseNotAllowed)
+from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.db.models import F
-
-from .utils import get_captcha_image, get_captcha_text
-from .handles import (handle_uploaded_files, set_captcha_to_session,
-                      get_session_data, set_session_data)
+from django.views.decorators.http import require_POST
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from .archives import get_archive_response, ARCHIVE_FORMATS, COMPRESSIONS
+from .captcha import get_captcha
+from .handles import (handle_uploaded_files, set_captcha, check_captcha,
+                      get_session_data, set_session_data, get_download_response,
+                      get_thumbnail_response, get_file_type,
+                      append_upload_chunk, finalize_upload_session,
+                      discard_upload_session, find_stored_blob, create_file_object,
+                      make_preflight_challenge, check_preflight_sample, check_quota,
+                      list_directory, get_listing_args, find_by_path, get_conflict_arg)
+from .previews import is_text, render_text_preview
+from .tasks import wake_blob_reaper
+from .uploadhandlers import use_hashing_upload_handler
 from .forms import (LoginForm, SignupForm, UploadForm, 
-                    EditForm, CreateDirectoryForm, ConfirmForm)
-from .models import Directory, File, Link, get_media_abspath
+                    EditForm, CreateDirectoryForm, MoveDirectoryForm, ConfirmForm)
+from .models import (Directory, File, Link, UploadSession, Usage, NameConflict,
+                     get_media_abspath, get_path_hash)
 
-import mimetypes
-from io import BytesIO
-from urllib.parse import quote
 import os
+import re
 
-# you need 'brew install libmagic' under Mac OS
-import magic
 
 """
     根目录用 '' 表示，以去除 URL 中多余的 / 符号
@@ -40,14 +51,11 @@ def index(request):
         每次访问 index 更改目录时，session data 随之改变
     """
     user = request.user
-    form = UploadForm()
     try:
         directory = user.directory_set.filter(parent=None)[0] # 根目录
     except IndexError: # 没有根目录要创建一个
         directory = Directory.create_root_dir(user)
-    set_session_data(request, 'directory', directory.pk)
-    context = {'user': user, 'form': form, 'directory': directory}
-    return render(request, 'myapp/index.html', context=context)
+    return render_directory(request, user, directory)
 
 
 @login_required
@@ -61,36 +69,35 @@ def detail(request, username, path=''):
             detail(path) 包含了文件名，因为是 URL
     """
     user = get_object_or_404(User, username=username)
-    file = File.objects.filter(owner=user, path=os.path.dirname(path), name=os.path.basename(path))
-    directory = Directory.objects.filter(owner=user, path=path)
-    form = UploadForm()
-
-    if file and file.count() == 1:
-        file = file[0]
-        context = {'user': user, 'file': file, 'is_file': True}
-    elif directory and directory.count() == 1:
-        directory = directory[0]
-        set_session_data(request, 'directory', directory.pk)
-        context = {'user': user, 'form': form, 'directory': directory, 'is_file': False}
-    elif directory.count() == 0: # 主目录被删了，自动新建
-        directory = Directory.create_root_dir(user)
-        context = {'user': user, 'form': form, 'directory': directory, 'is_file': False}
-    else:
-        import pdb; pdb.set_trace()
-        raise Http404
 
-    
+    found = find_by_path(user, path)
+    if isinstance(found, File):
+        context = {'user': user, 'file': found, 'is_file': True}
+        return render(request, 'myapp/index.html', context)
+
+    directory = found
+    if directory is None:
+        if path: # 不存在的路径
+            raise Http404
+        directory = Directory.create_root_dir(user) # 主目录被删了，自动新建
+    return render_directory(request, user, directory)
+
+
+def render_directory(request, user, directory):
+    """ 目录页：记下当前目录，列出第一页（或者 after 指定的那一页） """
+    set_session_data(request, 'directory', directory.pk)
+    sort, reverse, cursor, limit = get_listing_args(request)
+    entries, next_cursor = list_directory(directory, user.username, sort, reverse, cursor, limit)
+    context = {'user': user, 'form': UploadForm(), 'directory': directory, 'is_file': False,
+               'usage': Usage.get_for(user), 'entries': entries, 'next_cursor': next_cursor,
+               'sort': sort, 'order': 'desc' if reverse else 'asc'}
     return render(request, 'myapp/index.html', context)
 
 
+
 def login(request):
     
     next_url = request.GET.get('next', reverse('myapp:index'))
-    key = request.session.session_key
-    try:
-        real_captcha = request.session[key].get('captcha')
-    except KeyError:
-        real_captcha = ''
 
     if request.method == 'POST':
         form = LoginForm(request.POST)
@@ -100,7 +107,7 @@ def login(request):
             captcha = form.cleaned_data['captcha'].lower()
 
             # 判断验证码是否正确
-            if real_captcha == captcha:
+            if check_captcha(request, captcha):
                 user = auth.authenticate(username=username, password=password)
                 if user is not None and user.is_active:
                     auth.login(request, user)
@@ -146,19 +153,19 @@ def signup(request):
 
 def captcha(request):
     """ 
-        验证码保存在 session 数据中，如果随意产生 session，会使得用户退出登录
+        CAPTCHA_STATELESS 为 True 时，验证码的答案签名后放在 cookie 里，不碰 session；
+        否则验证码保存在 session 数据中，如果随意产生 session，会使得用户退出登录
         因此，需要在 user 的现有 session 中添加，而不是创建 session。
         如果 user 没有带任何 session，那么创建。
     """
 
-    # 自动产生 4 位的验证码，确保是小写
-    cap_text = get_captcha_text()
-    # 验证码保存到 session 并产生图片
-    set_captcha_to_session(request, cap_text)
-    cap_img = get_captcha_image(cap_text)
-    cap_stream = BytesIO()
-    cap_img.save(cap_stream, format='png')
-    return HttpResponse(cap_stream.getvalue(), content_type="image/png")
+    # 从验证码池里取出预先渲染好的 4 位验证码和图片
+    cap_text, cap_png = get_captcha()
+    response = HttpResponse(cap_png, content_type="image/png")
+    response['Cache-Control'] = 'no-store'
+    # 验证码保存到签名的 cookie 或者 session
+    set_captcha(request, response, cap_text)
+    return response
 
 ###################
 ####  目录操作  ####
@@ -170,7 +177,7 @@ def mkdir(request, pk):
         创建目录
     """
 
-    current_dir = Directory.objects.get(pk=pk)
+    current_dir = get_object_or_404(Directory, pk=pk, owner=request.user)
 
     user = request.user
 
@@ -180,21 +187,46 @@ def mkdir(request, pk):
     elif request.method == 'POST':
         form = CreateDirectoryForm(request.POST)
         if form.is_valid():
-            name = form.cleaned_data['name']
-            new_dir = Directory.objects.create(
-                name = name,
-                owner = user,
-                parent = current_dir,
-                path = os.path.join(current_dir.path, name),
-            )
-            # 作为 url 参数的时候，去掉最开头的 '/' ，以免变成 username//test 难看
-            return redirect('myapp:detail', username=user.username, path=new_dir.path)
+            try:
+                new_dir = current_dir.create_subdir(form.cleaned_data['name'])
+            except NameConflict as e:
+                form.add_error('name', str(e))
+            else:
+                # 作为 url 参数的时候，去掉最开头的 '/' ，以免变成 username//test 难看
+                return redirect('myapp:detail', username=user.username, path=new_dir.path)
     return render(request, 'myapp/mkdir.html', {'form': form, 'directory': current_dir})
 
+@login_required
+def mvdir(request, pk):
+    """
+        移动或者重命名目录，子目录和文件跟着一起移动
+    """
+    directory = get_object_or_404(Directory, pk=pk, owner=request.user)
+    user = request.user
+
+    if request.method == 'GET':
+        form = MoveDirectoryForm({'name': directory.name, 'target': directory.parent.path if directory.parent else ''})
+
+    elif request.method == 'POST':
+        form = MoveDirectoryForm(request.POST)
+        if form.is_valid():
+            target = form.cleaned_data['target']
+            parent = Directory.objects.filter(owner=user, path_hash=get_path_hash(target), path=target).first()
+            if parent is None:
+                form.add_error('target', '抱歉，目标目录不存在')
+            else:
+                try:
+                    directory.move(parent, form.cleaned_data['name'])
+                except ValueError as e:
+                    form.add_error(None, str(e))
+                else:
+                    return redirect('myapp:detail', username=user.username, path=directory.path)
+    return render(request, 'myapp/mvdir.html', {'form': form, 'directory': directory})
+
 @login_required
 def rmdir(request, pk):
     """ 删除目录和下面的文件、子目录 """
-    directory = get_object_or_404(Directory, pk=pk)
+    directory = get_object_or_404(Directory, pk=pk, owner=request.user)
     parent = directory.parent
 
     if request.method == 'GET':
@@ -212,6 +244,7 @@ def rmdir(request, pk):
             confirm = form.cleaned_data['confirm']
             if confirm == 'y':
                 directory.rmdir()
+                wake_blob_reaper() # 磁盘文件交给后台线程删除
                 if parent: 
                     return redirect(parent.get_url())
                 else: # parent 是空，说明用户删除了整个家目录，那么回首页并创建一个空的家目录
@@ -220,48 +253,217 @@ def rmdir(request, pk):
                 return redirect(directory.get_url())
 
 
+@login_required
+def archive(request, pk):
+    """
+        把整个目录打包下载，边打包边发送
+        Query String:
+        format=zip|tar         默认 zip
+        compression=auto|store|deflate  ZIP 的压缩方式，默认 auto，已经压缩过的文件不再压缩
+    """
+    directory = get_object_or_404(Directory, pk=pk, owner=request.user)
+    fmt = request.GET.get('format', 'zip')
+    compression = request.GET.get('compression', 'auto')
+    if fmt not in ARCHIVE_FORMATS or compression not in COMPRESSIONS:
+        raise Http404
+    return get_archive_response(directory, fmt, compression)
+
+
 ###################
 ####  文件操作  ####
 ###################
 
 @login_required
+@csrf_exempt
 def upload(request):
+    """ 先换上 HashingFileUploadHandler，再检查 CSRF，CsrfViewMiddleware 会提前解析请求体 """
+    use_hashing_upload_handler(request)
+    return _upload(request)
+
+
+@csrf_protect
+def _upload(request):
 
     if request.method == 'POST':
         owner = request.user
         dir_pk = get_session_data(request, 'directory')
-        directory = Directory.objects.get(pk=dir_pk)
+        # session 里的目录可能是浏览别人的页面时记下的，只能传到自己的目录，配额也是按自己算的
+        directory = get_object_or_404(Directory, pk=dir_pk, owner=owner)
 
         form = UploadForm(request.POST, request.FILES)
         if form.is_valid():
             files = request.FILES.getlist('files')
+            conflict = form.cleaned_data['conflict'] or settings.UPLOAD_NAME_CONFLICT
 
-            handle_uploaded_files(files, owner, directory)
+            try:
+                handle_uploaded_files(files, owner, directory, conflict)
+            except NameConflict as e:
+                return HttpResponse(str(e), status=409)
             return redirect('myapp:detail', username=owner.username, path=directory.path)
         
     return redirect('myapp:index')
 
 
+###################
+####  断点续传  ####
+###################
+
+def _upload_session_response(session, status=200):
+    response = JsonResponse(session.to_dict(), status=status)
+    response['Upload-Offset'] = str(session.offset)
+    response['Upload-Length'] = str(session.size)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
 @login_required
-def download(request, pk):
-    """ 一般是下载，当附带 preview=True query string 时为预览 """    
-
-    file = get_object_or_404(File, pk=pk)
-    buf = open(file.get_full_path(), 'rb')
-    response = HttpResponse(buf)   
-    response['Content-Length'] = str(file.size)
-
-    if request.GET.get('preview'):
-        filetype = mimetypes.guess_type(file.name)[0]
-        if not filetype:
-           filetype = 'application/octet-stream'   
-        response['Content-Type'] = filetype
-    else:
-        response['Content-Type'] = 'application/force-download'
-        response['Content-Disposition'] = 'attachment; filename={}'.format(quote(file.name))
+@require_POST
+def upload_session_create(request):
+    """
+        新建断点续传会话
+        POST: name 文件名，size 文件总大小，directory 目录 pk（可选，默认当前目录）
+              conflict 重名时怎么办（可选），见 handles.NAME_CONFLICTS
+    """
+    name = request.POST.get('name', '').strip()
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = -1
+    if not name or size < 0:
+        return JsonResponse({'error': '需要提供文件名 name 和文件大小 size'}, status=400)
+    try:
+        conflict = get_conflict_arg(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    dir_pk = request.POST.get('directory') or get_session_data(request, 'directory')
+    directory = get_object_or_404(Directory, pk=dir_pk, owner=request.user)
+    if not check_quota(request.user, size):
+        return JsonResponse({'error': '抱歉，空间不足'}, status=413)
+
+    session = UploadSession.objects.create(
+        name = name,
+        owner = request.user,
+        parent = directory,
+        size = size,
+        conflict = conflict,
+    )
+    response = _upload_session_response(session, status=201)
+    response['Location'] = reverse('myapp:upload_session', args=[session.pk])
     return response
 
 
+@login_required
+def upload_session(request, pk):
+    """
+        GET / HEAD: 查询已经上传了多少字节
+        PATCH: 请求头 Upload-Offset 必须等于已上传的字节数，请求体追加到文件末尾
+        DELETE: 放弃上传
+    """
+    session = get_object_or_404(UploadSession, pk=pk, owner=request.user)
+
+    if request.method in ('GET', 'HEAD'):
+        return _upload_session_response(session)
+
+    elif request.method == 'DELETE':
+        discard_upload_session(session)
+        return HttpResponse(status=204)
+
+    elif request.method == 'PATCH':
+        try:
+            offset = int(request.META.get('HTTP_UPLOAD_OFFSET', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return JsonResponse({'error': '缺少 Upload-Offset 或 Content-Length'}, status=400)
+
+        if offset + length > session.size:
+            return JsonResponse({'error': '上传的数据超过了声明的文件大小'}, status=413)
+        # 不在事务里写：传输期间不锁会话，同一个会话同时只有一个 PATCH 能写由临时文件的锁保证
+        if append_upload_chunk(session, request, offset, length) is None: # 客户端需要先查询 offset
+            session = get_object_or_404(UploadSession, pk=pk, owner=request.user) # 可能刚被删掉
+            return _upload_session_response(session, status=409)
+        return _upload_session_response(session)
+
+    return HttpResponseNotAllowed(['GET', 'HEAD', 'PATCH', 'DELETE'])
+
+
+@login_required
+@require_POST
+def upload_session_finalize(request, pk):
+    """ 所有数据都上传完之后，生成 File 对象 """
+    with transaction.atomic():
+        session = get_object_or_404(
+            UploadSession.objects.select_for_update(), pk=pk, owner=request.user)
+        if session.offset != session.size:
+            return _upload_session_response(session, status=409)
+        try:
+            file = finalize_upload_session(session)
+        except NameConflict as e: # 会话保留，客户端处理掉同名文件之后可以再 finalize
+            return JsonResponse({'error': str(e)}, status=409)
+
+    return JsonResponse(file.to_dict(), status=201)
+
+
+@login_required
+@require_POST
+def upload_preflight(request):
+    """
+        秒传：客户端上传前先报告文件名、大小和 sha1
+        POST: name, size, digest, directory（可选，默认当前目录）, conflict（可选）
+              token, sample（第二步才需要）
+
+        服务器上没有这个 digest 时返回 exists=False，客户端正常上传；
+        有的话，为了证明客户端确实拥有这个文件，而不是只知道 sha1，
+        先返回一个随机区间 challenge，客户端再带上这个区间的 sha1（sample）提交一次，
+        校验通过后直接创建 File，不传输任何数据
+    """
+    name = request.POST.get('name', '').strip()
+    digest = request.POST.get('digest', '').lower()
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = -1
+    if not name or size < 0 or not re.match(r'^[0-9a-f]{40}$', digest):
+        return JsonResponse({'error': '需要提供文件名 name，文件大小 size 和 sha1 摘要 digest'}, status=400)
+    try:
+        conflict = get_conflict_arg(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    dir_pk = request.POST.get('directory') or get_session_data(request, 'directory')
+    directory = get_object_or_404(Directory, pk=dir_pk, owner=request.user)
+    if not check_quota(request.user, size): # 秒传的文件同样占用户的空间
+        return JsonResponse({'error': '抱歉，空间不足'}, status=413)
+
+    if not find_stored_blob(digest, size):
+        return JsonResponse({'exists': False})
+
+    if settings.UPLOAD_PREFLIGHT_PROOF:
+        token = request.POST.get('token')
+        if not token:
+            return JsonResponse({'exists': True, 'challenge': make_preflight_challenge(digest, size)})
+        if not check_preflight_sample(digest, token, request.POST.get('sample', '')):
+            return JsonResponse({'error': '文件校验失败，请正常上传'}, status=403)
+
+    try:
+        file = create_file_object(digest, name, size, request.user, directory, conflict, stored_only=True)
+    except NameConflict as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    if file is None: # 校验之后内容刚好被删光了，让客户端正常上传
+        return JsonResponse({'exists': False})
+    return JsonResponse(dict(file.to_dict(), exists=True), status=201)
+
+
+@login_required
+def download(request, pk):
+    """ 一般是下载，当附带 preview=True query string 时为预览 
+        支持 Range 断点续传，大文件不会整个读进内存
+    """
+
+    file = get_object_or_404(File, pk=pk, owner=request.user)
+    return get_download_response(request, file, preview=bool(request.GET.get('preview')))
+
+
 @login_required
 def preview(request, pk):
     """ 预览文件 
@@ -270,17 +472,35 @@ def preview(request, pk):
         点击后预览全文（大图）: preview=True
     """
 
-    file = get_object_or_404(File, pk=pk)
-    magic_type = magic.from_file(file.get_full_path())
+    file = get_object_or_404(File, pk=pk, owner=request.user)
+    mime, magic_type = get_file_type(file)
     if request.GET.get('thumbnail'):
-        if 'image' in magic_type:
-            response = "<a target='_blank' href='{a}/{b}?preview=True'><img src='{a}/{b}''>".format(a='/download', b=pk)
-            return HttpResponse(response)
-        elif 'UTF-8 Unicode text' in magic_type:
-            response = "<h2>{} 摘要</h2><p>{} ... ...</p>".format(file.name, open(file.get_full_path()).read(1000))
+        if 'image' in magic_type: # 先显示缩略图，点开再看原图
+            response = "<a target='_blank' href='{}?preview=True'><img src='{}'></a>".format(
+                reverse('myapp:download', args=[pk]),
+                reverse('myapp:thumbnail', args=[pk, settings.THUMBNAIL_PREVIEW_SIZE]))
             return HttpResponse(response)
-    else:
-        return HttpResponse('<p>Sorry啦，这个文件不能预览</p>')
+        elif is_text(mime, magic_type): # 只读开头和末尾几 KB
+            return HttpResponse(render_text_preview(file))
+    return HttpResponse('<p>Sorry啦，这个文件不能预览</p>')
+
+
+@login_required
+def listing(request, pk):
+    """ 目录列表的 JSON 版本，参数和目录详情页一样，next 为 null 时表示没有下一页了 """
+    directory = get_object_or_404(Directory, pk=pk, owner=request.user)
+    sort, reverse, cursor, limit = get_listing_args(request)
+    entries, next_cursor = list_directory(directory, request.user.username, sort, reverse, cursor, limit)
+    return JsonResponse({'entries': entries, 'next': next_cursor})
+
+
+@login_required
+def thumbnail(request, pk, size):
+    """ 图片的缩略图，size 只能是 THUMBNAIL_SIZES 里的尺寸 """
+    file = get_object_or_404(File, pk=pk, owner=request.user)
+    if int(size) not in settings.THUMBNAIL_SIZES:
+        raise Http404
+    return get_thumbnail_response(request, file, int(size))
 
 
 @login_required
@@ -289,7 +509,7 @@ def edit(request, pk):
         todo: 支持移动路径、是否共享
     """
 
-    file = get_object_or_404(File, pk=pk)
+    file = get_object_or_404(File, pk=pk, owner=request.user)
     owner = request.user
 
     if request.method == 'GET':
@@ -297,11 +517,13 @@ def edit(request, pk):
     elif request.method == 'POST':
         form = EditForm(request.POST)
         if form.is_valid():
-            name = form.cleaned_data['name']
-            file.name = name
-            file.save()
-            path = os.path.join(file.path, file.name)
-            return redirect('myapp:detail', username=owner.username, path=path)
+            try:
+                file.move(name=form.cleaned_data['name'])
+            except ValueError as e: # 同一个目录下已经有这个名字
+                form.add_error('name', str(e))
+            else:
+                path = os.path.join(file.path, file.name)
+                return redirect('myapp:detail', username=owner.username, path=path)
 
     context = {'form': form, 'file': file}
     return render(request, 'myapp/edit.html', context)
@@ -311,7 +533,7 @@ def edit(request, pk):
 def delete(request, pk):
     """ 提供一个页面，让用户确认 """
 
-    file = get_object_or_404(File, pk=pk)
+    file = get_object_or_404(File, pk=pk, owner=request.user)
     directory = file.parent
     # import pdb; pdb.set_trace()
     if request.method == 'POST':
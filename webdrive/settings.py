@@ -44,6 +44,7 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'myapp.middleware.QuotaMiddleware', # 要在 CSRF 读取上传的请求体之前检查配额
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -137,3 +138,148 @@ LOGIN_URL = 'myapp:login'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+
+# 下载时每次读取的字节数
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 一个 Range 请求最多允许的区间数，超过则直接返回整个文件
+DOWNLOAD_MAX_RANGES = 16
+
+# 下载响应允许浏览器缓存的秒数，blob 按 sha1 命名，内容不会变
+DOWNLOAD_CACHE_MAX_AGE = 60 * 60 * 24 * 365
+
+# 把下载交给前端代理传输，Django 只负责权限检查
+#   None: 由 Django 自己流式传输
+#   'nginx': X-Accel-Redirect，需要配置 internal location，如
+#            location /protected/ { internal; alias <MEDIA_ROOT>/; }
+#   'xsendfile': X-Sendfile，用于 Apache mod_xsendfile 或 lighttpd
+SENDFILE_BACKEND = None
+
+# nginx 中映射到 MEDIA_ROOT 的 internal location
+SENDFILE_URL = '/protected/'
+
+# 上传时每次从请求中读取、写入磁盘的字节数，1 到 8 MB 比较合适
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 上传时是否在单独的线程里计算 sha1，让 hash 和磁盘写入重叠
+UPLOAD_HASH_IN_THREAD = False
+
+# 是否 fsync 新的 blob，保证放到 digest 对应的位置之后已经落盘
+# 只在 place_blob 真正放了新的 blob 时 fsync 一次，上传的请求里不 fsync 重复的内容
+UPLOAD_FSYNC = True
+
+# 每个进程最多缓存多少个断点续传会话的 sha1 状态
+UPLOAD_HASHER_CACHE_SIZE = 1024
+
+# 秒传时是否要求客户端对随机区间做 sha1 校验，证明确实拥有文件
+UPLOAD_PREFLIGHT_PROOF = True
+
+# 秒传校验区间的最大长度
+UPLOAD_PREFLIGHT_SAMPLE_SIZE = 64 * 1024
+
+# 秒传校验 token 的有效期（秒）
+UPLOAD_PREFLIGHT_MAX_AGE = 300
+
+# 预览时读取文件开头多少字节来判断文件类型
+PREVIEW_SNIFF_SIZE = 64 * 1024
+
+# 内容定义分块（CDC）去重：大文件按内容切成 chunk 分别储存，
+# 只改动了一小部分的大文件只需要多存几个 chunk。
+# 切分是纯 Python 实现，速度大约每秒几 MB，只对足够大的文件启用；
+# 上传时先存完整的文件，之后由 chunk_blobs 命令在 web 进程之外切分（fsck 扫描时也会补上）。
+# CHUNK_STORE_THREAD 为 True 时改由 web 进程里的后台线程切分，只适合单进程的开发环境：
+# 切分时占着 GIL，会拖慢同一个进程的请求，进程退出时没切完的要等 chunk_blobs 补上
+CHUNK_STORE = False
+CHUNK_STORE_THREAD = False
+CHUNK_STORE_MIN_FILE_SIZE = 64 * 1024 * 1024
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+# blob 在 MEDIA_ROOT 下的目录布局
+#   'flat': 所有 blob 直接放在 MEDIA_ROOT 下
+#   'sharded': 按 sha1 前缀分层，如 MEDIA_ROOT/ab/cd/abcdef...
+# 从 flat 改成 sharded 之后运行 python manage.py migrate_blobs 搬动已有的文件
+BLOB_LAYOUT = 'flat'
+BLOB_SHARD_DEPTH = 2
+BLOB_SHARD_WIDTH = 2
+
+# 删除目录后是否在本进程的后台线程里删除计数归零的 blob，
+# 为 False 时只能由定期运行的 fsck 命令清理
+BLOB_REAPER_THREAD = True
+
+# fsck 命令：修改时间在这么多秒以内的文件不动，避免误删正在上传的文件
+GC_GRACE_SECONDS = 3600
+
+# fsck 命令：没有引用的 blob 在隔离区里保留多少秒才真正删除
+GC_QUARANTINE_SECONDS = 7 * 24 * 3600
+
+# 超过这么多秒没有完成的断点续传会话由 fsck 命令删除
+UPLOAD_SESSION_MAX_AGE = 7 * 24 * 3600
+
+# 每个用户默认可以使用的空间（字节），None 表示不限制；单个用户的配额在 Usage.quota 里修改
+USER_QUOTA = 10 * 1024 * 1024 * 1024
+
+# 缩略图：可以生成的尺寸（像素，长边），预览页用 THUMBNAIL_PREVIEW_SIZE
+# Pillow 没有编译 WebP 支持时自动改用 JPEG
+THUMBNAIL_SIZES = (256, 1024)
+THUMBNAIL_PREVIEW_SIZE = 256
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_QUALITY = 80
+# 生成缩略图的进程数，也就是同时解码的图片数；排队超过 THUMBNAIL_MAX_PENDING 时返回 503
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_MAX_PENDING = 16
+# 像素数超过这个值的图片不生成缩略图，避免解码时占用太多内存
+THUMBNAIL_MAX_PIXELS = 64 * 1024 * 1024
+# 请求最多等待缩略图生成多少秒
+THUMBNAIL_TIMEOUT = 30
+
+# 每个进程在内存里缓存多少个 digest 的文件类型，见 handles.get_file_type
+FILE_TYPE_CACHE_SIZE = 4096
+
+# 文本预览只读文件开头和末尾这么多字节，最多显示多少行
+TEXT_PREVIEW_HEAD_SIZE = 4 * 1024
+TEXT_PREVIEW_TAIL_SIZE = 2 * 1024
+TEXT_PREVIEW_MAX_LINES = 50
+# 没有 BOM 时按顺序尝试的编码，都不行时按 latin-1 显示
+TEXT_PREVIEW_ENCODINGS = ('utf-8', 'gb18030')
+
+# 每个进程预先渲染好的验证码个数，0 表示每次请求时再渲染
+# 少于 CAPTCHA_POOL_LOW_WATER 个时由后台线程补充
+CAPTCHA_POOL_SIZE = 256
+CAPTCHA_POOL_LOW_WATER = 64
+
+# 验证码放在签名的 cookie 里，匿名用户打开登录页不会创建 session
+# 为 False 时和以前一样放在 session 里
+CAPTCHA_STATELESS = True
+CAPTCHA_COOKIE_NAME = 'captcha'
+# 验证码的有效期（秒）
+CAPTCHA_MAX_AGE = 300
+
+# 用过的验证码记在 cache 里防止重复使用；多进程部署时需要换成所有进程共用的 cache，
+# 如 memcached 或 redis，否则同一个验证码可以在每个进程各用一次
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# 目录列表每页默认多少项，?limit= 最多可以要多少项
+LISTING_PAGE_SIZE = 100
+LISTING_MAX_PAGE_SIZE = 1000
+
+# JSON API 的 batch 接口一次最多执行多少个操作，所有操作在同一个事务里
+API_BATCH_MAX_OPERATIONS = 1000
+
+# 打包下载目录时，这些扩展名的文件已经压缩过，ZIP 里用 stored 模式，不再压缩
+ARCHIVE_STORED_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst',
+    '.docx', '.xlsx', '.pptx', '.pdf',
+)
+
+# 上传时目录下已经有同名文件怎么办，请求里没有指定 conflict 时使用
+# suffix: 新文件改名为 name_<pk>；replace: 已有的文件换成新的内容；reject: 拒绝上传
+UPLOAD_NAME_CONFLICT = 'suffix'